@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Times serializing lots of small FLANN indices through typedbytes, with the
+in-memory (memfd) scratch files and with the tempfile fallback.
+
+    python benchmarks/bench_flann_typedbytes.py --n-indices 10000
+'''
+from __future__ import division, print_function
+
+from cStringIO import StringIO
+from contextlib import closing
+import time
+
+import numpy as np
+import cyflann
+
+from sdm import typedbytes_utils as tbu
+from sdm.typedbytes_utils import tb
+
+
+def make_indices(n_indices, n_pts, dim, algorithm):
+    rs = np.random.RandomState(0)
+    indices = []
+    for _ in range(n_indices):
+        idx = cyflann.FLANNIndex(algorithm=algorithm)
+        idx.build_index(rs.normal(size=(n_pts, dim)).astype(np.float32))
+        indices.append(idx)
+    return indices
+
+
+def time_save(indices, tempdir):
+    with closing(StringIO()) as sio:
+        out = tb.Output(sio)
+        tbu.register_write(out)
+        start = time.time()
+        for idx in indices:
+            tbu.flann_to_typedbytes(out, idx, tempdir=tempdir)
+        elapsed = time.time() - start
+        return elapsed, sio.getvalue()
+
+
+def time_load(raw, n_indices, tempdir):
+    with closing(StringIO(raw)) as sio:
+        inp = tb.Input(sio)
+        tbu.register_read_ndarray(inp)
+        start = time.time()
+        for _ in range(n_indices):
+            assert inp.file.read(1) == chr(tbu.FLANN_CODE)
+            tbu.flann_from_typedbytes(inp, tempdir=tempdir)
+        return time.time() - start
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--n-indices', type=int, default=10000)
+    parser.add_argument('--n-pts', type=int, default=50)
+    parser.add_argument('--dim', type=int, default=5)
+    parser.add_argument('--algorithm', default='kdtree_single')
+    parser.add_argument('--tempdir', default=None,
+        help="Where the fallback puts its scratch files (default: system).")
+    args = parser.parse_args()
+
+    indices = make_indices(args.n_indices, args.n_pts, args.dim,
+                           args.algorithm)
+    print("{:,} {} indices of {}x{} points".format(
+        args.n_indices, args.algorithm, args.n_pts, args.dim))
+
+    real_memfd_create = tbu._memfd_create
+    modes = [('tempfile', None)]
+    if real_memfd_create is not None:
+        modes.insert(0, ('memfd', real_memfd_create))
+    else:
+        print("memfd_create isn't available here; only timing the fallback")
+
+    try:
+        for name, memfd_create in modes:
+            tbu._memfd_create = memfd_create
+            save_time, raw = time_save(indices, args.tempdir)
+            load_time = time_load(raw, args.n_indices, args.tempdir)
+            print("{:>8}: save {:8,.0f}/s   load {:8,.0f}/s".format(
+                name, args.n_indices / save_time,
+                args.n_indices / load_time))
+    finally:
+        tbu._memfd_create = real_memfd_create
+
+
+if __name__ == '__main__':
+    main()
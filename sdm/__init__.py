@@ -5,7 +5,8 @@ from . import features
 from .features import Features
 
 from . import np_divs
-from .np_divs import estimate_divs
+from .np_divs import (estimate_divs, estimate_cross_divs, recompute_divs,
+                      estimate_entropies)
 
 from . import sdm
 from .sdm import SDC, NuSDC, SDR, NuSDR, OneClassSDM
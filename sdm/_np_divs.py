@@ -1,9 +1,44 @@
 from __future__ import division
 
+import time
+
 import numpy as np
 
 from .utils import lazy_range, izip, iteritems
-from .mp_utils import progress
+
+
+# the kinds of job lists the kernels enumerate; see np_divs.PairMask
+_JOBS_BLOCK = 0
+_JOBS_TRIANGLE = 1
+_JOBS_LIST = 2
+
+# how often, in seconds, the kernels report progress
+PROGRESS_INTERVAL = .25
+
+
+def _stack_bags(rhos):
+    # The rows of each bag's array stacked together, and the boundaries of
+    # the bags in that stack (as in Features._boundaries).
+    boundaries = np.hstack([[0], np.cumsum([rho.shape[0] for rho in rhos])])
+    return np.vstack(rhos), boundaries
+
+
+def _bag_means(stacked, boundaries):
+    # The mean of each bag's rows of stacked, as one segmented reduction
+    # rather than a Python loop over the bags (which can be very slow for
+    # lots of small bags). All the bags must be nonempty.
+    sums = np.add.reduceat(stacked, boundaries[:-1], axis=0, dtype=np.float64)
+    sums /= np.diff(boundaries)[:, np.newaxis]
+    return sums
+
+
+def _rho_logs(rhos):
+    # The log of each point's rho at each K, stacked across bags, and each
+    # bag's mean of those: all that kl and the alpha divergences need from
+    # rhos, so it's worth computing once rather than for every pair.
+    stacked, boundaries = _stack_bags(rhos)
+    logs = np.ascontiguousarray(np.log(stacked), dtype=np.float32)
+    return logs, _bag_means(logs, boundaries).astype(np.float32)
 
 
 def _linear(Bs, dim, num_q, rhos, nus):
@@ -96,31 +131,166 @@ def _jensen_shannon_core(Ks, dim, min_i, digamma_vals, num_q, rhos, nus):
     return est
 
 
+def _jensen_renyi_core(omas, Ks, dim, log_gamma_ratios, num_q, rhos, nus):
+    # For each alpha and K, the mean over points X_i in X of
+    #   (i * r^d / w)^(1 - alpha) * gamma(i) / gamma(i + 1 - alpha)
+    # where r is the radius of the largest ball around X_i in X+Y whose
+    # weight w is at most K / (n+m-1), with the weights as in
+    # _jensen_shannon_core, and i is the number of points in that ball (but
+    # at least 1). log_gamma_ratios[a, i] is the log of the gamma ratio for
+    # the ath alpha.
+    num_p = rhos.shape[0]
+
+    t = 2 * num_p - 1
+    p_wt = 1 / t
+    q_wt = num_p / (num_q * t)
+
+    quantiles = Ks / (num_p + num_q - 1)
+    omas = np.reshape(omas, (-1, 1))
+
+    est = np.zeros((omas.size, Ks.size))
+
+    max_k = rhos.shape[1]
+    combo = np.empty(max_k * 2, dtype=[('dist', np.float32), ('weight', float)])
+    for rho, nu, in izip(rhos, nus):
+        combo['dist'][:max_k] = rho
+        combo['dist'][max_k:] = nu
+        combo['weight'][:max_k] = p_wt
+        combo['weight'][max_k:] = q_wt
+        combo.sort()
+        weights = np.cumsum(combo['weight'])
+
+        i = np.maximum(weights.searchsorted(quantiles, side='right'), 1)
+        log_mass = (np.log(i / weights[i - 1])
+                    + dim * np.log(combo['dist'][i - 1]))
+        est += np.exp(omas * log_mass + log_gamma_ratios[:, i])
+    est /= num_p
+    return est
+
+
 ################################################################################
 
+def _within_bag_sq_dists(features, indices, max_K, cores):
+    # The squared distances from each point to its max_K nearest neighbors
+    # in its own bag (not counting itself), stacked across the bags. The
+    # Cython version searches the bags in parallel.
+    return np.vstack([idx.nn_index(bag, max_K + 1)[1][:, 1:]
+                      for bag, idx in izip(features.features, indices)])
+
+
 def _estimate_cross_divs(features, indices, rhos,
                          mask, funcs, Ks, max_K, save_all_Ks,
                          specs, n_meta_only,
-                         progressbar, cores, min_dist):
-    n_bags = len(features)
+                         progress, cores, min_dist,
+                         col_features=None, col_indices=None,
+                         log_rhos=None, knn_out=None):
+    # Estimates divergences from each bag in features (with within-bag
+    # distances rhos) to each bag in col_features (with indices col_indices),
+    # for the pairs in mask (a PairMask, or None meaning all of them). If
+    # col_features is None, the columns are the same bags as the rows.
+    # log_rhos is only used by the Cython version.
+    #
+    # If knn_out is given, it's (nu_sq_dists, col_ptr, rows, offsets) for a
+    # kNN store (see np_divs._knn_store_index): the squared distances from
+    # each row bag's points to their neighbors in each column bag are
+    # written into nu_sq_dists (except for a square's diagonal). That can
+    # have more columns than max_K, the number the estimators look at.
+    square = col_features is None
+    if square:
+        col_features = features
+        col_indices = indices
+
+    search_K = max_K
+    if knn_out is not None:
+        knn_buf, knn_col_ptr, knn_rows, knn_offsets = knn_out
+        search_K = knn_buf.shape[1]
+    b = features._boundaries
+
+    def sq_dists(i, start, end):
+        # find the nearest neighbors in col bag i from these points
+        dists = col_indices[i].nn_index(features._features[start:end],
+                                        search_K)[1]
+        if knn_out is not None:
+            col_rows = knn_rows[knn_col_ptr[i]:knn_col_ptr[i + 1]]
+            for j in lazy_range(*np.searchsorted(b, [start, end])):
+                if not (square and i == j):
+                    k = knn_col_ptr[i] + np.searchsorted(col_rows, j)
+                    knn_buf[knn_offsets[k]:knn_offsets[k + 1]] = \
+                        dists[b[j] - start:b[j + 1] - start]
+        return dists[:, :max_K]
+
+    return _divs_from_sq_dists(
+        features._boundaries, col_features._n_pts, rhos, mask, funcs, Ks,
+        save_all_Ks, specs, n_meta_only, progress, min_dist, sq_dists,
+        square)
+
+
+def _divs_from_knn_store(boundaries, n_pts, dim, rhos,
+                         mask, funcs, Ks, max_K, save_all_Ks,
+                         specs, n_meta_only,
+                         progress, cores, min_dist, knn_in):
+    # Like _estimate_cross_divs between a set of bags and itself, but reads
+    # the squared neighbor distances from a kNN store instead of searching:
+    # knn_in is (nu_sq_dists, col_ptr, rows, offsets), as knn_out is there,
+    # where nu_sq_dists can have more than max_K columns. Every pair in mask
+    # must be in the store. dim and cores are only used by the Cython version.
+    nus, col_ptr, pair_rows, offsets = knn_in
+    cache = {}
+
+    def sq_dists(i, start, end):
+        # a run of rows in column i is a run of its stored pairs, whose
+        # distances are consecutive, except that a diagonal pair has none
+        if cache.get('i') != i:
+            cache['i'] = i
+            c0, c1 = col_ptr[i], col_ptr[i + 1]
+            cache['rows'] = pair_rows[c0:c1]
+            cache['offsets'] = offsets[c0:c1 + 1] - offsets[c0]
+            cache['dists'] = nus[offsets[c0]:offsets[c1], :max_K]
+        r0, r1 = np.searchsorted(boundaries, [start, end])
+        k0 = np.searchsorted(cache['rows'], r0)
+        offs = cache['offsets']
+        dists = cache['dists'][offs[k0]:offs[k0 + r1 - r0]]
+        if r0 <= i < r1:
+            # the diagonal's estimates don't look at these
+            at = offs[k0 + i - r0] - offs[k0]
+            filler = np.empty((n_pts[i], max_K), dtype=dists.dtype)
+            filler.fill(np.nan)
+            dists = np.vstack([dists[:at], filler, dists[at:]])
+        return dists
+
+    return _divs_from_sq_dists(
+        boundaries, n_pts, rhos, mask, funcs, Ks, save_all_Ks, specs,
+        n_meta_only, progress, min_dist, sq_dists, square=True)
+
+
+def _divs_from_sq_dists(boundaries, col_n_pts, rhos, mask, funcs, Ks,
+                        save_all_Ks, specs, n_meta_only, progress, min_dist,
+                        sq_dists, square):
+    # The guts of the pure-Python _estimate_cross_divs and
+    # _divs_from_knn_store, which get their neighbor distances from
+    # sq_dists(i, start, end): the squared distances from row points start
+    # to end to their max_K nearest neighbors in column bag i.
+    n_rows = len(boundaries) - 1
+    n_cols = len(col_n_pts)
     K_indices = Ks - 1
     which_Ks = slice(None, None) if save_all_Ks else K_indices
 
-    outputs = np.empty((n_bags, n_bags, len(specs) + n_meta_only, len(Ks)),
+    outputs = np.empty((n_rows, n_cols, len(specs) + n_meta_only, len(Ks)),
                        dtype=np.float32)
     outputs.fill(np.nan)
 
     # TODO: should just call functions that need self up here with rhos
     #       instead of computing nus and then throwing them out below
     any_run_self = False
-    all_bags = lazy_range(n_bags)
-    for func, info in iteritems(funcs):
-        self_val = getattr(func, 'self_value', None)
-        if self_val is not None:
-            pos = np.reshape(info.pos, (-1, 1))
-            outputs[all_bags, all_bags, pos, :] = self_val
-        else:
-            any_run_self = True
+    if square:
+        all_bags = lazy_range(n_rows)
+        for func, info in iteritems(funcs):
+            self_val = getattr(func, 'self_value', None)
+            if self_val is not None:
+                pos = np.reshape(info.pos, (-1, 1))
+                outputs[all_bags, all_bags, pos, :] = self_val
+            else:
+                any_run_self = True
 
     # Keep track of whether each function needs rho_sub or just rho
     # TODO: this could be faster....
@@ -135,9 +305,22 @@ def _estimate_cross_divs(features, indices, rhos,
         def needs_sub(func):
             return False
 
-    indices_loop = progress()(indices) if progressbar else indices
-    for i, index in enumerate(indices_loop):
-        # Loop over rows of the output array.
+    if mask is None:
+        def col_mask(i):
+            return np.ones(n_rows, dtype=bool)
+    else:
+        def col_mask(i):
+            return mask.column(i, n_rows)
+
+    if progress is not None:
+        n_jobs = sum(col_mask(i).sum() for i in lazy_range(n_cols))
+        n_done = 0
+        start_time = time.time()
+        next_report = start_time + PROGRESS_INTERVAL
+        progress(0, n_jobs, 0.)
+
+    for i in lazy_range(n_cols):
+        # Loop over columns of the output array.
         #
         # We want to search from most(?) of the other bags to this one, as
         # determined by mask and to avoid repeating nus.
@@ -153,38 +336,45 @@ def _estimate_cross_divs(features, indices, rhos,
         #
         # TODO: Is cythonning this file/this function worth it?
 
-        num_q = features._n_pts[i]
+        if progress is not None:
+            now = time.time()
+            if now >= next_report:
+                next_report = now + PROGRESS_INTERVAL
+                progress(n_done, n_jobs, n_done / (now - start_time))
+
+        num_q = col_n_pts[i]
 
         # make a boolean array of whether we want to do the ith bag
-        do_bag = mask[i]
-        if not any_run_self:
-            do_bag = do_bag.copy()
+        do_bag = col_mask(i)
+        if progress is not None:
+            n_done += do_bag.sum()
+        if square and not any_run_self:
             do_bag[i] = False
+        if not do_bag.any():
+            continue
 
         # loop over contiguous sections where do_bag is True
-        change_pts = np.hstack([0, np.diff(do_bag).nonzero()[0] + 1, n_bags])
+        change_pts = np.hstack([0, np.diff(do_bag).nonzero()[0] + 1, n_rows])
         s = 0 if do_bag[0] else 1
         for start, end in izip(change_pts[s::2], change_pts[s+1::2]):
-            boundaries = features._boundaries[start:end+1]
-            feats = features._features[boundaries[0]:boundaries[-1]]
-            base = boundaries[0]
+            bounds = boundaries[start:end+1]
+            base = bounds[0]
 
-            # find the nearest neighbors in features[i] from each of these bags
-            neighbors = np.maximum(min_dist,
-                    np.sqrt(index.nn_index(feats, max_K)[1][:, which_Ks]))
+            neighbors = np.maximum(min_dist, np.sqrt(
+                sq_dists(i, bounds[0], bounds[-1])[:, which_Ks]))
 
             for j_sub, j in enumerate(lazy_range(start, end)):
                 rho = rhos[j]
 
-                nu_start = boundaries[j_sub] - base
-                nu_end = boundaries[j_sub + 1] - base
+                nu_start = bounds[j_sub] - base
+                nu_end = bounds[j_sub + 1] - base
                 nu = neighbors[nu_start:nu_end]
 
                 if save_all_Ks:
                     rho_sub = rho[:, K_indices]
                     nu_sub = nu[:, K_indices]
 
-                if i == j:
+                if square and i == j:
                     for func, info in iteritems(funcs):
                         o = (j, i, info.pos, slice(None))
                         if getattr(func, 'self_value', None) is None:
@@ -200,4 +390,8 @@ def _estimate_cross_divs(features, indices, rhos,
                             outputs[o] = func(num_q, rho_sub, nu_sub)
                         else:
                             outputs[o] = func(num_q, rho, nu)
+
+    if progress is not None:
+        elapsed = time.time() - start_time
+        progress(n_done, n_jobs, n_done / elapsed if elapsed > 0 else 0.)
     return outputs
@@ -6,68 +6,91 @@ from cython.parallel import prange, threadid
 from libc.stdlib cimport malloc, free
 from libc.math cimport log, sqrt, fmax
 from cpython.exc cimport PyErr_CheckSignals
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
 
 from functools import partial
 
 import numpy as np
 cimport numpy as np
-from numpy cimport uint8_t
 
 from cyflann.flann cimport flann_index_t, FLANNParameters, \
                            flann_find_nearest_neighbors_index_float
 from cyflann.index cimport FLANNIndex, FLANNParameters as CyFLANNParameters
 
 from .utils import lazy_range, izip, iteritems
-from .mp_utils import progress
 
 from ._np_divs import (_linear as py_linear,
                        kl as py_kl,
                        _alpha_div as py_alpha_div,
-                       _jensen_shannon_core as py_js_core)
+                       _jensen_shannon_core as py_js_core,
+                       _jensen_renyi_core as py_jr_core,
+                       _JOBS_BLOCK as py_JOBS_BLOCK,
+                       _JOBS_TRIANGLE as py_JOBS_TRIANGLE,
+                       PROGRESS_INTERVAL as py_PROGRESS_INTERVAL,
+                       _rho_logs)
+
+cdef extern from "math.h" nogil:
+    float expf(float x)
+    float logf(float x)
 
 cdef float fnan = float("NaN")
 cdef float finf = float("inf")
+cdef int JOBS_BLOCK = py_JOBS_BLOCK
+cdef int JOBS_TRIANGLE = py_JOBS_TRIANGLE
+cdef double PROGRESS_INTERVAL = py_PROGRESS_INTERVAL
+
+# per-thread counters are this many longs apart, so that they're on separate
+# cache lines
+DEF COUNTER_STRIDE = 8
+
+
+cdef inline double _now() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
 cdef void _linear(float[:] Bs, int dim, int num_q,
-                  float[:, ::1] nus,
+                  const float[:, ::1] log_nus,
                   float[:] results) nogil:
-    #   B / m * mean(nu ^ -dim)
+    #   B / m * mean(nu ^ -dim) = B / m * mean(exp(-dim * log(nu)))
     cdef int i, j
-    cdef int num_p = nus.shape[0]
+    cdef int num_p = log_nus.shape[0]
     cdef int num_Ks = results.shape[0]
-    cdef float mean
+    cdef double total
     cdef float mdim = -dim
 
     for j in range(num_Ks):
-        mean = 0
+        total = 0
         for i in range(num_p):
-            mean += (nus[i, j] ** mdim) / num_p
-        results[j] = Bs[j] / num_q * mean
+            total += expf(mdim * log_nus[i, j])
+        results[j] = Bs[j] / num_q * total / num_p
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
 cdef void kl(int dim, int num_q,
-             float[:, ::1] rhos, float[:, ::1] nus,
+             const float[:] mean_log_rhos, const float[:, ::1] log_nus,
              float[:] results) nogil:
-    # dim * mean(log(nus) - log(rhos), axis=0) + log(num_q / (num_p - 1))
+    # dim * (mean(log(nus), axis=0) - mean(log(rhos), axis=0))
+    #   + log(num_q / (num_p - 1))
+    # with the rho half precomputed for each bag
 
     cdef int i, j
-    cdef int num_p = rhos.shape[0]
+    cdef int num_p = log_nus.shape[0]
     cdef int num_Ks = results.shape[0]
-    cdef float mean
+    cdef double total
 
     cdef float const = log(num_q / (<float> (num_p - 1)))
 
     for j in range(num_Ks):
-        mean = 0
+        total = 0
         for i in range(num_p):
-            mean += (log(nus[i, j]) - log(rhos[i, j])) / num_p
-        results[j] = max(0, dim * mean + const)
+            total += log_nus[i, j]
+        results[j] = max(0, dim * (total / num_p - mean_log_rhos[j]) + const)
 
 
 @cython.boundscheck(False)
@@ -75,13 +98,13 @@ cdef void kl(int dim, int num_q,
 @cython.cdivision(True)
 cdef void _alpha_div(float[:] omas, float[:, ::1] Bs,
                      int dim, int num_q,
-                     float[:, ::1] rhos, float[:, ::1] nus,
+                     const float[:, ::1] log_rhos, const float[:, ::1] log_nus,
                      int[:] poses, float[:, ::1] results) nogil:
     cdef int i, j, k
     cdef int num_alphas = omas.shape[0]
-    cdef int num_p = rhos.shape[0]
-    cdef int num_Ks = rhos.shape[1]
-    cdef float ratio, factor
+    cdef int num_p = log_rhos.shape[0]
+    cdef int num_Ks = log_rhos.shape[1]
+    cdef float log_ratio, factor
 
     for i in range(num_alphas):
         for j in range(num_Ks):
@@ -90,14 +113,16 @@ cdef void _alpha_div(float[:] omas, float[:, ::1] Bs,
     # the actual main estimate:
     #   mean( rho^(- dim * est alpha) nu^(- dim * est beta) )
     #   = mean( (rho / nu) ^ (dim * (1 - alpha)) )
+    #   = mean( exp(dim * (1 - alpha) * (log(rho) - log(nu))) )
+    # where the logs are computed once per point rather than once per alpha
     for k in range(num_p):
         for j in range(num_Ks):
-            ratio = rhos[k, j] / nus[k, j]
+            log_ratio = dim * (log_rhos[k, j] - log_nus[k, j])
             for i in range(num_alphas):
-                results[poses[i], j] += ratio ** (dim * omas[i]) / num_p
+                results[poses[i], j] += expf(log_ratio * omas[i])
 
     for i in range(num_alphas):
-        factor = ((<float>(num_p - 1)) / num_q) ** omas[i]
+        factor = ((<float>(num_p - 1)) / num_q) ** omas[i] / num_p
         for j in range(num_Ks):
             results[poses[i], j] *= factor * Bs[i, j]
             if results[poses[i], j] < 0.:
@@ -110,21 +135,21 @@ cdef void _alpha_div(float[:] omas, float[:, ::1] Bs,
 cdef void _jensen_shannon_core(const int[:] Ks, int dim,
                                int min_i, const float[:] digamma_vals,
                                int num_q,
-                               const float[:, ::1] rhos,
-                               const float[:, ::1] nus,
+                               const float[:, ::1] sq_rhos,
+                               const float[:, ::1] sq_nus,
                                const int[:] Ks_order, float min_sq_dist,
-                               float[:] alphas_tmp, float[:] results) nogil:
-    # NOTE: rhos contains all the neighbors up to max_K
-    # NOTE: nus here is the "dists_out" array, which is a squared distance
+                               double[:] alphas_tmp, float[:] results) nogil:
+    # NOTE: sq_rhos contains the squares of all the rhos up to max_K
+    # NOTE: sq_nus here is the "dists_out" array, which is a squared distance
     #       that hasn't been thresholded by min_dist
     cdef int i
-    cdef int num_p = rhos.shape[0]
+    cdef int num_p = sq_rhos.shape[0]
 
     cdef double t = 2 * num_p - 1
     cdef double p_wt = 1 / t
     cdef double q_wt = num_p / (num_q * t)
 
-    cdef int max_K = rhos.shape[1]
+    cdef int max_K = sq_rhos.shape[1]
     cdef int num_Ks = Ks.shape[0]
 
     cdef double alpha, max_wt = -1
@@ -136,88 +161,383 @@ cdef void _jensen_shannon_core(const int[:] Ks, int dim,
     for i in range(num_Ks):
         results[i] = 0
 
-    # mergesort rhos and nus
-    # keeping track of the incremental weights until we hit each alpha
-    cdef double curr_quantile, log_curr_dist, log_last_dist
-    cdef double next_rho_log_dist, next_nu_log_dist
+    # mergesort rhos and nus, by their squares
+    # keeping track of the incremental weights until we hit each alpha,
+    # and only taking logs when we do
+    cdef double curr_quantile, curr_dist, last_dist
+    cdef double next_rho_dist, next_nu_dist
     cdef int next_rho, next_nu, next_alpha
 
     for i in range(num_p):
         curr_quantile = 0.
         next_alpha = 0
-        log_curr_dist = log_last_dist = fnan
+        curr_dist = last_dist = fnan
 
         next_rho = 0
-        next_rho_log_dist = log(rhos[i, next_rho])
+        next_rho_dist = sq_rhos[i, next_rho]
 
         next_nu = 0
-        next_nu_log_dist = log(fmax(min_sq_dist, nus[i, next_nu])) / 2.
+        next_nu_dist = fmax(min_sq_dist, sq_nus[i, next_nu])
 
         while next_alpha < num_Ks:
-            log_last_dist = log_curr_dist
-            if next_rho_log_dist < next_nu_log_dist:
-                log_curr_dist = next_rho_log_dist
+            last_dist = curr_dist
+            if next_rho_dist < next_nu_dist:
+                curr_dist = next_rho_dist
                 curr_quantile += p_wt
                 next_rho += 1
                 if next_rho == max_K:
-                    next_rho_log_dist = finf
+                    next_rho_dist = finf
                 else:
-                    next_rho_log_dist = log(rhos[i, next_rho])
+                    next_rho_dist = sq_rhos[i, next_rho]
             else:
-                log_curr_dist = next_nu_log_dist
+                curr_dist = next_nu_dist
                 curr_quantile += q_wt
                 next_nu += 1
                 if next_nu == max_K:
-                    next_nu_log_dist = finf
+                    next_nu_dist = finf
                 else:
-                    next_nu_log_dist = \
-                        log(fmax(min_sq_dist, nus[i, next_nu])) / 2.
+                    next_nu_dist = fmax(min_sq_dist, sq_nus[i, next_nu])
 
             while (next_alpha < num_Ks and
                    curr_quantile > alphas_tmp[Ks_order[next_alpha]]):
                 results[Ks_order[next_alpha]] += (
-                    dim * log_last_dist
+                    dim * log(last_dist) / 2.
                     - digamma_vals[next_rho + next_nu - 1 - min_i]
                 ) / num_p
                 next_alpha += 1
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _jensen_renyi_core(const int[:] Ks, int dim,
+                             const float[:] omas,
+                             const float[:, ::1] log_gamma_ratios,
+                             int num_q,
+                             const float[:, ::1] sq_rhos,
+                             const float[:, ::1] sq_nus,
+                             const int[:] Ks_order, float min_sq_dist,
+                             double[:] quantiles_tmp,
+                             const int[:] poses, float[:, ::1] results) nogil:
+    # NOTE: as in _jensen_shannon_core, sq_rhos has the squares of all the
+    #       rhos up to max_K, and sq_nus is the "dists_out" array
+    cdef int a, i, k
+    cdef int num_p = sq_rhos.shape[0]
+    cdef int num_alphas = omas.shape[0]
+
+    cdef double t = 2 * num_p - 1
+    cdef double p_wt = 1 / t
+    cdef double q_wt = num_p / (num_q * t)
+
+    cdef int max_K = sq_rhos.shape[1]
+    cdef int num_Ks = Ks.shape[0]
+
+    for k in range(num_Ks):
+        quantiles_tmp[k] = Ks[k] / (num_p + num_q - 1.)
+
+    for a in range(num_alphas):
+        for k in range(num_Ks):
+            results[poses[a], k] = 0
+
+    # mergesort rhos and nus by their squares, keeping track of the number
+    # of points and the weight in the ball so far; before taking a point
+    # that would put the weight over a K's quantile, add that K's terms
+    # (unless the ball is still empty, so it always has at least one point)
+    cdef double weight, next_wt, curr_sq_dist, next_rho_dist, next_nu_dist
+    cdef double log_mass
+    cdef int count, next_rho, next_nu, next_K
+    cdef bint take_rho
+
+    for i in range(num_p):
+        count = 0
+        weight = 0.
+        curr_sq_dist = fnan
+        next_K = 0
+
+        next_rho = 0
+        next_rho_dist = sq_rhos[i, next_rho]
+
+        next_nu = 0
+        next_nu_dist = fmax(min_sq_dist, sq_nus[i, next_nu])
+
+        while True:
+            take_rho = next_rho_dist < next_nu_dist
+            if next_rho == max_K and next_nu == max_K:
+                next_wt = finf  # out of neighbors: use all of them
+            elif take_rho:
+                next_wt = p_wt
+            else:
+                next_wt = q_wt
+
+            while (count > 0 and next_K < num_Ks and
+                   weight + next_wt > quantiles_tmp[Ks_order[next_K]]):
+                k = Ks_order[next_K]
+                log_mass = log(count / weight) + dim * log(curr_sq_dist) / 2.
+                for a in range(num_alphas):
+                    results[poses[a], k] += expf(
+                        omas[a] * log_mass + log_gamma_ratios[a, count])
+                next_K += 1
+            if next_K == num_Ks:
+                break
+
+            count += 1
+            weight += next_wt
+            if take_rho:
+                curr_sq_dist = next_rho_dist
+                next_rho += 1
+                if next_rho == max_K:
+                    next_rho_dist = finf
+                else:
+                    next_rho_dist = sq_rhos[i, next_rho]
+            else:
+                curr_sq_dist = next_nu_dist
+                next_nu += 1
+                if next_nu == max_K:
+                    next_nu_dist = finf
+                else:
+                    next_nu_dist = fmax(min_sq_dist, sq_nus[i, next_nu])
+
+    for a in range(num_alphas):
+        for k in range(num_Ks):
+            results[poses[a], k] /= num_p
+
+
 ################################################################################
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
+def _within_bag_sq_dists(features, indices, int max_K, int cores):
+    # The squared distances from each point to its max_K nearest neighbors
+    # in its own bag (not counting itself), stacked across the bags, with
+    # the bags searched in parallel.
+    cdef int i, tid, num_p, i_start
+    cdef int n_bags = len(features)
+
+    cdef float[:, ::1] all_features = \
+        np.asarray(features._features, dtype=np.float32)
+    cdef long[:] boundaries = features._boundaries
+    cdef int max_pts = np.max(features._n_pts)
+
+    cdef float[:, ::1] sq_dists = \
+        np.empty((all_features.shape[0], max_K), dtype=np.float32)
+    cdef int[:, :, ::1] idx_out = \
+        np.empty((cores, max_pts, max_K + 1), dtype=np.int32)
+    cdef float[:, :, ::1] dists_out = \
+        np.empty((cores, max_pts, max_K + 1), dtype=np.float32)
+
+    cdef FLANNParameters params = \
+        (<CyFLANNParameters> indices[0].params)._this
+    params.cores = 1
+
+    cdef flann_index_t * index_array = <flann_index_t *> malloc(
+                n_bags * sizeof(flann_index_t))
+    if not index_array:
+        raise MemoryError()
+    try:
+        for i in range(n_bags):
+            index_array[i] = (<FLANNIndex> indices[i])._this
+
+        with nogil:
+            for i in prange(n_bags, num_threads=cores, schedule='dynamic'):
+                tid = threadid()
+                i_start = boundaries[i]
+                num_p = boundaries[i + 1] - i_start
+
+                flann_find_nearest_neighbors_index_float(
+                    index_id=index_array[i],
+                    testset=&all_features[i_start, 0],
+                    trows=num_p,
+                    indices=&idx_out[tid, 0, 0],
+                    dists=&dists_out[tid, 0, 0],
+                    nn=max_K + 1,
+                    flann_params=&params)
+
+                # the closest neighbor is always the point itself
+                sq_dists[i_start:i_start + num_p, :] = \
+                    dists_out[tid, :num_p, 1:]
+    finally:
+        free(index_array)
+
+    return np.asarray(sq_dists)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline long _knn_store_pos(long[:] col_ptr, int[:] rows, long[:] offsets,
+                                int i, int j) nogil:
+    # Where the stored pair (i, j)'s distances start in a kNN store's
+    # nu_sq_dists: binary search for row i among column j's rows.
+    cdef long lo = col_ptr[j], hi = col_ptr[j + 1], mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if rows[mid] < i:
+            lo = mid + 1
+        else:
+            hi = mid
+    return offsets[lo]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline bint _job_pair(long job_i, int kind,
+                           long r0, long r1, long c0, long c1, bint flag,
+                           const int[:] job_rows, const int[:] job_cols,
+                           int * i, int * j) nogil:
+    # Decodes job number job_i into the pair (i, j); returns false if the job
+    # is a duplicate that should be skipped.
+    cdef long height, width, area, a, b
+    if kind == JOBS_BLOCK:
+        # the block of rows [r0, r1) by cols [c0, c1), row-major; if flag,
+        # followed by the transposed block minus its overlap with the first
+        height = r1 - r0
+        width = c1 - c0
+        area = height * width
+        if job_i < area:
+            i[0] = r0 + job_i // width
+            j[0] = c0 + job_i % width
+            return True
+        job_i -= area
+        i[0] = c0 + job_i // height
+        j[0] = r0 + job_i % height
+        return not (r0 <= i[0] < r1 and c0 <= j[0] < c1)
+    elif kind == JOBS_TRIANGLE:
+        # number the lower triangle (a, b), b <= a, row-major, which has
+        # a * (a + 1) / 2 elements before row a; the pair is (b, a). if the
+        # diagonal's excluded (flag false), that's the lower triangle of an
+        # array one smaller, shifted down a row.
+        a = <long> ((sqrt(8. * job_i + 1) - 1) / 2)
+        while a * (a + 1) // 2 > job_i:
+            a -= 1
+        while (a + 1) * (a + 2) // 2 <= job_i:
+            a += 1
+        b = job_i - a * (a + 1) // 2
+        if not flag:
+            a += 1
+        i[0] = b
+        j[0] = a
+        return True
+    else:
+        i[0] = job_rows[job_i]
+        j[0] = job_cols[job_i]
+        return True
+
+
 def _estimate_cross_divs(features, indices, rhos,
-                         np.ndarray mask, funcs,
+                         mask, funcs,
+                         int[:] Ks, int max_K, bint save_all_Ks,
+                         specs, int n_meta_only,
+                         progress, int cores, float min_dist,
+                         col_features=None, col_indices=None,
+                         log_rhos=None, knn_out=None):
+    # Estimates divergences from each bag in features (with within-bag
+    # distances rhos) to each bag in col_features (with indices col_indices),
+    # for the pairs in mask (a PairMask, or None meaning all of them). If
+    # col_features is None, the columns are the same bags as the rows.
+    #
+    # If progress isn't None, it's called as progress(done, total, rate) with
+    # the number of pairs done, the number to do, and the pairs per second so
+    # far, at most every PROGRESS_INTERVAL seconds and once at the end.
+    #
+    # log_rhos is _rho_logs() of the rows' rhos at Ks, if it's been cached.
+    #
+    # If knn_out is given, it's (nu_sq_dists, col_ptr, rows, offsets) for a
+    # kNN store (see np_divs._knn_store_index): the squared distances from
+    # each row bag's points to their neighbors in each column bag are
+    # written into the float32 nu_sq_dists (except for a square's diagonal).
+    # That can have more columns than max_K, the number the estimators use.
+    square = col_features is None
+    if square:
+        col_features = features
+        col_indices = indices
+    return _cross_divs(
+        features._boundaries, features._n_pts, col_features._n_pts,
+        features.dim, rhos, mask, funcs, Ks, max_K, save_all_Ks, specs,
+        n_meta_only, progress, cores, min_dist, square, log_rhos,
+        np.asarray(features._features, dtype=np.float32), col_indices,
+        knn_out, None)
+
+
+def _divs_from_knn_store(boundaries, n_pts, int dim, rhos,
+                         mask, funcs,
                          int[:] Ks, int max_K, bint save_all_Ks,
                          specs, int n_meta_only,
-                         bint progressbar, int cores, float min_dist):
+                         progress, int cores, float min_dist, knn_in):
+    # Like _estimate_cross_divs between a set of bags and itself, but reads
+    # the squared neighbor distances from a kNN store instead of searching:
+    # knn_in is (nu_sq_dists, col_ptr, rows, offsets), as knn_out is there,
+    # where nu_sq_dists can have more than max_K columns. Every pair in mask
+    # must be in the store.
+    return _cross_divs(
+        boundaries, n_pts, n_pts, dim, rhos, mask, funcs, Ks, max_K,
+        save_all_Ks, specs, n_meta_only, progress, cores, min_dist, True,
+        None, None, None, None, knn_in)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _cross_divs(row_boundaries, row_n_pts, col_n_pts_, int dim, rhos,
+                mask, funcs,
+                int[:] Ks, int max_K, bint save_all_Ks,
+                specs, int n_meta_only,
+                progress, int cores, float min_dist, bint square, log_rhos,
+                features, col_indices, knn_out, knn_in):
+    # The kernel behind _estimate_cross_divs and _divs_from_knn_store: the
+    # neighbor distances come from searching col_indices for the rows of
+    # features, or if knn_in is given, from a kNN store.
     # TODO: update to handle passing all Ks or only some
     cdef int a, i, j, k
-    cdef int num_p, num_q, i_start, i_end, j_start, j_end
-
-    cdef float[:, ::1] all_rhos_stacked, rhos_stacked
+    cdef int num_p, num_q, i_start, i_end
 
+    # everything below works with squared distances or their logs
+    cdef float[:, ::1] all_sq_rhos_stacked
     if save_all_Ks:
-        all_rhos_stacked = np.ascontiguousarray(np.vstack(rhos),
-                                                dtype=np.float32)
-        rhos_stacked = np.ascontiguousarray(
-            np.asarray(all_rhos_stacked)[:, np.asarray(Ks) - 1])
-    else:
-        rhos_stacked = np.ascontiguousarray(np.vstack(rhos), dtype=np.float32)
-
-    cdef float[:, ::1] all_features = \
-        np.asarray(features._features, dtype=np.float32)
-    cdef long[:] boundaries = features._boundaries
-
-    cdef int n_bags = len(features)
+        all_sq_rhos_stacked = np.square(np.vstack(rhos), dtype=np.float32)
+
+    if log_rhos is None:
+        log_rhos = _rho_logs([rho[:, np.asarray(Ks) - 1] for rho in rhos]
+                             if save_all_Ks else rhos)
+    cdef float[:, ::1] log_rhos_stacked, mean_log_rhos
+    log_rhos_stacked, mean_log_rhos = log_rhos
+
+    cdef bint do_knn_out = knn_out is not None
+    cdef float[:, ::1] knn_buf
+    cdef long[:] knn_col_ptr, knn_offsets
+    cdef int[:] knn_rows
+    cdef long knn_pos
+    cdef int search_K = max_K
+    if do_knn_out:
+        knn_buf = knn_out[0]
+        knn_col_ptr = knn_out[1]
+        knn_rows = knn_out[2]
+        knn_offsets = knn_out[3]
+        search_K = knn_buf.shape[1]
+    cdef bint search_wider = search_K > max_K
+
+    cdef bint do_knn_in = knn_in is not None
+    cdef const float[:, :] knn_in_buf
+    if do_knn_in:
+        knn_in_buf = knn_in[0]
+        knn_col_ptr = knn_in[1]
+        knn_rows = knn_in[2]
+        knn_offsets = knn_in[3]
+
+    cdef float[:, ::1] all_features = features
+    cdef long[:] boundaries = np.asarray(row_boundaries, dtype=np.int64)
+    cdef long[:] col_n_pts = np.asarray(col_n_pts_, dtype=np.int64)
+
+    cdef int n_rows = len(row_n_pts)
+    cdef int n_cols = col_n_pts.shape[0]
     cdef int num_Ks = Ks.size
-    cdef int dim = features.dim
     cdef float min_sq_dist = min_dist * min_dist
 
     ############################################################################
     ### Handle the funcs we have.
-    # Hard-coded to only allow calling alpha, kl, linear here, for speed.
+    # Hard-coded to only allow calling linear, kl, alpha and the js and jr
+    # cores here, for speed.
 
     cdef int num_funcs = len(specs) + n_meta_only
 
@@ -240,6 +560,12 @@ def _estimate_cross_divs(features, indices, rhos,
     cdef int[:] js_Ks_order
     cdef int js_pos
 
+    cdef bint do_jr = False
+    cdef float[:] jr_omas
+    cdef float[:, ::1] jr_log_gamma_ratios
+    cdef int[:] jr_Ks_order
+    cdef int[:] jr_pos
+
     for func, info in iteritems(funcs):
         assert isinstance(func, partial)
         assert not func.keywords
@@ -302,6 +628,24 @@ def _estimate_cross_divs(features, indices, rhos,
             if js_pos < 0:
                 js_pos += num_funcs
 
+        elif real_func is py_jr_core:
+            do_jr = True
+            assert save_all_Ks
+            omas, the_Ks, the_dim, log_gamma_ratios = func.args
+            assert np.all(the_Ks == Ks)
+            assert the_dim == dim
+            jr_omas = np.asarray(omas.ravel(), dtype=np.float32)
+            assert log_gamma_ratios.shape == (jr_omas.size, 2 * max_K + 1)
+            jr_log_gamma_ratios = np.asarray(log_gamma_ratios,
+                                             dtype=np.float32)
+
+            jr_Ks_order = np.argsort(Ks).astype(np.int32)
+
+            jr_pos = np.asarray(info.pos, dtype=np.int32)
+            for i in range(jr_pos.shape[0]):
+                if jr_pos[i] < 0:
+                    jr_pos[i] += num_funcs
+
         else:
             msg = "cython code can't handle function {}"
             raise ValueError(msg.format(real_func))
@@ -309,73 +653,120 @@ def _estimate_cross_divs(features, indices, rhos,
     ############################################################################
 
     # use params with cores=1
-    cdef FLANNParameters params = (<CyFLANNParameters> indices[0].params)._this
-    params.cores = 1
-
-    # figure out which matrix elements we need to do
-    nonzero_i, nonzero_j = mask.nonzero()
-    cdef int[:] mask_is = nonzero_i.astype(np.int32), \
-                mask_js = nonzero_j.astype(np.int32)
+    cdef FLANNParameters params
+    if not do_knn_in:
+        params = (<CyFLANNParameters> col_indices[0].params)._this
+        params.cores = 1
+
+    # figure out which matrix elements we need to do: the jobs are numbered
+    # 0 to n_jobs - 1 and decoded into pairs by _job_pair(), so that only
+    # explicit lists of pairs need any memory
+    cdef int job_kind
+    cdef long r0, r1, c0, c1, job_i, n_jobs
+    cdef bint job_flag, do_job
+    cdef int[:] job_rows = None, job_cols = None
+    if mask is None:
+        job_kind, r0, r1, c0, c1, job_flag = \
+            py_JOBS_BLOCK, 0, n_rows, 0, n_cols, False
+    else:
+        job_kind, r0, r1, c0, c1, job_flag, job_rows_, job_cols_ = \
+            mask._job_spec(n_rows, n_cols)
+        if job_rows_ is not None:
+            job_rows = np.asarray(job_rows_, dtype=np.int32)
+            job_cols = np.asarray(job_cols_, dtype=np.int32)
+
+    if job_kind == JOBS_BLOCK:
+        n_jobs = (r1 - r0) * (c1 - c0)
+        if job_flag:
+            n_jobs *= 2
+    elif job_kind == JOBS_TRIANGLE:
+        n_jobs = r1 - r0
+        n_jobs = n_jobs * (n_jobs + 1) // 2 if job_flag \
+            else n_jobs * (n_jobs - 1) // 2
+    else:
+        n_jobs = job_rows.shape[0]
 
     # the results variable
     cdef float[:, :, :, ::1] outputs = np.empty(
-        (n_bags, n_bags, num_funcs, len(Ks)), dtype=np.float32)
+        (n_rows, n_cols, num_funcs, len(Ks)), dtype=np.float32)
     outputs[:, :, :, :] = fnan
 
     # temporay working variables
-    cdef int max_pts = np.max(features._n_pts)
+    cdef int max_pts = np.max(row_n_pts)
 
     # work buffer for each thread; first axis is for a thread.
     # done since cython doesn't currently support thread-local memoryviews :|
     cdef int[:, :, ::1] idx_out = \
-        np.empty((cores, max_pts, max_K), dtype=np.int32)
+        np.empty((cores, max_pts, search_K), dtype=np.int32)
     cdef float[:, :, ::1] dists_out = \
         np.empty((cores, max_pts, max_K), dtype=np.float32)
-    cdef float[:, :, ::1] neighbors = \
+    # the search results, if they're wider than what the estimators use
+    cdef float[:, :, ::1] search_out = dists_out
+    if search_wider:
+        search_out = np.empty((cores, max_pts, search_K), dtype=np.float32)
+    cdef float[:, :, ::1] log_neighbors = \
         np.empty((cores, max_pts, num_Ks), dtype=np.float32)
-    cdef float[:, ::1] alphas_tmp = np.empty((cores, num_Ks), dtype=np.float32)
+    cdef double[:, ::1] alphas_tmp = \
+        np.empty((cores, num_Ks), dtype=np.float64)
+    cdef double[:, ::1] quantiles_tmp = \
+        np.empty((cores, num_Ks), dtype=np.float64)
+    cdef int[:, ::1] job_pairs = np.empty((cores, 2), dtype=np.int32)
     cdef int tid
-    cdef long job_i, n_jobs = mask_is.shape[0]
 
-    cdef object pbar
-    cdef long jobs_since_last_tick_val
-    cdef long * jobs_since_last_tick = &jobs_since_last_tick_val
-    cdef uint8_t[:] is_done
-    if progressbar:
-        is_done = np.zeros(n_jobs, dtype=np.uint8)
-        pbar = progress(maxval=n_jobs)
-        pbar.start()
+    # each thread counts the jobs it's finished; thread 0 periodically
+    # takes the GIL to check for ^C and report progress
+    cdef long[:, ::1] done_counts = \
+        np.zeros((cores, COUNTER_STRIDE), dtype=np.int64)
+    cdef bint do_progress = progress is not None
+    cdef double start_time = _now()
+    cdef double next_check = start_time + PROGRESS_INTERVAL
+    cdef double * next_check_p = &next_check  # so prange leaves it shared
+    cdef double now
+    if do_progress:
+        progress(0, n_jobs, 0.)
 
     # make a C array of pointers to indices, so we can get it w/o the GIL
-    cdef flann_index_t * index_array = <flann_index_t *> malloc(
-                n_bags * sizeof(flann_index_t))
-    if not index_array:
-        raise MemoryError()
+    cdef flann_index_t * index_array = NULL
+    if not do_knn_in:
+        index_array = <flann_index_t *> malloc(n_cols * sizeof(flann_index_t))
+        if not index_array:
+            raise MemoryError()
     try:
         # populate the index_array
-        for i in range(n_bags):
-            index_array[i] = (<FLANNIndex> indices[i])._this
+        if not do_knn_in:
+            for j in range(n_cols):
+                index_array[j] = (<FLANNIndex> col_indices[j])._this
 
         with nogil:
             for job_i in prange(n_jobs, num_threads=cores, schedule='dynamic'):
                 tid = threadid()
-                i = mask_is[job_i]
-                j = mask_js[job_i]
+                do_job = _job_pair(job_i, job_kind, r0, r1, c0, c1, job_flag,
+                                   job_rows, job_cols,
+                                   &job_pairs[tid, 0], &job_pairs[tid, 1])
+                # assign directly so that i and j are thread-private
+                i = job_pairs[tid, 0]
+                j = job_pairs[tid, 1]
 
                 if tid == 0:
-                    with gil:
-                        PyErr_CheckSignals()  # allow ^C to interrupt us
-                    if progressbar:
-                        handle_pbar(pbar, jobs_since_last_tick, is_done)
+                    now = _now()
+                    if now >= next_check_p[0]:
+                        next_check_p[0] = now + PROGRESS_INTERVAL
+                        with gil:
+                            PyErr_CheckSignals()  # allow ^C to interrupt us
+                            if do_progress:
+                                report_progress(progress, done_counts,
+                                                n_jobs, now - start_time)
 
                 i_start = boundaries[i]
                 i_end = boundaries[i + 1]
                 num_p = i_end - i_start
 
-                if i == j:
+                if not do_job:
+                    pass
+                elif square and i == j:
                     if do_linear:
                         _linear(linear_Bs, dim, num_p,
-                                rhos_stacked[i_start:i_end],
+                                log_rhos_stacked[i_start:i_end],
                                 outputs[i, j, linear_pos, :])
                     if do_kl:
                         outputs[i, j, kl_pos, :] = 0
@@ -384,78 +775,93 @@ def _estimate_cross_divs(features, indices, rhos,
                         for k in range(alpha_pos.shape[0]):
                             outputs[i, j, alpha_pos[k], :] = 1
 
-                    # no need to set js self-values to nan, they already are
+                    # no need to set js or jr self-values to nan, they
+                    # already are
                 else:
-                    j_start = boundaries[j]
-                    j_end = boundaries[j + 1]
-                    num_q = j_end - j_start
-
-                    # do the nearest neighbor search from p to q
-                    flann_find_nearest_neighbors_index_float(
-                        index_id=index_array[j],
-                        testset=&all_features[i_start, 0],
-                        trows=num_p,
-                        indices=&idx_out[tid, 0, 0],
-                        dists=&dists_out[tid, 0, 0],
-                        nn=max_K,
-                        flann_params=&params)
-                    for a in range(num_p):
-                        for k in range(num_Ks):
-                            neighbors[tid, a, k] = fmax(min_dist,
-                                       sqrt(dists_out[tid, a, Ks[k] - 1]))
+                    num_q = col_n_pts[j]
+
+                    if do_knn_in:
+                        # the stored distances, cut down to max_K
+                        knn_pos = _knn_store_pos(knn_col_ptr, knn_rows,
+                                                 knn_offsets, i, j)
+                        dists_out[tid, :num_p, :] = \
+                            knn_in_buf[knn_pos:knn_pos + num_p, :max_K]
+                    else:
+                        # do the nearest neighbor search from p to q
+                        flann_find_nearest_neighbors_index_float(
+                            index_id=index_array[j],
+                            testset=&all_features[i_start, 0],
+                            trows=num_p,
+                            indices=&idx_out[tid, 0, 0],
+                            dists=&search_out[tid, 0, 0],
+                            nn=search_K,
+                            flann_params=&params)
+
+                    if do_knn_out:
+                        knn_pos = _knn_store_pos(knn_col_ptr, knn_rows,
+                                                 knn_offsets, i, j)
+                        knn_buf[knn_pos:knn_pos + num_p, :] = \
+                            search_out[tid, :num_p, :]
+                    if search_wider:
+                        dists_out[tid, :num_p, :] = \
+                            search_out[tid, :num_p, :max_K]
+
+                    # log(nu) = log(nu^2) / 2, with nu^2 >= min_dist^2
+                    if do_linear or do_kl or do_alpha:
+                        for a in range(num_p):
+                            for k in range(num_Ks):
+                                log_neighbors[tid, a, k] = logf(fmax(
+                                    min_sq_dist,
+                                    dists_out[tid, a, Ks[k] - 1])) / 2
 
                     if do_linear:
                         _linear(linear_Bs, dim, num_q,
-                                neighbors[tid, :num_p, :],
+                                log_neighbors[tid, :num_p, :],
                                 outputs[i, j, linear_pos, :])
 
                     if do_kl:
                         kl(dim, num_q,
-                           rhos_stacked[i_start:i_end],
-                           neighbors[tid, :num_p, :],
+                           mean_log_rhos[i],
+                           log_neighbors[tid, :num_p, :],
                            outputs[i, j, kl_pos, :])
 
                     if do_alpha:
                         _alpha_div(alpha_omas, alpha_Bs, dim, num_q,
-                                   rhos_stacked[i_start:i_end],
-                                   neighbors[tid, :num_p, :],
+                                   log_rhos_stacked[i_start:i_end],
+                                   log_neighbors[tid, :num_p, :],
                                    alpha_pos, outputs[i, j, :, :])
 
                     if do_js:
-                        _jensen_shannon_core(Ks, dim,
-                                             js_min_i, js_digamma_vals,
-                                             num_q,
-                                             all_rhos_stacked[i_start:i_end],
-                                             dists_out[tid, :num_p, :],
-                                             js_Ks_order, min_sq_dist,
-                                             alphas_tmp[tid],
-                                             outputs[i, j, js_pos, :])
-
-                if progressbar:
-                    is_done[job_i] = 1
-
-        if progressbar:
-            pbar.finish()
+                        _jensen_shannon_core(
+                            Ks, dim, js_min_i, js_digamma_vals, num_q,
+                            all_sq_rhos_stacked[i_start:i_end],
+                            dists_out[tid, :num_p, :],
+                            js_Ks_order, min_sq_dist, alphas_tmp[tid],
+                            outputs[i, j, js_pos, :])
+
+                    if do_jr:
+                        _jensen_renyi_core(
+                            Ks, dim, jr_omas, jr_log_gamma_ratios, num_q,
+                            all_sq_rhos_stacked[i_start:i_end],
+                            dists_out[tid, :num_p, :],
+                            jr_Ks_order, min_sq_dist, quantiles_tmp[tid],
+                            jr_pos, outputs[i, j, :, :])
+
+                done_counts[tid, 0] += 1
+
+        if do_progress:
+            report_progress(progress, done_counts, n_jobs,
+                            _now() - start_time)
 
         return np.asarray(outputs)
     finally:
         free(index_array)
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef bint handle_pbar(object pbar, long * jobs_since_last_tick,
-                      uint8_t[:] is_done) nogil except 1:
-    jobs_since_last_tick[0] += 1
-
-    cdef long done_count = 0
-
-    # TODO: tweak this number?
-    if jobs_since_last_tick[0] >= 20:
-        for k in range(is_done.shape[0]):
-            if is_done[k]:
-                done_count += 1
-
-        with gil:
-            pbar.update(done_count)
-        jobs_since_last_tick[0] = 0
+cdef report_progress(progress, long[:, ::1] done_counts, long n_jobs,
+                     double elapsed):
+    cdef long done = 0
+    cdef int t
+    for t in range(done_counts.shape[0]):
+        done += done_counts[t, 0]
+    progress(done, n_jobs, done / elapsed if elapsed > 0 else 0.)
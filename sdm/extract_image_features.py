@@ -5,7 +5,7 @@ from bisect import bisect
 from collections import defaultdict
 import csv
 from functools import partial
-from itertools import imap, islice, takewhile
+from itertools import imap, islice, izip, takewhile
 import os
 import random
 import warnings
@@ -15,8 +15,8 @@ import numpy as np
 from vlfeat.phow import (vl_phow, DEFAULT_MAGNIF, DEFAULT_CONTRAST_THRESH,
                          DEFAULT_WINDOW_SIZE, DEFAULT_COLOR, COLOR_CHOICES)
 
-from .utils import (positive_int, positive_float, nonnegative_float,
-                    strict_map, str_types, confirm_outfile, iteritems)
+from .utils import (positive_int, nonnegative_int, positive_float,
+                    nonnegative_float, str_types, confirm_outfile, iteritems)
 from .features import Features
 
 # NOTE: depends on skimage for resizing, and either opencv, matplotlib with PIL,
@@ -49,11 +49,21 @@ def get_features(img, color=DEFAULT_COLOR,
 
 IMREAD_MODES = ['skimage-pil', 'skimage-qt', 'skimage-gdal', 'cv2',
                 'matplotlib', 'skimage-freeimage']
+_imread_cache = {}
 def _find_working_imread(modes=IMREAD_MODES):
-    "Finds an image-reading mode that works; returns the name and a function."
+    '''
+    Finds an image-reading mode that works; returns the name and a function.
+    The answer is cached, so the imports are only tried once per process.
+    '''
     if isinstance(modes, str_types):
         modes = [modes]
+    key = tuple(modes)
+    if key not in _imread_cache:
+        _imread_cache[key] = _find_working_imread_uncached(modes)
+    return _imread_cache[key]
 
+
+def _find_working_imread_uncached(modes):
     for mode in modes:
         try:
             if mode.startswith('skimage-'):
@@ -82,6 +92,14 @@ def _find_working_imread(modes=IMREAD_MODES):
 def _load_features(filename, imread_mode=IMREAD_MODES, size=None, **kwargs):
     """
     Loads filename, optionally resizes it, and calls get_features.
+    """
+    img = _load_image(filename, imread_mode=imread_mode, size=size)
+    return get_features(img, **kwargs)
+
+
+def _load_image(filename, imread_mode=IMREAD_MODES, size=None):
+    """
+    Loads filename and optionally resizes it.
 
     size should be either None or a (width, height) tuple, where having one
     element be None means that the relevant entry is chosen so as to maintain
@@ -102,7 +120,7 @@ def _load_features(filename, imread_mode=IMREAD_MODES, size=None, **kwargs):
             newsize = size
         img = skimage.transform.resize(img, newsize)
 
-    return get_features(img, **kwargs)
+    return img
 
 
 def _load_extras(paths):
@@ -207,8 +225,70 @@ def find_paths(dirs, img_per_cla=None, sampler='first',
     return cats, paths
 
 
+DEFAULT_MAX_CHUNKSIZE = 16
+DEFAULT_IO_THREADS = 4
+
+def _iter_image_features(paths, imread_mode=IMREAD_MODES, parallel=False,
+                         chunksize=None, max_in_flight=None,
+                         io_threads=DEFAULT_IO_THREADS, size=None, **kwargs):
+    '''
+    Yields (frames, descrs) for each of paths, in order, with at most
+    max_in_flight chunks of chunksize images being worked on or waiting to be
+    consumed at once. See extract_image_features() for the arguments.
+
+    If io_threads, images are read and resized by that many threads in this
+    process, which feed the (CPU-bound) get_features() calls in the worker
+    processes; the decoded images waiting for a worker are bounded in the
+    same way. Otherwise, each worker reads its own images.
+    '''
+    from .mp_utils import imap_bounded, get_pool, DummyPool
+
+    # sort out parallelism options
+    pool = None
+    if hasattr(parallel, 'apply_async'):
+        the_pool = parallel
+    elif parallel is False:
+        the_pool = DummyPool()
+    else:
+        import multiprocessing as mp
+        the_pool = pool = mp.Pool(None if parallel is True else parallel)
+
+    if chunksize is None:
+        # big enough to amortize the overhead, small enough to load-balance
+        n_proc = getattr(the_pool, '_processes', 1)
+        chunksize = max(1, min(DEFAULT_MAX_CHUNKSIZE,
+                               len(paths) // (4 * n_proc)))
+
+    # find an imread mode now, so we don't have to try bad imports every time
+    imread_mode, _ = _find_working_imread(imread_mode)
+
+    try:
+        if io_threads:
+            load_image = partial(_load_image, imread_mode=imread_mode,
+                                 size=size)
+            with get_pool(io_threads, threads=True) as io_pool:
+                imgs = imap_bounded(io_pool, load_image, paths)
+                for res in imap_bounded(the_pool,
+                                        partial(get_features, **kwargs), imgs,
+                                        chunksize=chunksize,
+                                        max_in_flight=max_in_flight):
+                    yield res
+        else:
+            load_features = partial(_load_features, imread_mode=imread_mode,
+                                    size=size, **kwargs)
+            for res in imap_bounded(the_pool, load_features, paths,
+                                    chunksize=chunksize,
+                                    max_in_flight=max_in_flight):
+                yield res
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
 def extract_image_features(paths, cats, imread_mode=IMREAD_MODES,
-                           parallel=False, **kwargs):
+                           parallel=False, chunksize=None, max_in_flight=None,
+                           **kwargs):
     '''
     Extracts features from images in a list of data directories.
 
@@ -220,39 +300,34 @@ def extract_image_features(paths, cats, imread_mode=IMREAD_MODES,
              'random': a random sample of the images
     extensions: (case-insensitive) filename extensions to treat as images
     parallel: - if False (default), run serially
-              - if an object with a `map` method (e.g. multiprocessing.Pool),
-                run extractions through that
+              - if an object with an `apply_async` method (e.g.
+                multiprocessing.Pool), run extractions through that
               - if True, run in a pool with one process per CPU core
               - if an integer, run in a pool with that many processes
+    chunksize: the number of images to send to a worker at once. Default:
+               a quarter of each worker's share, up to 16.
+    max_in_flight: the number of chunks to have in progress at once.
+                   Default: twice the number of workers.
+    io_threads: the number of threads reading and resizing images for the
+                workers (default 4); 0 means the workers read their own.
 
     Other arguments are passed on to get_features().
 
-    Returns a Features tuple.
+    Returns a Features tuple. To write the features out as they're computed
+    instead of holding them all in memory, use save_image_features().
     '''
     extras = _load_extras(paths)
     image_names = [os.path.basename(path) for path in paths]
 
-    # sort out parallelism options
-    pool = None
-    if hasattr(parallel, 'map'):
-        do_map = parallel.map
-    elif parallel is False:
-        do_map = strict_map
-    else:
-        import multiprocessing as mp
-        pool = mp.Pool(None if parallel is True else parallel)
-        do_map = pool.map
-
-    # find an imread mode now, so we don't have to try bad imports every time
-    imread_mode, _ = _find_working_imread(imread_mode)
-
     # do the actual extraction, skipping any images we get no features from
     frames = []
     descrs = []
     n_skipped = 0
     keep = np.ones(len(paths), dtype=bool)
-    load_features = partial(_load_features, imread_mode=imread_mode, **kwargs)
-    for i, (frame, descr) in enumerate(do_map(load_features, paths)):
+    results = _iter_image_features(
+        paths, imread_mode=imread_mode, parallel=parallel,
+        chunksize=chunksize, max_in_flight=max_in_flight, **kwargs)
+    for i, (frame, descr) in enumerate(results):
         if frame.size == 0:
             n_skipped += 1
             keep[i] = False
@@ -267,13 +342,53 @@ def extract_image_features(paths, cats, imread_mode=IMREAD_MODES,
         image_names = np.asarray(image_names)[keep]
         extras = {name: vals[keep] for name, vals in extras.iteritems()}
 
-    if pool is not None:
-        pool.close()
-        pool.join()
     return Features(descrs, categories=cats, names=image_names,
                     frames=frames, **extras)
 
 
+def save_image_features(paths, cats, save_path, format='hdf5', resume=False,
+                        attrs={}, writer_args={}, **kwargs):
+    '''
+    Like extract_image_features(), but writes each image's features into
+    save_path as soon as they're ready (in order), so that only the chunks
+    currently in flight are ever in memory.
+
+    format is 'hdf5', 'perbag' or 'typedbytes'; see Features.open_writer().
+    If resume, any images already in save_path are skipped, so an interrupted
+    run can just be started again. attrs are saved along with the features;
+    writer_args are passed along to Features.open_writer().
+
+    Other arguments are as for extract_image_features().
+
+    Returns the number of images written.
+    '''
+    extras = _load_extras(paths)
+    cats = [str(cat) for cat in cats]
+    image_names = [os.path.basename(path) for path in paths]
+
+    with Features.open_writer(save_path, format=format, resume=resume,
+                              **dict(attrs, **writer_args)) as writer:
+        todo = [i for i, bag_name in enumerate(izip(cats, image_names))
+                if bag_name not in writer]
+        if len(todo) < len(paths):
+            print("Skipping {} images already in '{}'.".format(
+                len(paths) - len(todo), save_path))
+
+        n_skipped = 0
+        results = _iter_image_features([paths[i] for i in todo], **kwargs)
+        for i, (frame, descr) in izip(todo, results):
+            if frame.size == 0:
+                n_skipped += 1
+                continue
+            writer.write(cats[i], image_names[i], descr, frames=frame,
+                         **dict((k, v[i]) for k, v in extras.iteritems()))
+
+    if n_skipped:
+        msg = "Skipped {} images that got no features out.".format(n_skipped)
+        warnings.warn(msg)
+    return len(todo) - n_skipped
+
+
 ################################################################################
 ### Command line
 
@@ -308,6 +423,17 @@ def parse_args():
     parser.add_argument('--n-proc', default=None, dest='parallel',
         type=lambda x: False if x.strip() == '1' else positive_int(x),
         help="Number of processes to use; default is as many as CPU cores.")
+    parser.add_argument('--chunksize', type=positive_int, default=None,
+        help="Number of images to hand to a worker at a time; default "
+             "a quarter of each worker's share, up to {}.".format(
+                 DEFAULT_MAX_CHUNKSIZE))
+    parser.add_argument('--max-in-flight', type=positive_int, default=None,
+        help="Number of chunks to be working on at once, which bounds memory "
+             "use; default twice the number of processes.")
+    parser.add_argument('--io-threads', type=nonnegative_int,
+        default=DEFAULT_IO_THREADS,
+        help="Number of threads reading and resizing images for the "
+             "processes; 0 to have each process read its own." + _def)
 
     # options for finding and loading images
     files = parser.add_argument_group('File options')
@@ -367,13 +493,22 @@ def parse_args():
     # options for output files
     out = parser.add_argument_group('Ouptut options')
     out.add_argument('--output-format',
-        choices=['single-hdf5', 'perimage-npz'], default='single-hdf5',
+        choices=['single-hdf5', 'stacked-hdf5', 'perimage-npz', 'typedbytes'],
+        default='single-hdf5',
         help="Output format: single-hdf5 for a single hdf5 file (the default), "
-             "or perimage-npz for npz files for each image.")
+             "stacked-hdf5 for a single hdf5 file with all features stacked "
+             "into one dataset (faster for many images), "
+             "perimage-npz for npz files for each image, "
+             "or typedbytes for a directory of hadoop typedbytes shards. "
+             "All but stacked-hdf5 are written as the images are processed; "
+             "stacked-hdf5 holds everything in memory until the end.")
 
     out.add_argument('save_path',
-        help="The output file path if single-hdf5, "
+        help="The output file path if single-hdf5 or stacked-hdf5, "
               "or the base directory to put the per-image files.")
+    out.add_argument('--resume', action='store_true', default=False,
+        help="Keep whatever is already in save_path and skip those images, "
+             "to continue an interrupted run. Not for stacked-hdf5.")
 
     # options for feature extraction
     sift = parser.add_argument_group('SIFT options')
@@ -406,12 +541,16 @@ def parse_args():
     args = parser.parse_args()
     if not args.dirs and not args.paths_csv:
         parser.error("Must specify some images to load.")
+    if args.resume and args.output_format == 'stacked-hdf5':
+        parser.error("Can't --resume with stacked-hdf5 output.")
     return args
 
 
 def main():
     args = parse_args()
-    confirm_outfile(args.save_path, dir=args.output_format != 'single-hdf5')
+    if not args.resume:
+        confirm_outfile(args.save_path,
+                        dir=not args.output_format.endswith('hdf5'))
 
     if args.paths_csv:
         cats = []
@@ -428,16 +567,22 @@ def main():
                                  sampler=args.sampler)
 
     skip = set('paths_csv dirs extensions img_per_cla '
-               'sampler output_format save_path'.split())
+               'sampler output_format save_path resume'.split())
     kwargs = dict((k, v) for k, v in vars(args).iteritems() if k not in skip)
-    features = extract_image_features(paths, cats, **kwargs)
     # TODO: show a progressbar here
 
-    print("Saving results to '{}'".format(args.save_path))
-    if args.output_format == 'single-hdf5':
-        features.save_as_hdf5(args.save_path, args=repr(vars(args)))
+    if args.output_format == 'stacked-hdf5':
+        features = extract_image_features(paths, cats, **kwargs)
+        print("Saving results to '{}'".format(args.save_path))
+        features.save_as_hdf5(args.save_path, layout='stacked',
+                              args=repr(vars(args)))
     else:
-        features.save_as_perbag(args.save_path, args=repr(vars(args)))
+        print("Saving results to '{}'".format(args.save_path))
+        format = {'single-hdf5': 'hdf5', 'perimage-npz': 'perbag',
+                  'typedbytes': 'typedbytes'}[args.output_format]
+        save_image_features(paths, cats, args.save_path, format=format,
+                            resume=args.resume,
+                            attrs={'args': repr(vars(args))}, **kwargs)
 
 if __name__ == '__main__':
     main()
@@ -4,27 +4,249 @@ from collections import Counter, defaultdict
 from contextlib import closing
 from functools import partial
 from glob import glob
-import operator as op
+import json
+import multiprocessing as mp
 import os
 import cPickle as pickle
 import shutil
 import sys
+import zipfile
 
 import numpy as np
 
 from .utils import (imap, izip, iterkeys, iteritems, lazy_range, strict_zip,
-                    reduce, str_types, is_integer_type)
+                    strict_map, str_types, is_integer_type)
 
 _default_category = 'none'
 _do_nothing_sentinel = object()
 
 DEFAULT_VARFRAC = 0.7
+DEFAULT_LOAD_THREADS = 8
 
 def _group(boundaries, arr):
     return [arr[boundaries[i-1]:boundaries[i]]
             for i in lazy_range(1, len(boundaries))]
 
 
+def _runs(idx):
+    '''
+    Yields (start, end) such that idx[start:end] are consecutive integers,
+    covering all of idx.
+    '''
+    start = 0
+    for i in lazy_range(1, len(idx) + 1):
+        if i == len(idx) or idx[i] != idx[i-1] + 1:
+            yield start, i
+            start = i
+
+
+def _batches(n, batch_size, n_pts=None, max_points=None):
+    '''
+    Yields (start, end) for batches of at most batch_size of n items, each of
+    which (if max_points is passed) has at most max_points total n_pts, unless
+    a single item is bigger than that.
+    '''
+    start = 0
+    pts = 0
+    for i in lazy_range(n):
+        if i - start >= batch_size or (
+                max_points is not None and i > start and
+                pts + n_pts[i] > max_points):
+            yield start, i
+            start = i
+            pts = 0
+        if max_points is not None:
+            pts += n_pts[i]
+    if n > start:
+        yield start, n
+
+
+def _can_mmap(ds, dtype):
+    "Whether an h5py dataset can be memory-mapped as dtype."
+    return (ds.dtype == dtype and ds.chunks is None and
+            ds.compression is None and ds.id.get_offset() is not None)
+
+
+def _npz_features_header(npz_path):
+    '''
+    Gets the shape and dtype of the 'features' array in an npz file, reading
+    only its .npy header.
+    '''
+    from numpy.lib import format as npy_format
+
+    with closing(zipfile.ZipFile(npz_path)) as zf:
+        try:
+            f = zf.open('features.npy')
+        except KeyError:
+            raise ValueError("malformed file: {} has no features"
+                             .format(npz_path))
+        with closing(f):
+            version = npy_format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = npy_format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = npy_format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def _typedbytes_file_idx(fname):
+    "Gets the index from a path like .../data_350.tb."
+    base = os.path.basename(fname)
+    return int(base[len('data_'):-len('.tb')])
+
+
+def _read_typedbytes_file(cls, fname, **kwargs):
+    with open(fname, 'rb') as f:
+        return cls._read_typedbytes(f, **kwargs)
+
+
+def _stack_bags(bags):
+    '''
+    Stacks a list of bag arrays into a single array with one allocation,
+    dropping references to the bags as they're copied.
+
+    Returns the stacked array and the n_pts array.
+    '''
+    if not bags:
+        raise ValueError("must have at least one bag")
+
+    for i, bag in enumerate(bags):
+        if bag.ndim == 1:
+            bags[i] = bag[None, :]
+        elif bag.ndim != 2:
+            raise TypeError("each bag must be n_pts x dim")
+    n_pts = np.array([bag.shape[0] for bag in bags])
+    dims = set(bag.shape[1] for bag in bags)
+    if len(dims) != 1:
+        raise TypeError("bags' second dimension must be consistent")
+
+    boundaries = np.hstack([[0], np.cumsum(n_pts)])
+    stacked = np.empty((boundaries[-1], dims.pop()),
+                       dtype=np.result_type(*set(bag.dtype for bag in bags)))
+    for i in lazy_range(len(bags)):
+        stacked[boundaries[i]:boundaries[i+1]] = bags[i]
+        bags[i] = None
+    return stacked, n_pts
+
+
+DEFAULT_SHARD_BYTES = 500 * 2**20
+
+def _shard_bounds(sizes, shard_bytes=None, shard_bags=None, splits=None):
+    '''
+    Gets a list of (start, end) bag index ranges for shards of bags with the
+    given sizes; see Features.save_as_typedbytes.
+    '''
+    n = len(sizes)
+    if sum(x is not None for x in (shard_bytes, shard_bags, splits)) > 1:
+        raise ValueError("pass at most one of shard_bytes, shard_bags, splits")
+
+    if splits is not None:
+        starts = sorted(set(int(x) for x in splits) | set([0]))
+        if starts[-1] >= n or starts[0] < 0:
+            raise ValueError("splits should be between 0 and {}".format(n - 1))
+    elif shard_bags is not None:
+        if shard_bags < 1:
+            raise ValueError("shard_bags should be positive")
+        starts = list(lazy_range(0, n, shard_bags))
+    else:
+        if shard_bytes is None:
+            shard_bytes = DEFAULT_SHARD_BYTES
+        starts = [0]
+        amt = 0
+        for i, size in enumerate(sizes):
+            if amt >= shard_bytes:
+                starts.append(i)
+                amt = 0
+            amt += size
+    return strict_zip(starts, starts[1:] + [n])
+
+
+def _typedbytes_tell(out):
+    '''
+    The offset in the file of the typedbytes Output out where the next record
+    will start. Flushes out first, in case it buffers writes itself.
+    '''
+    flush = getattr(out, 'flush', None)
+    if flush is not None:
+        flush()
+    return out.file.tell()
+
+
+def _write_typedbytes_shard(feats, path, bounds):
+    "Writes one shard for Features.save_as_typedbytes; feats is ForkedData."
+    from . import typedbytes_utils as tbu
+
+    start, end = bounds
+    fname = 'data_{}.tb'.format(start)
+    out = tbu.tb.PairedOutput(open(os.path.join(path, fname), 'wb'))
+    tbu.register_write(out)
+
+    data = feats.value.data[start:end]
+    offsets = np.empty(len(data) + 1, dtype=np.int64)
+    skip_set = frozenset(['category', 'name'])
+    try:
+        for i, bag in enumerate(data):
+            offsets[i] = _typedbytes_tell(out)
+            out.write((
+                "{}/{}".format(bag['category'], bag['name']),
+                dict((k, v) for k, v in izip(bag.dtype.names, bag)
+                     if k not in skip_set)
+            ))
+        offsets[-1] = _typedbytes_tell(out)
+    finally:
+        out.close()
+
+    _write_typedbytes_index(
+        os.path.join(path, fname), data['category'], data['name'], offsets,
+        [bag.shape for bag in data['features']],
+        [bag.dtype for bag in data['features']])
+    return fname
+
+
+def _typedbytes_index_path(fname):
+    "data_350.tb => data_350.idx.npz"
+    return fname[:-len('.tb')] + '.idx.npz'
+
+
+def _write_typedbytes_index(fname, categories, names, offsets, shapes, dtypes):
+    '''
+    Saves the offset index for the typedbytes shard fname: the categories and
+    names of its bags, the offsets their records start at (plus the end of the
+    last one), and the shapes and dtypes of their features.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    shapes = np.array([(1,) + tuple(shape) if len(shape) == 1 else shape
+                       for shape in shapes], dtype=np.int64).reshape(-1, 2)
+    np.savez(_typedbytes_index_path(fname),
+             categories=categories, names=names,
+             offsets=offsets[:-1], lengths=np.diff(offsets),
+             n_pts=shapes[:, 0], dims=shapes[:, 1],
+             dtypes=np.array([np.dtype(dt).str for dt in dtypes], dtype='S'))
+
+
+def _read_typedbytes_index(fname):
+    '''
+    Loads the offset index written alongside a typedbytes shard by
+    save_as_typedbytes(): returns arrays of categories, names, offsets,
+    numbers of points, dimensions, and dtypes, or None if there's no index.
+    '''
+    try:
+        index = np.load(_typedbytes_index_path(fname))
+    except IOError:
+        return None
+    with closing(index):
+        try:
+            return tuple(index[k] for k in ['categories', 'names', 'offsets',
+                                            'n_pts', 'dims', 'dtypes'])
+        except KeyError:  # an older index, without the shapes
+            return None
+
+
+def _to_bytes(a):
+    a = np.asarray(a)
+    return np.char.encode(a, 'utf-8') if a.dtype.kind == 'U' else a
+
+
 class Features(object):
     '''
     A wrapper class for storing bags of features. (A *bag* is a set of feature
@@ -72,7 +294,7 @@ class Features(object):
 
         # load the features
         if n_pts is not None:
-            n_pts = np.squeeze(n_pts)
+            n_pts = np.atleast_1d(np.squeeze(n_pts))
             if n_pts.ndim != 1:
                 raise TypeError("n_pts must be 1-dimensional")
             if n_pts.size == 0:
@@ -724,6 +946,35 @@ class Features(object):
         else:
             raise TypeError("unknown save format '{}'".format(format))
 
+    @staticmethod
+    def open_writer(path, format='hdf5', resume=False, **kwargs):
+        '''
+        Opens a writer that adds bags to a features file one at a time,
+        without having them all in memory:
+
+            with Features.open_writer(path, 'perbag', resume=True) as writer:
+                for cat, name, bag, frames in ...:
+                    if (cat, name) not in writer:
+                        writer.write(cat, name, bag, frames=frames)
+
+        format is 'hdf5' (using the 'groups' layout), 'perbag', or
+        'typedbytes'; the result can be read with Features.load() as usual.
+        If resume, keeps any bags already in path, so that an interrupted job
+        can pick up where it left off; otherwise path is overwritten.
+
+        Other keyword arguments are saved as attributes, except for
+        file_root (for 'hdf5') and shard_bags (for 'typedbytes', the number
+        of bags per shard; default 1000).
+        '''
+        if format == 'hdf5':
+            return _HDF5BagWriter(path, resume=resume, **kwargs)
+        elif format == 'perbag':
+            return _PerbagWriter(path, resume=resume, **kwargs)
+        elif format == 'typedbytes':
+            return _TypedbytesBagWriter(path, resume=resume, **kwargs)
+        else:
+            raise TypeError("unknown save format '{}'".format(format))
+
     @classmethod
     def load(cls, path, **kwargs):
         '''
@@ -734,7 +985,8 @@ class Features(object):
             otherwise calls load_from_perbag
         otherwise, calls load_from_hdf5.
 
-        See any of those functions for documentation of the arguments.
+        See any of those functions for documentation of the arguments; e.g.
+        pass mmap=True to memory-map a 'stacked' hdf5 file.
         '''
         if os.path.isdir(path):
             if glob(os.path.join(path, 'data_*.tb')):
@@ -747,7 +999,8 @@ class Features(object):
     ############################################################################
     ### Stuff relating to hdf5 feature files
 
-    def save_as_hdf5(self, filename, file_root=None, append=False, **attrs):
+    def save_as_hdf5(self, filename, file_root=None, append=False,
+                     layout='groups', stacked_opts=None, **attrs):
         '''
         Saves into an HDF5 file filename,
         rooted at file_root (default: root of the file).
@@ -759,31 +1012,78 @@ class Features(object):
 
         Also saves any keyword args as a dateset under '/_meta'.
 
-        Each bag is saved as "features" and "frames" in /category/filename; any
-        "extras" get added there as a (probably scalar) dataset named by the
-        extra's name.
+        layout is one of:
+            'groups' (default): each bag is saved as "features" and "frames"
+                in /category/filename; any "extras" get added there as a
+                (probably scalar) dataset named by the extra's name.
+
+            'stacked': everything is saved in the /_stacked group, with
+                "features" a single (total_points x dim) dataset, "n_pts" the
+                number of points in each bag, "categories" and "names" string
+                datasets, and one dataset per extra in "extras". Extras that
+                aren't scalars are pickled. This is much faster to read and
+                write for many bags.
+
+                stacked_opts is a dict of extra arguments for creating the
+                features dataset, e.g. {'compression': 'gzip'} or
+                {'chunks': (10000, dim)}. By default it's stored contiguous
+                and uncompressed, so that load_from_hdf5(mmap=True) can
+                memory-map it.
         '''
         import h5py
         with h5py.File(filename, 'a' if append else 'w') as f:
             if file_root is not None:
                 f = f.require_group(file_root)
 
-            skip_set = frozenset(['category', 'name'])
-            for row in self:
-                g = f.require_group(row['category']).create_group(row['name'])
-                for name, val in izip(row.dtype.names, row):
-                    if name not in skip_set:
-                        g[name] = val
+            if layout == 'groups':
+                skip_set = frozenset(['category', 'name'])
+                for row in self:
+                    g = f.require_group(row['category']) \
+                         .create_group(row['name'])
+                    for name, val in izip(row.dtype.names, row):
+                        if name not in skip_set:
+                            g[name] = val
+            elif layout == 'stacked':
+                self._save_hdf5_stacked(f.create_group('_stacked'),
+                                        **(stacked_opts or {}))
+            else:
+                raise ValueError("unknown layout '{}'".format(layout))
 
             meta = f.require_group('_meta')
             for k, v in iteritems(attrs):
                 meta[k] = v
 
+    def _save_hdf5_stacked(self, g, **features_opts):
+        import h5py
+
+        g.create_dataset('features', data=self._features, **features_opts)
+        g['n_pts'] = self._n_pts
+        g['categories'] = _to_bytes(self.categories)
+        g['names'] = _to_bytes(self.names)
+
+        extras = g.create_group('extras')
+        for name in self._extra_names:
+            vals = self.data[name]
+            if vals.dtype.kind == 'O':
+                dt = h5py.special_dtype(vlen=np.dtype(np.uint8))
+                pickled = np.empty(len(vals), dtype=object)
+                for i, val in enumerate(vals):
+                    pickled[i] = np.frombuffer(
+                        pickle.dumps(val, pickle.HIGHEST_PROTOCOL),
+                        dtype=np.uint8)
+                ds = extras.create_dataset(name, (len(vals),), dtype=dt)
+                ds[...] = pickled
+                ds.attrs['pickled'] = True
+            elif vals.dtype.kind == 'U':
+                extras[name] = _to_bytes(vals)
+            else:
+                extras[name] = vals
+
     @classmethod
     def load_from_hdf5(cls, filename, file_root=None,
                        load_attrs=False, features_dtype=None,
                        cats=None, pairs=None, subsample_fn=None,
-                       names_only=False):
+                       names_only=False, mmap=False):
         '''
         Reads a Features instance from an h5py file created by save_features().
 
@@ -809,6 +1109,49 @@ class Features(object):
 
         If names_only is passed, the list of (category, name) pairs is returned
         without having loaded any data. load_attrs is also ignored.
+
+        Handles both the 'groups' and 'stacked' layouts of save_as_hdf5().
+
+        If mmap is passed and the file has the 'stacked' layout with a
+        contiguous, uncompressed features dataset, the features are a
+        copy-on-write np.memmap into the file rather than being read into
+        memory, as long as the loaded bags are consecutive in the file (e.g.
+        when loading all of them) and features_dtype is None or matches.
+        Otherwise, mmap is ignored. Don't overwrite the file while the object
+        is still alive.
+        '''
+        import h5py
+
+        with h5py.File(filename, 'r') as f:
+            if file_root is not None:
+                f = f[file_root]
+
+            bag_names, idx = cls._hdf5_select(
+                f, cats=cats, pairs=pairs, subsample_fn=subsample_fn)
+
+            if names_only:
+                return bag_names
+
+            obj = cls._load_hdf5_batch(f, bag_names, idx,
+                                       features_dtype=features_dtype,
+                                       mmap=mmap)
+
+            if load_attrs:
+                return obj, cls._hdf5_attrs(f)
+            return obj
+
+    @classmethod
+    def iter_from_hdf5(cls, filename, file_root=None, batch_size=1000,
+                       max_points=None, features_dtype=None,
+                       cats=None, pairs=None, subsample_fn=None, mmap=False):
+        '''
+        Like load_from_hdf5(), but yields a sequence of Features instances
+        with at most batch_size bags each, so that the whole file never needs
+        to be in memory at once. If max_points is passed, batches are also
+        limited to at most that many points (unless a single bag is bigger).
+
+        The arguments are as in load_from_hdf5(). Note that with the 'groups'
+        layout, the types of extras are determined per batch.
         '''
         import h5py
 
@@ -816,115 +1159,242 @@ class Features(object):
             if file_root is not None:
                 f = f[file_root]
 
+            bag_names, idx = cls._hdf5_select(
+                f, cats=cats, pairs=pairs, subsample_fn=subsample_fn)
+
+            # read the stacked bag sizes once, rather than once per batch
+            if idx is None:
+                all_bounds = None
+            else:
+                all_bounds = np.hstack(
+                    [[0], np.cumsum(f['_stacked']['n_pts'][()])])
+
+            if max_points is None:
+                n_pts = None
+            elif idx is None:
+                n_pts = [f[cat][fname]['features'].shape[0]
+                         for cat, fname in bag_names]
+            else:
+                n_pts = all_bounds[idx + 1] - all_bounds[idx]
+
+            for start, end in _batches(len(bag_names), batch_size,
+                                       n_pts=n_pts, max_points=max_points):
+                yield cls._load_hdf5_batch(
+                    f, bag_names[start:end],
+                    None if idx is None else idx[start:end],
+                    features_dtype=features_dtype, mmap=mmap,
+                    all_bounds=all_bounds)
+
+    @staticmethod
+    def _hdf5_select(f, cats=None, pairs=None, subsample_fn=None):
+        '''
+        Finds the (category, name) pairs to load from an hdf5 group.
+
+        Returns the list of pairs and, for the 'stacked' layout, an array of
+        their indices into the stacked datasets (None for 'groups').
+        '''
+        if '_stacked' in f:
+            g = f['_stacked']
+            all_names = strict_zip(g['categories'][()], g['names'][()])
             bag_names = []
-            for cat, cat_g in iteritems(f):
-                if cat != '_meta' and (cats is None or cat in cats):
-                    for fname in iterkeys(cat_g):
-                        if pairs is None or (cat, fname) in pairs:
-                            bag_names.append((cat, fname))
+            idx = []
+            for i, (cat, fname) in enumerate(all_names):
+                if ((cats is None or cat in cats) and
+                        (pairs is None or (cat, fname) in pairs)):
+                    bag_names.append((cat, fname))
+                    idx.append(i)
 
             if subsample_fn is not None:
+                idx_map = dict(izip(bag_names, idx))
                 bag_names = subsample_fn(bag_names)
+                idx = [idx_map[bag_name] for bag_name in bag_names]
+            return bag_names, np.asarray(idx, dtype=int)
 
-            if names_only:
-                return bag_names
+        bag_names = []
+        for cat, cat_g in iteritems(f):
+            if cat != '_meta' and (cats is None or cat in cats):
+                for fname in iterkeys(cat_g):
+                    if pairs is None or (cat, fname) in pairs:
+                        bag_names.append((cat, fname))
 
-            # first pass: get numbers/type of features, names/types of metadata
-            dim = None
-            n_pts = []
-            dtypes = set()
-            extra_types = {}
-            with_extras = Counter()
+        if subsample_fn is not None:
+            bag_names = subsample_fn(bag_names)
+        return bag_names, None
 
-            for cat, fname in bag_names:
-                g = f[cat][fname]
+    @staticmethod
+    def _hdf5_attrs(f):
+        attrs = {}
+        if '_meta' in f:
+            for k, v in iteritems(f['_meta']):
+                attrs[k] = v[()]
+            for k, v in iteritems(f['_meta'].attrs):
+                if k not in attrs:
+                    attrs[k] = v
+        for k, v in iteritems(f.attrs):
+            if k not in attrs:
+                attrs[k] = v
+        return attrs
 
-                feats = g['features']
-                shape = feats.shape
-                if len(shape) != 2:
-                    msg = "malformed file: {}/{}/features has shape {}"
-                    raise ValueError(msg.format(cat, fname, shape))
-                elif shape[0] == 0:
-                    msg = "malformed file: {}/{} has no features"
-                    raise ValueError(msg.format(cat, fname))
+    @classmethod
+    def _load_hdf5_batch(cls, f, bag_names, idx, features_dtype=None,
+                         mmap=False, all_bounds=None):
+        if not bag_names:
+            raise ValueError("no bags to load")
+        if idx is None:
+            return cls._load_hdf5_groups(f, bag_names,
+                                         features_dtype=features_dtype)
+        else:
+            return cls._load_hdf5_stacked(f['_stacked'], bag_names, idx,
+                                          features_dtype=features_dtype,
+                                          mmap=mmap, all_bounds=all_bounds)
 
-                if dim is None:
-                    dim = shape[1]
-                elif shape[1] != dim:
-                    msg = "malformed file: {}/{} has feature dim {}, expected {}"
-                    raise ValueError(msg.format(cat, fname, shape[1], dim))
-
-                n_pts.append(feats.shape[0])
-                dtypes.add(feats.dtype)
-
-                for name, val in iteritems(g):
-                    if name == 'features':
-                        continue
-
-                    dt = val.dtype if all(s == 1 for s in val.shape) else object
-                    if name not in extra_types:
-                        extra_types[name] = dt
-                    elif extra_types[name] != dt:
-                        msg = "different {}s have different dtypes"
-                        raise TypeError(msg.format(name))
-                        # TODO: find a dtype that'll cover all of them
-                    with_extras[name] += 1
-
-            n_bags = len(bag_names)
-            n_pts = np.asarray(n_pts)
-            boundaries = np.hstack([[0], np.cumsum(n_pts)])
+    @classmethod
+    def _load_hdf5_stacked(cls, g, bag_names, idx, features_dtype=None,
+                           mmap=False, all_bounds=None):
+        '''
+        Loads the bags at idx from a 'stacked' group. all_bounds, the bag
+        boundaries of the whole stacked features dataset, is read from
+        _stacked/n_pts if not passed.
+        '''
+        feats_ds = g['features']
+        if len(feats_ds.shape) != 2:
+            msg = "malformed file: _stacked/features has shape {}"
+            raise ValueError(msg.format(feats_ds.shape))
+
+        if all_bounds is None:
+            all_bounds = np.hstack([[0], np.cumsum(g['n_pts'][()])])
+        n_pts = all_bounds[idx + 1] - all_bounds[idx]
+        boundaries = np.hstack([[0], np.cumsum(n_pts)])
+
+        dtype = feats_ds.dtype if features_dtype is None else features_dtype
+        runs = list(_runs(idx))
+
+        if mmap and len(runs) == 1 and _can_mmap(feats_ds, dtype):
+            start = all_bounds[idx[0]]
+            features = np.memmap(
+                g.file.filename, mode='c', dtype=feats_ds.dtype,
+                offset=feats_ds.id.get_offset(), shape=feats_ds.shape
+            )[start:start + boundaries[-1]]
+            feat_runs = []
+        else:
+            features = np.empty((boundaries[-1], feats_ds.shape[1]),
+                                dtype=dtype)
+            feat_runs = runs
+
+        # read runs of consecutive bags at once
+        for start, end in feat_runs:
+            out_start = boundaries[start]
+            out_end = boundaries[end]
+            in_start = all_bounds[idx[start]]
+            feats_ds.read_direct(
+                features,
+                source_sel=np.s_[in_start:in_start + out_end - out_start],
+                dest_sel=np.s_[out_start:out_end])
+
+        # and the same runs of the extras
+        extras = {}
+        for name, ds in iteritems(g['extras']):
+            pickled = ds.attrs.get('pickled', False)
+            if pickled:
+                vals = np.empty(len(idx), dtype=object)
+            else:
+                vals = np.empty((len(idx),) + ds.shape[1:], dtype=ds.dtype)
+            for start, end in runs:
+                chunk = ds[idx[start]:idx[start] + end - start]
+                if pickled:
+                    for i, val in enumerate(chunk):
+                        vals[start + i] = pickle.loads(val.tostring())
+                else:
+                    vals[start:end] = chunk
+            extras[name] = vals
 
-            # allocate space for features and extras
-            # TODO: go straight into a data array, save a copy...
-            if features_dtype is None:
-                dtype = dtypes.pop()
-                if dtypes:
-                    raise TypeError("different features have different dtypes")
+        categories, names = zip(*bag_names)
+        return cls(features, n_pts=n_pts, categories=categories, names=names,
+                   **extras)
+
+    @classmethod
+    def _load_hdf5_groups(cls, f, bag_names, features_dtype=None):
+        # first pass: get numbers/type of features, names/types of metadata
+        dim = None
+        n_pts = []
+        dtypes = set()
+        extra_types = {}
+        with_extras = Counter()
+
+        for cat, fname in bag_names:
+            g = f[cat][fname]
+
+            feats = g['features']
+            shape = feats.shape
+            if len(shape) != 2:
+                msg = "malformed file: {}/{}/features has shape {}"
+                raise ValueError(msg.format(cat, fname, shape))
+            elif shape[0] == 0:
+                msg = "malformed file: {}/{} has no features"
+                raise ValueError(msg.format(cat, fname))
+
+            if dim is None:
+                dim = shape[1]
+            elif shape[1] != dim:
+                msg = "malformed file: {}/{} has feature dim {}, expected {}"
+                raise ValueError(msg.format(cat, fname, shape[1], dim))
+
+            n_pts.append(feats.shape[0])
+            dtypes.add(feats.dtype)
+
+            for name, val in iteritems(g):
+                if name == 'features':
+                    continue
+
+                dt = val.dtype if all(s == 1 for s in val.shape) else object
+                if name not in extra_types:
+                    extra_types[name] = dt
+                elif extra_types[name] != dt:
+                    msg = "different {}s have different dtypes"
+                    raise TypeError(msg.format(name))
                     # TODO: find a dtype that'll cover all of them
-            else:
-                dtype = features_dtype
-            features = np.empty((n_pts.sum(), dim), dtype=dtype)
-
-            extras = {}
-            extra_defaults = {}
-            for name, dt in iteritems(extra_types):
-                if with_extras[name] != n_bags:
-                    dt, d = cls._missing_extras(dt)
-                    extra_defaults[name] = d
-                    print("WARNING: {} missing values for {}. using {} instead"
-                            .format(n_bags - with_extras[name], name, d),
-                          file=sys.stderr)
-                extras[name] = np.empty(n_bags, dtype=dt)
-
-            # actually load all the features and extras
-            for i, (cat, fname) in enumerate(bag_names):
-                g = f[cat][fname]
-                features[boundaries[i]:boundaries[i+1]] = g['features']
-
-                for ex_name in extra_types:
-                    if ex_name in g:
-                        extras[ex_name][i] = g[ex_name][()]
-                    else:
-                        extras[ex_name][i] = extra_defaults[ex_name]
-
-            categories, names = zip(*bag_names)
-            obj = cls(features, n_pts=n_pts, categories=categories, names=names,
-                      **extras)
+                with_extras[name] += 1
+
+        n_bags = len(bag_names)
+        n_pts = np.asarray(n_pts)
+        boundaries = np.hstack([[0], np.cumsum(n_pts)])
+
+        # allocate space for features and extras
+        # TODO: go straight into a data array, save a copy...
+        if features_dtype is None:
+            dtype = dtypes.pop()
+            if dtypes:
+                raise TypeError("different features have different dtypes")
+                # TODO: find a dtype that'll cover all of them
+        else:
+            dtype = features_dtype
+        features = np.empty((n_pts.sum(), dim), dtype=dtype)
 
-            if load_attrs:
-                attrs = {}
-                if '_meta' in f:
-                    for k, v in iteritems(f['_meta']):
-                        attrs[k] = v[()]
-                    for k, v in iteritems(f['_meta'].attrs):
-                        if k not in attrs:
-                            attrs[k] = v
-                for k, v in iteritems(f.attrs):
-                    if k not in attrs:
-                        attrs[k] = v
-                return obj, attrs
+        extras = {}
+        extra_defaults = {}
+        for name, dt in iteritems(extra_types):
+            if with_extras[name] != n_bags:
+                dt, d = cls._missing_extras(dt)
+                extra_defaults[name] = d
+                print("WARNING: {} missing values for {}. using {} instead"
+                        .format(n_bags - with_extras[name], name, d),
+                      file=sys.stderr)
+            extras[name] = np.empty(n_bags, dtype=dt)
+
+        # actually load all the features and extras
+        for i, (cat, fname) in enumerate(bag_names):
+            g = f[cat][fname]
+            features[boundaries[i]:boundaries[i+1]] = g['features']
+
+            for ex_name in extra_types:
+                if ex_name in g:
+                    extras[ex_name][i] = g[ex_name][()]
+                else:
+                    extras[ex_name][i] = extra_defaults[ex_name]
 
-            return obj
+        categories, names = zip(*bag_names)
+        return cls(features, n_pts=n_pts, categories=categories, names=names,
+                   **extras)
 
     ############################################################################
     ### Stuff relating to per-bag npz feature files
@@ -956,7 +1426,7 @@ class Features(object):
     @classmethod
     def load_from_perbag(cls, path, load_attrs=False, features_dtype=None,
                          cats=None, pairs=None, subsample_fn=None,
-                         names_only=False):
+                         names_only=False, n_threads=DEFAULT_LOAD_THREADS):
         '''
         Reads a Features instance from a directory of npz files created
         by save_as_perbag().
@@ -978,8 +1448,13 @@ class Features(object):
 
         If names_only is passed, the list of (category, name) pairs is returned
         without having loaded any data. load_attrs is also ignored.
+
+        Files are read by a pool of n_threads threads (default 8), which helps
+        a lot on high-latency filesystems. The features are read directly
+        into a single stacked array, whose size is found first from the .npy
+        headers in the npz files.
         '''
-        from glob import glob
+        from .mp_utils import get_pool
 
         bag_names = []
         for cat in os.listdir(path):
@@ -996,38 +1471,63 @@ class Features(object):
         if names_only:
             return bag_names
 
-        # Unlike in read_from_hdf5, we can't just get the size of arrays without
-        # loading them in. So we do the vstacking thing.
+        if not bag_names:
+            raise ValueError("no bags to load")
+        npz_paths = [os.path.join(path, cat, fname + '.npz')
+                     for cat, fname in bag_names]
 
-        bags = []
-        extras = []  # a list of dictionaries. will replace with a dict of
-                     # arrays after we load them all in.
+        with get_pool(n_threads, threads=True) as pool:
+            # first pass: get shapes and types of features from the headers
+            n_pts = []
+            dim = None
+            dtypes = set()
+            for npz_path, (shape, dtype) in izip(
+                    npz_paths, pool.imap(_npz_features_header, npz_paths)):
+                if len(shape) == 1:
+                    shape = (1,) + shape
+                if len(shape) != 2:
+                    msg = "malformed file: {} has features of shape {}"
+                    raise ValueError(msg.format(npz_path, shape))
+                elif shape[0] == 0:
+                    msg = "malformed file: {} has no features"
+                    raise ValueError(msg.format(npz_path))
 
-        for cat, fname in bag_names:
-            npz_path = os.path.join(path, cat, fname + '.npz')
-            with closing(np.load(npz_path)) as data:
-                feats = None
+                if dim is None:
+                    dim = shape[1]
+                elif shape[1] != dim:
+                    msg = "malformed file: {} has feature dim {}, expected {}"
+                    raise ValueError(msg.format(npz_path, shape[1], dim))
+                n_pts.append(shape[0])
+                dtypes.add(dtype)
+
+            n_pts = np.asarray(n_pts)
+            boundaries = np.hstack([[0], np.cumsum(n_pts)])
+            if features_dtype is None:
+                features_dtype = np.result_type(*dtypes)
+            features = np.empty((boundaries[-1], dim), dtype=features_dtype)
+
+            # second pass: read the features straight into place
+            def load_bag(i):
                 extra = {}
-                for k, v in iteritems(data):
-                    if k == 'features':
-                        if features_dtype is not None:
-                            feats = np.asarray(v, dtype=features_dtype)
+                with closing(np.load(npz_paths[i])) as data:
+                    for k, v in iteritems(data):
+                        if k == 'features':
+                            features[boundaries[i]:boundaries[i+1]] = v
                         else:
-                            feats = v[()]
-                    else:
-                        extra[k] = v[()]
-                bags.append(feats)
-                extras.append(extra)
+                            extra[k] = v[()]
+                return extra
+            extras = pool.map(load_bag, lazy_range(len(bag_names)))
 
         categories, names = zip(*bag_names)
-        obj = cls._postprocess(categories, names, bags, extras)
+        obj = cls._postprocess(categories, names, features, extras,
+                               n_pts=n_pts)
 
         return cls._maybe_load_attrs(obj, path, load_attrs=load_attrs)
 
     @classmethod
-    def _postprocess(cls, categories, names, bags, extras):
+    def _postprocess(cls, categories, names, bags, extras, n_pts=None):
         # post-process the extras
-        n_bags = len(bags)
+        n_bags = len(extras)
         extra_types = defaultdict(Counter)
         the_extras = {}
         extra_defaults = {}
@@ -1058,7 +1558,8 @@ class Features(object):
             for name, default in iteritems(extra_defaults):
                 the_extras[name][i] = extra_d.get(name, default)
 
-        return cls(bags, categories=categories, names=names, **the_extras)
+        return cls(bags, n_pts=n_pts, categories=categories, names=names,
+                   **the_extras)
 
     @classmethod
     def _maybe_load_attrs(cls, obj, path, load_attrs):
@@ -1075,13 +1576,23 @@ class Features(object):
     ############################################################################
     ### Stuff relating to typedbytes feature file
 
-    def save_as_typedbytes(self, path, **attrs):
+    def save_as_typedbytes(self, path, shard_bytes=None, shard_bags=None,
+                           splits=None, n_proc=None, **attrs):
         '''
         Save into a directory of Hadoop typedbytes file.
 
-        They're split to have about 500MB of data each, named like "data_0.tb",
-        "data_350.tb", etc, where the number is the first index contained.
-            TODO: allow customizing this, giving explicit splits, ...
+        They're split into shards named like "data_0.tb", "data_350.tb", etc,
+        where the number is the first index contained. At most one of these
+        determines the split:
+            shard_bytes: start a new shard once a shard has about this many
+                         bytes of data (the default, with 500MB).
+            shard_bags: put this many bags in each shard.
+            splits: an explicit list of indices at which to start new shards.
+
+        The shards are written in parallel by n_proc processes (default: one
+        per shard, up to the number of cores). A "manifest.json" file lists
+        each shard's filename along with the range [start, end) of bag indices
+        it contains.
 
         The keys in the files are "name/category".
         Each value is a mapping, with elements:
@@ -1097,7 +1608,11 @@ class Features(object):
 
         Requires the "ctypedbytes" or "typedbytes" library (in pip).
         '''
-        from . import typedbytes_utils as tbu
+        from .mp_utils import ForkedData, get_pool
+
+        shards = _shard_bounds(self._typedbytes_sizes(), shard_bytes=shard_bytes,
+                               shard_bags=shard_bags, splits=splits)
+
         if os.path.exists(path):
             shutil.rmtree(path)
         os.makedirs(path)
@@ -1105,29 +1620,30 @@ class Features(object):
         with open(os.path.join(path, 'attrs.pkl'), 'wb') as f:
             pickle.dump(attrs, f)
 
-        def output_file(idx):
-            f = open(os.path.join(path, 'data_{}.tb'.format(idx)), 'wb')
-            out = tbu.tb.PairedOutput(f)
-            tbu.register_write(out)
-            return out
-
-        amt_per_file = 500 * 2**20
-        skip_set = frozenset(['category', 'name'])
-
-        out = output_file(0)
-        try:
-            for idx, bag in enumerate(self):
-                if out.file.tell() >= amt_per_file:
-                    out.close()
-                    out = output_file(idx)
-
-                out.write((
-                    "{}/{}".format(bag['category'], bag['name']),
-                    dict((k, v) for k, v in izip(bag.dtype.names, bag)
-                         if k not in skip_set)
-                ))
-        finally:
-            out.close()
+        if n_proc is None:
+            n_proc = min(len(shards), mp.cpu_count())
+        write = partial(_write_typedbytes_shard, ForkedData(self), path)
+        with get_pool(n_proc) as pool:
+            fnames = pool.map(write, shards)
+
+        manifest = {
+            'n_bags': len(self),
+            'shards': [{'file': fname, 'start': start, 'end': end}
+                       for fname, (start, end) in izip(fnames, shards)],
+        }
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    def _typedbytes_sizes(self):
+        "Approximate sizes of each bag when written by save_as_typedbytes()."
+        sizes = self._n_pts * self.dim * self.dtype.itemsize + 128
+        for name in self._extra_names:
+            vals = self.data[name]
+            if vals.dtype.kind == 'O':
+                sizes += [np.asarray(v).nbytes + 128 for v in vals]
+            else:
+                sizes += vals.dtype.itemsize + 16
+        return sizes
 
     @classmethod
     def _proc_from_typedbytes(cls, val, features_dtype=None):
@@ -1135,7 +1651,11 @@ class Features(object):
         return bag, dict((k, np.asarray(v)) for k, v in iteritems(val))
 
     @classmethod
-    def _load_typedbytes(cls, f, features_dtype=None, cats=None, pairs=None):
+    def _read_typedbytes(cls, f, features_dtype=None, cats=None, pairs=None):
+        '''
+        Reads the bags from a single typedbytes file object. Returns lists of
+        categories, names, bag arrays, and extras dicts.
+        '''
         from . import typedbytes_utils as tbu
 
         inp = tbu.tb.Input(f)
@@ -1147,6 +1667,17 @@ class Features(object):
         bags = []
         extras = []
 
+        def load(key):
+            cat, name = key.split('/', 1)
+            val = inp.read()
+            bag, extra = cls._proc_from_typedbytes(
+                    val, features_dtype=features_dtype)
+
+            categories.append(cat)
+            names.append(name)
+            bags.append(bag)
+            extras.append(extra)
+
         while True:
             key = inp.read()
             if key is None:
@@ -1155,31 +1686,19 @@ class Features(object):
             cat, name = key.split('/', 1)
             if ((cats is not None and cat not in cats) or
                     (pairs is not None and (cat, name) not in pairs)):
-                # skipping this one
-                type_byte = f.read(1)
-                val_length, = inp.read_int()
-
-                if f._file_seekable:
-                    f.seek(val_length, os.SEEK_CUR)
-                else:
-                    f.read(val_length)
+                # skipping this one: the value is a map, whose length prefix
+                # counts entries rather than bytes, so we can't just seek
+                # past it. Big features arrays are mmapped rather than read.
+                inp.read()
             else:
-                # loading this one
-                val = inp.read()
-                bag, extra = cls._proc_from_typedbytes(
-                        val, features_dtype=features_dtype)
-
-                categories.append(cat)
-                names.append(name)
-                bags.append(bag)
-                extras.append(extra)
+                load(key)
 
-        return cls._postprocess(categories, names, bags, extras)
+        return categories, names, bags, extras
 
     @classmethod
     def load_from_typedbytes(cls, path, load_attrs=False, features_dtype=None,
                              cats=None, pairs=None, subsample_fn=None,
-                             names_only=False):
+                             names_only=False, n_threads=DEFAULT_LOAD_THREADS):
         '''
         Reads a Features instance from a directory of typedbytes files created
         by save_as_typedbytes().
@@ -1202,19 +1721,54 @@ class Features(object):
         If names_only is passed, the list of (category, name) pairs is returned
         instead of any data. load_attrs is also ignored.
 
-        Note that for this type (as opposed to HDF5/perbag), we have to actually
-        walk over all the data to get the categories and names for names_only or
-        a subsample_fn. To not double the I/O, we just load it all. If you're
-        trying to save on memory, you could modify this method to do so....
+        If every file has an offset index (data_*.idx.npz, as written by
+        save_as_typedbytes()), names_only, subsample_fn, cats and pairs are
+        handled with the index, and only the selected records are read. The
+        index also gives the shapes of the features, so they're read directly
+        into a single stacked array.
+        Otherwise, we have to actually walk over all the data to get the
+        categories and names for names_only or a subsample_fn; to not double
+        the I/O, we just load it all in that case, and then stack it.
+
+        The files are read by a pool of up to n_threads threads (default 8),
+        one file per thread at a time.
         '''
+        from .mp_utils import get_pool
+
+        # load everything, in the order they were saved
+        fnames = sorted(glob(os.path.join(path, 'data_*.tb')),
+                        key=_typedbytes_file_idx)
+        if not fnames:
+            raise ValueError("no data_*.tb files in {}".format(path))
+
+        indices = [_read_typedbytes_index(fname) for fname in fnames]
+        if all(index is not None for index in indices):
+            feats = cls._load_typedbytes_indexed(
+                fnames, indices, features_dtype=features_dtype,
+                cats=cats, pairs=pairs, subsample_fn=subsample_fn,
+                names_only=names_only, n_threads=n_threads)
+            if names_only:
+                return feats
+            return cls._maybe_load_attrs(feats, path, load_attrs=load_attrs)
+        del indices
 
-        # load everything
-        def load_files():
-            for fname in glob(os.path.join(path, 'data_*.tb')):
-                with open(fname, 'rb') as f:
-                    yield cls._load_typedbytes(f, features_dtype=features_dtype,
-                                               cats=cats, pairs=pairs)
-        feats = reduce(op.add, load_files())
+        categories = []
+        names = []
+        bags = []
+        extras = []
+        read = partial(_read_typedbytes_file, cls,
+                       features_dtype=features_dtype, cats=cats, pairs=pairs)
+        with get_pool(min(n_threads, len(fnames)), threads=True) as pool:
+            for f_cats, f_names, f_bags, f_extras in pool.imap(read, fnames):
+                categories.extend(f_cats)
+                names.extend(f_names)
+                bags.extend(f_bags)
+                extras.extend(f_extras)
+
+        features, n_pts = _stack_bags(bags)
+        del bags
+        feats = cls._postprocess(categories, names, features, extras,
+                                 n_pts=n_pts)
 
         if subsample_fn is not None or names_only:
             bag_names = zip(feats.categories, feats.names)
@@ -1229,3 +1783,268 @@ class Features(object):
                 return bag_names
 
         return cls._maybe_load_attrs(feats, path, load_attrs=load_attrs)
+
+    @classmethod
+    def _load_typedbytes_indexed(cls, fnames, indices, features_dtype=None,
+                                 cats=None, pairs=None, subsample_fn=None,
+                                 names_only=False,
+                                 n_threads=DEFAULT_LOAD_THREADS):
+        '''
+        Does load_from_typedbytes() for files that all have offset indices,
+        which are passed as returned by _read_typedbytes_index().
+        '''
+        from . import typedbytes_utils as tbu
+        from .mp_utils import get_pool
+
+        bag_names = []
+        locs = []
+        for file_i, index in enumerate(indices):
+            for cat, name, offset, n, dim, dtype in izip(*index):
+                if ((cats is None or cat in cats) and
+                        (pairs is None or (cat, name) in pairs)):
+                    bag_names.append((cat, name))
+                    locs.append((file_i, offset, n, dim, dtype))
+        del indices
+
+        if subsample_fn is not None:
+            loc_map = dict(izip(bag_names, locs))
+            bag_names = subsample_fn(bag_names)
+            locs = [loc_map[bag_name] for bag_name in bag_names]
+
+        if names_only:
+            return bag_names
+        if not bag_names:
+            raise ValueError("no bags to load")
+
+        file_is, offsets, n_pts, dims, dtypes = strict_zip(*locs)
+        del locs
+        if len(set(dims)) != 1:
+            raise ValueError("malformed files: bags have feature dims {}"
+                             .format(sorted(set(dims))))
+        n_pts = np.asarray(n_pts)
+        boundaries = np.hstack([[0], np.cumsum(n_pts)])
+        if features_dtype is None:
+            features_dtype = np.result_type(*[np.dtype(dt)
+                                              for dt in set(dtypes)])
+        features = np.empty((boundaries[-1], dims[0]), dtype=features_dtype)
+        extras = [None] * len(bag_names)
+
+        # read each file's records in file order, straight into place
+        file_records = [[] for _ in fnames]
+        for i, (file_i, offset) in enumerate(izip(file_is, offsets)):
+            file_records[file_i].append((offset, i))
+
+        def load_file(file_i):
+            with open(fnames[file_i], 'rb') as f:
+                inp = tbu.tb.Input(f)
+                tbu.register_read_ndarray(inp)
+                tbu.check_seekable(inp)
+
+                for offset, i in sorted(file_records[file_i]):
+                    f.seek(offset)
+                    key = inp.read()
+                    if key != '{}/{}'.format(*bag_names[i]):
+                        msg = "malformed index: expected {!r} at {} in {}, " \
+                              "got {!r}"
+                        raise ValueError(msg.format(
+                            '{}/{}'.format(*bag_names[i]), offset,
+                            fnames[file_i], key))
+                    bag, extras[i] = cls._proc_from_typedbytes(inp.read())
+                    if bag.ndim == 1:
+                        bag = bag[None, :]
+                    out = features[boundaries[i]:boundaries[i+1]]
+                    if bag.shape != out.shape:
+                        msg = "malformed index: {} is {}, expected {}"
+                        raise ValueError(msg.format(
+                            key, bag.shape, out.shape))
+                    out[...] = bag
+
+        with get_pool(min(n_threads, len(fnames)), threads=True) as pool:
+            pool.map(load_file, [file_i for file_i, records
+                                 in enumerate(file_records) if records])
+
+        categories, names = zip(*bag_names)
+        return cls._postprocess(categories, names, features, extras,
+                                n_pts=n_pts)
+
+
+################################################################################
+### Writing features files one bag at a time
+
+class _BagWriter(object):
+    '''
+    Adds bags to a features file one at a time, so that they don't all need
+    to be in memory at once; see Features.open_writer().
+
+    `(category, name) in writer` checks whether a bag is already there, e.g.
+    from an earlier, interrupted run.
+    '''
+    def __contains__(self, bag_name):
+        raise NotImplementedError
+
+    def write(self, category, name, features, **extras):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _HDF5BagWriter(_BagWriter):
+    "Writes the 'groups' layout of Features.save_as_hdf5()."
+    def __init__(self, filename, file_root=None, resume=False, **attrs):
+        import h5py
+        self._file = h5py.File(filename, 'a' if resume else 'w')
+        self._root = f = self._file
+        if file_root is not None:
+            self._root = f = f.require_group(file_root)
+
+        meta = f.require_group('_meta')
+        for k, v in iteritems(attrs):
+            if k in meta:
+                del meta[k]
+            meta[k] = v
+
+    def __contains__(self, bag_name):
+        cat, name = bag_name
+        return (cat in self._root and name in self._root[cat]
+                and 'features' in self._root[cat][name])
+
+    def write(self, category, name, features, **extras):
+        g = self._root.require_group(category)
+        if name in g:  # left partially-written by an earlier run
+            del g[name]
+        g = g.create_group(name)
+        for k, v in iteritems(extras):
+            g[k] = v
+        # features go last, so that a bag is only "in" the file once complete
+        g['features'] = features
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _PerbagWriter(_BagWriter):
+    "Writes the layout of Features.save_as_perbag()."
+    def __init__(self, path, resume=False, **attrs):
+        if os.path.exists(path) and not resume:
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+
+        with open(os.path.join(path, 'attrs.pkl'), 'wb') as f:
+            pickle.dump(attrs, f)
+
+    def _bag_path(self, category, name):
+        return os.path.join(self.path, category, name + '.npz')
+
+    def __contains__(self, bag_name):
+        return os.path.exists(self._bag_path(*bag_name))
+
+    def write(self, category, name, features, **extras):
+        dirpath = os.path.join(self.path, category)
+        if not os.path.isdir(dirpath):
+            os.mkdir(dirpath)
+
+        # write then rename, so that a bag is only "in" the dir once complete
+        path = self._bag_path(category, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, features=features, **extras)
+        os.rename(path + '.tmp', path)
+
+
+class _TypedbytesBagWriter(_BagWriter):
+    '''
+    Writes the layout of Features.save_as_typedbytes(), starting a new shard
+    (and rewriting the manifest) every shard_bags bags. Resuming adds new
+    shards after the existing ones.
+    '''
+    def __init__(self, path, resume=False, shard_bags=1000, **attrs):
+        if os.path.exists(path) and not resume:
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.shard_bags = shard_bags
+
+        with open(os.path.join(path, 'attrs.pkl'), 'wb') as f:
+            pickle.dump(attrs, f)
+
+        self._shards = []
+        self._seen = set()
+        if glob(os.path.join(path, 'data_*.tb')):
+            self._seen.update(Features.load_from_typedbytes(
+                path, names_only=True))
+            try:
+                with open(os.path.join(path, 'manifest.json')) as f:
+                    self._shards = json.load(f)['shards']
+            except IOError:
+                fnames = sorted(glob(os.path.join(path, 'data_*.tb')),
+                                key=_typedbytes_file_idx)
+                starts = strict_map(_typedbytes_file_idx, fnames)
+                self._shards = [
+                    {'file': os.path.basename(fname), 'start': start,
+                     'end': end}
+                    for fname, start, end in izip(
+                        fnames, starts, starts[1:] + [len(self._seen)])]
+        self._n_bags = len(self._seen)
+        self._out = None
+
+    def __contains__(self, bag_name):
+        return tuple(bag_name) in self._seen
+
+    def _start_shard(self):
+        from . import typedbytes_utils as tbu
+
+        self._fname = 'data_{}.tb'.format(self._n_bags)
+        self._tmp_path = os.path.join(self.path, self._fname + '.tmp')
+        self._out = tbu.tb.PairedOutput(open(self._tmp_path, 'wb'))
+        tbu.register_write(self._out)
+        self._start = self._n_bags
+        # categories, names, offsets, shapes, dtypes
+        self._index = ([], [], [_typedbytes_tell(self._out)], [], [])
+
+    def _finish_shard(self):
+        self._out.close()
+        self._out = None
+
+        path = os.path.join(self.path, self._fname)
+        _write_typedbytes_index(path, *self._index)
+        os.rename(self._tmp_path, path)
+
+        self._shards.append(
+            {'file': self._fname, 'start': self._start, 'end': self._n_bags})
+        manifest = {'n_bags': self._n_bags, 'shards': self._shards}
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    def write(self, category, name, features, **extras):
+        if self._out is None:
+            self._start_shard()
+
+        features = np.asarray(features)
+        extras['features'] = features
+        self._out.write(("{}/{}".format(category, name), extras))
+
+        cats, names, offsets, shapes, dtypes = self._index
+        cats.append(category)
+        names.append(name)
+        offsets.append(_typedbytes_tell(self._out))
+        shapes.append(features.shape)
+        dtypes.append(features.dtype)
+        self._seen.add((category, name))
+        self._n_bags += 1
+
+        if self._n_bags - self._start >= self.shard_bags:
+            self._finish_shard()
+
+    def close(self):
+        if self._out is not None:
+            self._finish_shard()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+Hadoop streaming mapper and reducer for estimating divergences across a
+cluster. The divergence matrix is split into blocks of bags; each mapper
+input line names a pair of blocks, which the mapper computes (in both
+directions) and emits as text records. A single reducer stitches the blocks
+back together into the same HDF5 format that estimate_divs writes.
+
+The records are plain text lines, so the whole thing can be run without a
+cluster:
+
+    estimate_divs_mapper feats.h5 --n-blocks 4 --list-tiles > tiles.txt
+    estimate_divs_mapper feats.h5 --n-blocks 4 < tiles.txt \
+        | sort | estimate_divs_reducer feats.h5 feats.divs.h5
+
+With hadoop, tiles.txt is the -input, the mapper and reducer commands are
+passed to -mapper and -reducer, and -numReduceTasks should be 1. The
+features file (and the reducer's output path) need to be visible to every
+node, e.g. via a shared filesystem or -files.
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import base64
+from io import BytesIO
+import sys
+
+import numpy as np
+
+from .np_divs import (_add_input_args, _add_div_args, _load_features,
+                      add_to_h5_file, block_bounds, block_pairs,
+                      estimate_divs_block)
+from .knn_search import default_min_dist
+from .utils import positive_int, get_status_fn
+
+
+def _encode_block(ary):
+    buf = BytesIO()
+    np.save(buf, ary)
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def _decode_block(s):
+    return np.load(BytesIO(base64.b64decode(s)))
+
+
+################################################################################
+### Mapper
+
+def parse_mapper_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Hadoop streaming mapper for estimate_divs: reads lines "
+                    "of 'i j' block pairs from stdin and writes the "
+                    "corresponding divergence blocks to stdout.")
+    _add_input_args(parser)
+    parser.add_argument('--n-blocks', type=positive_int, required=True,
+        help="The number of blocks to split the bags into along each axis.")
+    parser.add_argument('--list-tiles', action='store_true', default=False,
+        help="Instead of mapping, print the block pairs to use as the job's "
+             "input.")
+    _add_div_args(parser)
+    return parser.parse_args(args)
+
+
+def mapper_main(args=None):
+    args = parse_mapper_args(args)
+    status_fn = get_status_fn(True)
+    out = sys.stdout
+
+    if args.list_tiles:
+        for i, j in block_pairs(args.n_blocks):
+            out.write('{}\t{}\n'.format(i, j))
+        return
+
+    bags = _load_features(args)
+    bounds = block_bounds(len(bags), args.n_blocks)
+    if args.min_dist is None:
+        args.min_dist = default_min_dist(bags.dim)
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        i, j = map(int, line.split())
+        status_fn("Computing block ({}, {})...".format(i, j))
+        rows, cols = bounds[i], bounds[j]
+        fwd, bwd = estimate_divs_block(
+            bags, rows, cols,
+            specs=args.div_funcs, Ks=args.K,
+            cores=args.cores, min_dist=args.min_dist,
+            status_fn=None, progressbar=False,
+            **args.flann_args)
+
+        out.write('{}\t{}\t{}\n'.format(rows[0], cols[0], _encode_block(fwd)))
+        if i != j:
+            out.write('{}\t{}\t{}\n'.format(
+                cols[0], rows[0], _encode_block(bwd)))
+        out.flush()
+
+
+################################################################################
+### Reducer
+
+def parse_reducer_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Hadoop streaming reducer for estimate_divs: reads the "
+                    "blocks written by the mapper from stdin and saves the "
+                    "full divergence matrix to an HDF5 file.")
+    _add_input_args(parser)
+    parser.add_argument('output_file',
+        help="The HDF5 file to write; existing divs with the same "
+             "function and K are overwritten.")
+    _add_div_args(parser)
+    return parser.parse_args(args)
+
+
+def reducer_main(args=None):
+    args = parse_reducer_args(args)
+    status_fn = get_status_fn(True)
+
+    bags = _load_features(args)
+    n = len(bags)
+    if args.min_dist is None:
+        args.min_dist = default_min_dist(bags.dim)
+
+    divs = np.empty((n, n, len(args.div_funcs), len(args.K)), dtype=np.float32)
+    divs.fill(np.nan)
+    done = np.zeros((n, n), dtype=bool)
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        row_start, col_start, data = line.split('\t')
+        row_start, col_start = int(row_start), int(col_start)
+        block = _decode_block(data)
+        row_end = row_start + block.shape[0]
+        col_end = col_start + block.shape[1]
+        divs[row_start:row_end, col_start:col_end] = block
+        done[row_start:row_end, col_start:col_end] = True
+
+    if not done.all():
+        msg = "only got {} of the {} divergence pairs"
+        raise ValueError(msg.format(done.sum(), done.size))
+
+    status_fn("Outputting results to", args.output_file)
+    add_to_h5_file(args.output_file, {
+        'specs': args.div_funcs,
+        'Ks': args.K,
+        'min_dist': args.min_dist,
+        'dim': bags.dim,
+        'cats': bags.categories,
+        'names': bags.names,
+        'Ds': divs,
+    })
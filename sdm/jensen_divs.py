@@ -1,6 +1,8 @@
 ################################################################################
 ### Jensen-Renyi divergences
-# TODO: make them work for arbitrary sample sizes, integrate into estimate_divs?
+# These only handle one pair of equal-sized samples at a time; the 'jr:alpha'
+# spec of np_divs estimates Jensen-Renyi divergences between bags of any sizes
+# as part of estimate_divs.
 
 def renyi_entropy_knns(knns, dim, alphas, Ks):
     '''
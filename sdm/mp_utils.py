@@ -3,9 +3,12 @@ Some convenince methods for use with multiprocessing.Pool.
 '''
 from __future__ import division, print_function
 
+from collections import deque
 from contextlib import contextmanager
 import itertools
 import multiprocessing as mp
+import multiprocessing.pool
+from multiprocessing.pool import ThreadPool
 import os
 import random
 import string
@@ -48,7 +51,8 @@ class DummyPool(object):
 
     def apply_async(self, func, args, kwds=None, callback=None):
         val = func(*args, **(kwds or {}))
-        callback(val)
+        if callback is not None:
+            callback(val)
         return ImmediateResult(val)
 
     def map(self, func, args, chunksize=None):
@@ -74,20 +78,74 @@ def patch_starmap(pool):
     pool.starmap = starmap
 
 
-def make_pool(n_proc=None):
-    "Makes a multiprocessing.Pool or a DummyPool depending on n_proc."
-    pool = DummyPool() if n_proc == 1 else mp.Pool(n_proc)
+### A Pool whose workers aren't daemonic, so that they can have their own pools.
+class NoDaemonProcess(mp.Process):
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class NoDaemonPool(mp.pool.Pool):
+    Process = NoDaemonProcess
+
+
+def make_pool(n_proc=None, daemon=True, threads=False):
+    '''
+    Makes a multiprocessing.Pool or a DummyPool depending on n_proc.
+    If not daemon, the workers are allowed to make pools of their own.
+    If threads, makes a ThreadPool instead (for I/O-bound work), even for
+    n_proc = 1 so that the work still overlaps with the caller's.
+    '''
+    if threads:
+        pool = ThreadPool(n_proc)
+    elif n_proc == 1:
+        pool = DummyPool()
+    else:
+        pool = (mp.Pool if daemon else NoDaemonPool)(n_proc)
     patch_starmap(pool)
     return pool
 
 
 @contextmanager
-def get_pool(n_proc=None):
+def get_pool(n_proc=None, daemon=True, threads=False):
     "A context manager that opens a pool and joins it on exit."
-    pool = make_pool(n_proc)
-    yield pool
-    pool.close()
-    pool.join()
+    pool = make_pool(n_proc, daemon=daemon, threads=threads)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+### Streaming through a pool without reading everything in up front.
+def _map_chunk(func, chunk):
+    return strict_map(func, chunk)
+
+
+def imap_bounded(pool, func, iterable, chunksize=1, max_in_flight=None):
+    '''
+    Like pool.imap(func, iterable, chunksize), but only has max_in_flight
+    chunks submitted or waiting to be consumed at once (default: twice the
+    number of workers). pool.imap reads the whole input and holds on to any
+    results the consumer hasn't gotten to yet, which can be a lot of memory.
+    '''
+    if max_in_flight is None:
+        max_in_flight = 2 * getattr(pool, '_processes', 1)
+
+    it = iter(iterable)
+    chunks = iter(lambda: list(itertools.islice(it, chunksize)), [])
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(_map_chunk, (func, chunk)))
+        if len(pending) >= max_in_flight:
+            for result in pending.popleft().get():
+                yield result
+    while pending:
+        for result in pending.popleft().get():
+            yield result
 
 
 ### A helper for letting the forked processes use data without pickling.
@@ -164,6 +222,28 @@ def progressbar_and_updater(*args, **kwargs):
     return pbar, update_pbar
 
 
+def progressbar_callback(**kwargs):
+    '''
+    Returns a function update(done, total, rate) that shows a progress bar,
+    for use as a progress callback. The bar is started on the first call
+    and finished once done reaches total, after which the next call starts
+    a new one.
+    '''
+    state = {}
+
+    def update(done, total, rate=None):
+        pbar = state.get('pbar')
+        if pbar is None:
+            if not total:
+                return
+            pbar = state['pbar'] = progress(maxval=total, **kwargs).start()
+        pbar.update(done)
+        if done >= total:
+            pbar.finish()
+            del state['pbar']
+    return update
+
+
 def map_unordered_with_progressbar(pool, func, jobs):
     pbar, tick_pbar = progressbar_and_updater(maxval=len(jobs))
     callback = lambda result: tick_pbar()
@@ -13,11 +13,19 @@ from __future__ import division, print_function
 
 import argparse
 from collections import namedtuple, defaultdict, OrderedDict
+from contextlib import contextmanager
+import errno
 from functools import partial
 import itertools
+import json
 from operator import itemgetter
 import os
+import shutil
+import socket
+import subprocess
 import sys
+import threading
+import time
 import warnings
 
 import numpy as np
@@ -26,23 +34,29 @@ from scipy.special import gamma, gammaln, psi
 
 from cyflann import FLANNIndex, FLANNParameters
 
-from .features import Features
+from .features import Features, _can_mmap
 from .utils import (eps, izip, lazy_range, strict_map, raw_input, identity,
-                    str_types, bytes, positive_int, confirm_outfile,
+                    str_types, bytes, positive_int, nonnegative_int,
+                    positive_float, confirm_outfile,
                     is_integer_type,
                     read_cell_array,
                     iteritems, itervalues, get_status_fn)
-from .mp_utils import progress
+from .mp_utils import progress, progressbar_callback
 from .knn_search import default_min_dist, pick_flann_algorithm
-from ._np_divs import _linear, kl, _alpha_div, _jensen_shannon_core
+from ._np_divs import (_linear, kl, _alpha_div, _jensen_shannon_core,
+                       _jensen_renyi_core,
+                       _rho_logs, _stack_bags, _bag_means,
+                       _JOBS_BLOCK, _JOBS_TRIANGLE, _JOBS_LIST)
 
 try:
-    from ._np_divs_cy import _estimate_cross_divs
+    from ._np_divs_cy import (_estimate_cross_divs, _within_bag_sq_dists,
+                              _divs_from_knn_store)
 except ImportError as e:
     msg = ("Cythonned divergence estimator not available, using the slow "
            "pure-Python version:\n{}".format(e))
     warnings.warn(msg)
-    from ._np_divs import _estimate_cross_divs
+    from ._np_divs import (_estimate_cross_divs, _within_bag_sq_dists,
+                           _divs_from_knn_store)
 
 
 ################################################################################
@@ -207,6 +221,51 @@ jensen_shannon_core.self_value = np.nan
 # just subtract that later, don't bother computing it.
 
 
+def jensen_renyi_core(alphas, Ks, dim, num_q, rhos, nus):
+    r'''
+    Estimates, for each alpha,
+          mean_X( (i * r^d / w)^(1 - alpha) * gamma(i) / gamma(i + 1 - alpha) )
+    where r is the radius of the largest ball in X+Y around X_i (not counting
+    X_i itself) whose weight w is no more than K/(n+m-1),
+          X points have weight 1 / (2 n - 1)
+      and Y points have weight n / (m (2 n - 1)),
+    and i is the number of points in that ball (but always at least 1).
+
+    Up to a factor of c_d^(1 - alpha), where c_d is the volume of the unit
+    ball, this estimates \int_X p m^(alpha - 1) for the mixture
+    m = (p + q) / 2. See jensen_renyi for the full estimator.
+
+    Needs *all* of the neighbor distances, not just those for the Ks.
+
+    Returns an array of shape (num_alphas, num_Ks).
+    '''
+    ns = np.array([rhos.shape[0], num_q])
+    core, _ = _get_jensen_renyi_core(alphas, Ks, dim, ns)
+    return core(num_q, rhos, nus)
+
+def _get_jensen_renyi_core(alphas, Ks, dim, ns):
+    alphas = np.reshape(alphas, -1)
+    Ks = np.reshape(Ks, -1)
+    if np.any(alphas <= 0) or np.any(alphas >= 2) or np.any(alphas == 1):
+        msg = "jensen_renyi needs 0 < alpha < 2 and alpha != 1, got {}"
+        raise ValueError(msg.format(alphas))
+
+    # the ball can have anywhere from 1 to all 2 * max_K neighbors in it
+    max_K = np.max(Ks)
+    omas = 1 - alphas
+    i = np.arange(2 * max_K + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):  # i = 0 is unused
+        log_gamma_ratios = (gammaln(i[np.newaxis, :])
+                            - gammaln(i[np.newaxis, :] + omas[:, np.newaxis]))
+    return partial(_jensen_renyi_core, omas, Ks, dim, log_gamma_ratios), max_K
+
+jensen_renyi_core.needs_alpha = True
+jensen_renyi_core.chooser_fn = _get_jensen_renyi_core
+jensen_renyi_core.needs_all_ks = True
+jensen_renyi_core.chooser_fn.returns_ks = True
+jensen_renyi_core.self_value = np.nan  # as for jensen_shannon_core
+
+
 ################################################################################
 ### Meta-estimators: things that need some additional computation on top of
 ###                  the per-bag stuff of the functions above.
@@ -238,6 +297,26 @@ jensen_shannon_core.self_value = np.nan
 #   required: a list of the results array for each MetaRequirement classes,
 #             each of shape (n_bags, n_bags, num_Ks).
 #
+#   bag_stats: optional. A function ([alphas,] Ks, dim, rhos) returning an
+#              array whose first axis has some per-bag values that the meta
+#              function needs. The estimators run meta functions on one tile
+#              of bags at a time, so they compute these once for all the bags
+#              and pass the slices for the tile as the row_stats (and, along
+#              with col_rhos, col_stats) keyword arguments. If those aren't
+#              passed, the function computes them itself.
+#
+# Functions with a needs_transpose requirement also take these keyword
+# arguments, for estimating between two different sets of bags (as in
+# estimate_cross_divs); rhos and required are then for the rows, and of shape
+# (n_rows, n_cols, num_Ks):
+#
+#   col_rhos: the within-bag NN distances for the columns' bags. If None (the
+#             default), the rows and columns are the same bags, and the
+#             diagonal is the divergence from a bag to itself.
+#
+#   transposed: the required results the other way around: transposed[k][i, j]
+#               is the divergence from column bag j to row bag i.
+#
 # Returns: array of results.
 # If needs_alpha, has shape (n_bags, n_bags, num_alphas, num_Ks);
 # otherwise, has shape (n_bags, n_bags, num_Ks).
@@ -333,37 +412,57 @@ tsallis.needs_alpha = True
 tsallis.needs_results = [MetaRequirement(alpha_div, identity, False)]
 
 
-def l2(Ks, dim, rhos, required):
+def _quadratics(Ks, dim, rhos):
+    # quadratic() for each bag, all at once
+    stacked, boundaries = _stack_bags(rhos)
+    ns = np.diff(boundaries)[:, np.newaxis]
+    means = _bag_means(stacked ** (-dim), boundaries)
+    return (_quadratic_Bs(Ks, dim) / (ns - 1) * means).astype(np.float32)
+
+
+def l2(Ks, dim, rhos, required, col_rhos=None, transposed=None,
+       row_stats=None, col_stats=None):
     r'''
     Estimates the L2 distance between distributions, via
         \int (p - q)^2 = \int p^2 - \int p q - \int q p + \int q^2.
 
     \int pq and \int qp are estimated with the linear function (in both
     directions), while \int p^2 and \int q^2 are estimated via the quadratic
-    function below.
+    function below. row_stats and col_stats, if passed, are those quadratic
+    estimates for rhos and col_rhos.
     '''
-    n_bags = len(rhos)
+    square = col_rhos is None
+    if square:
+        col_rhos = rhos
+    n_rows = len(rhos)
+    n_cols = len(col_rhos)
 
     linears, = required
-    assert linears.shape == (n_bags, n_bags, 1, Ks.size)
+    assert linears.shape == (n_rows, n_cols, 1, Ks.size)
+    linears_T, = [linears.transpose(1, 0, 2, 3)] if square else transposed
 
-    quadratics = np.empty((n_bags, Ks.size), dtype=np.float32)
-    for i, rho in enumerate(rhos):
-        quadratics[i, :] = quadratic(Ks, dim, rho)
+    row_quads = row_stats
+    if row_quads is None:
+        row_quads = _quadratics(Ks, dim, rhos)
+    col_quads = col_stats
+    if col_quads is None:
+        col_quads = row_quads if square else _quadratics(Ks, dim, col_rhos)
 
     est = -linears
-    est -= linears.transpose(1, 0, 2, 3)
-    est += quadratics.reshape(n_bags, 1, 1, Ks.size)
-    est += quadratics.reshape(1, n_bags, 1, Ks.size)
+    est -= linears_T
+    est += row_quads.reshape(n_rows, 1, 1, Ks.size)
+    est += col_quads.reshape(1, n_cols, 1, Ks.size)
     np.maximum(est, 0, out=est)
     np.sqrt(est, out=est)
 
     # diagonal is of course known to be zero
-    all_bags = lazy_range(n_bags)
-    est[all_bags, all_bags, :, :] = 0
+    if square:
+        all_bags = lazy_range(n_rows)
+        est[all_bags, all_bags, :, :] = 0
     return est
 l2.needs_alpha = False
 l2.needs_results = [MetaRequirement(linear, alpha=None, needs_transpose=True)]
+l2.bag_stats = _quadratics
 
 
 # Not actually a meta-estimator, though it could be if it just repeated the
@@ -381,12 +480,26 @@ def quadratic(Ks, dim, rhos, required=None):
     # and the full estimator is
     #   B / (n - 1) * mean(rho ^ -dim)
     N = rhos.shape[0]
-    Ks = np.asarray(Ks)
-    Bs = (Ks - 1) / np.pi ** (dim / 2) * gamma(dim / 2 + 1)  # shape (num_Ks,)
+    Bs = _quadratic_Bs(Ks, dim)
     return Bs / (N - 1) * np.mean(rhos ** (-dim), axis=0)
 
 
-def jensen_shannon(Ks, dim, rhos, required, clamp=False):
+def _quadratic_Bs(Ks, dim):
+    Ks = np.asarray(Ks)
+    return (Ks - 1) / np.pi ** (dim / 2) * gamma(dim / 2 + 1)  # shape (num_Ks,)
+
+
+def _jensen_shannon_bag_stats(Ks, dim, rhos):
+    # log(n - 1) + d * mean(log rho_K) for each bag
+    stacked, boundaries = _stack_bags(rhos)
+    bits = dim * _bag_means(np.log(stacked), boundaries)
+    bits += np.log(np.diff(boundaries) - 1)[:, np.newaxis]
+    return bits.astype(np.float32)
+
+
+def jensen_shannon(Ks, dim, rhos, required, clamp=False,
+                   col_rhos=None, transposed=None,
+                   row_stats=None, col_stats=None):
     r'''
     Estimate the difference between the Shannon entropy of an equally-weighted
     mixture between X and Y and the mixture of the Shannon entropies:
@@ -441,27 +554,43 @@ def jensen_shannon(Ks, dim, rhos, required, clamp=False):
     where the alpha-quantile of a point in a weighted set is the highest k
     such that w_(j) <= alpha, where w_(j) is the weight of the (j)th nearest
     neighbor (not including the point itself).
-    '''
-    ns = np.array([rho.shape[0] for rho in rhos])
-    n_bags = ns.size
-    cores, = required
-    assert cores.shape == (n_bags, n_bags, 1, Ks.size)
 
-    bits = np.empty((n_bags, Ks.size), dtype=np.float32)
-    for i, rho in enumerate(rhos):  # TODO parallelize?
-        bits[i, :] = dim * np.mean(np.log(rho), axis=0)
-    bits += np.log(ns - 1)[:, np.newaxis]
+    row_stats and col_stats, if passed, are the last two terms' brackets
+    (without the 1/2) for each bag of rhos and col_rhos.
+    '''
+    square = col_rhos is None
+    if square:
+        col_rhos = rhos
+    n_rows = len(rhos)
+    n_cols = len(col_rhos)
 
-    est = cores + cores.transpose(1, 0, 2, 3)  # intentionally make a copy
-    est -= bits.reshape(n_bags, 1, 1, Ks.size)
-    est -= bits.reshape(1, n_bags, 1, Ks.size)
+    cores, = required
+    assert cores.shape == (n_rows, n_cols, 1, Ks.size)
+    cores_T, = [cores.transpose(1, 0, 2, 3)] if square else transposed
+
+    row_ns = np.array([rho.shape[0] for rho in rhos])
+    col_ns = row_ns if square else np.array([rho.shape[0] for rho in col_rhos])
+
+    row_bits = row_stats
+    if row_bits is None:
+        row_bits = _jensen_shannon_bag_stats(Ks, dim, rhos)
+    col_bits = col_stats
+    if col_bits is None:
+        col_bits = row_bits if square else \
+            _jensen_shannon_bag_stats(Ks, dim, col_rhos)
+
+    est = cores + cores_T  # intentionally make a copy
+    est -= row_bits.reshape(n_rows, 1, 1, Ks.size)
+    est -= col_bits.reshape(1, n_cols, 1, Ks.size)
     est /= 2
-    est += np.log(-1 + ns[:, np.newaxis] + ns[np.newaxis, :])[:, :, None, None]
+    est += np.log(-1 + row_ns[:, np.newaxis]
+                  + col_ns[np.newaxis, :])[:, :, None, None]
     est += psi(Ks)[None, None, None, :]
 
     # diagonal is zero
-    all_bags = lazy_range(n_bags)
-    est[all_bags, all_bags, :, :] = 0
+    if square:
+        all_bags = lazy_range(n_rows)
+        est[all_bags, all_bags, :, :] = 0
 
     if clamp:  # know that 0 <= JS <= ln(2)
         np.maximum(0, est, out=est)
@@ -470,6 +599,7 @@ def jensen_shannon(Ks, dim, rhos, required, clamp=False):
 jensen_shannon.needs_alpha = False
 jensen_shannon.needs_results = [
     MetaRequirement(jensen_shannon_core, alpha=None, needs_transpose=True)]
+jensen_shannon.bag_stats = _jensen_shannon_bag_stats
 
 
 def js_clamp(Ks, dim, rhos, required):
@@ -483,6 +613,88 @@ js_clamp.needs_results = [
     MetaRequirement(jensen_shannon, alpha=None, needs_transpose=False)]
 
 
+def _renyi_integral_logs(alphas, Ks, dim, rhos):
+    # For each bag, the log of the usual kNN estimate of \int p^alpha
+    # (without the c_d^(1 - alpha) factor):
+    #   mean_X( ((n - 1) rho_K^d)^(1 - alpha) ) gamma(K) / gamma(K + 1 - alpha)
+    # with shape (n_bags, num_alphas, num_Ks).
+    omas = np.reshape(1 - np.asarray(alphas), (1, -1, 1))
+    Ks = np.reshape(Ks, -1)
+    stacked, boundaries = _stack_bags(rhos)
+    n_pts, num_Ks = stacked.shape
+
+    powers = np.exp(omas * (dim * np.log(stacked))[:, np.newaxis, :])
+    means = _bag_means(powers.reshape(n_pts, -1), boundaries)
+    logs = np.log(means).reshape(-1, omas.size, num_Ks)
+    logs += omas * np.log(np.diff(boundaries) - 1)[:, None, None]
+    logs += gammaln(Ks) - gammaln(Ks + omas)
+    return logs
+
+
+def jensen_renyi(alphas, Ks, dim, rhos, required, clamp=True,
+                 col_rhos=None, transposed=None,
+                 row_stats=None, col_stats=None):
+    r'''
+    Estimate the Jensen-Renyi divergence between distributions,
+        R_\alpha((p + q)/2) - 1/2 R_\alpha(p) - 1/2 R_\alpha(q)
+    where R_\alpha is the Renyi entropy:
+        1/(1 - \alpha) \log \int p^\alpha
+    which is estimated based on kNN distances.
+
+    The mixture's \int m^\alpha = 1/2 E_p[m^(\alpha-1)] + 1/2 E_q[m^(\alpha-1)]
+    is estimated from the weighted kNN balls of jensen_renyi_core, in both
+    directions, so the bags can have different sizes. \int p^\alpha and
+    \int q^\alpha use the usual kNN estimator; row_stats and col_stats, if
+    passed, are their logs for each bag of rhos and col_rhos. The volume of
+    the unit ball cancels out.
+
+    If clamp (the default), enforces that the estimates are nonnegative.
+
+    Returns an array of shape (n_rows, n_cols, num_alphas, num_Ks).
+    '''
+    square = col_rhos is None
+    if square:
+        col_rhos = rhos
+    n_rows = len(rhos)
+    n_cols = len(col_rhos)
+    omas = np.reshape(1 - np.asarray(alphas), (-1, 1))
+
+    cores = np.concatenate(required, axis=2)
+    assert cores.shape == (n_rows, n_cols, omas.size, Ks.size)
+    if square:
+        cores_T = cores.transpose(1, 0, 2, 3)
+    else:
+        cores_T = np.concatenate(transposed, axis=2)
+
+    row_logs = row_stats
+    if row_logs is None:
+        row_logs = _renyi_integral_logs(alphas, Ks, dim, rhos)
+    col_logs = col_stats
+    if col_logs is None:
+        col_logs = row_logs if square else \
+            _renyi_integral_logs(alphas, Ks, dim, col_rhos)
+
+    est = cores + cores_T  # intentionally make a copy
+    est /= 2
+    np.log(est, out=est)
+    est -= row_logs[:, np.newaxis] / 2
+    est -= col_logs[np.newaxis, :] / 2
+    est /= omas
+
+    # diagonal is zero
+    if square:
+        all_bags = lazy_range(n_rows)
+        est[all_bags, all_bags, :, :] = 0
+
+    if clamp:
+        np.maximum(est, 0, out=est)
+    return est
+jensen_renyi.needs_alpha = True
+jensen_renyi.needs_results = [
+    MetaRequirement(jensen_renyi_core, alpha=identity, needs_transpose=True)]
+jensen_renyi.bag_stats = _renyi_integral_logs
+
+
 
 ################################################################################
 
@@ -499,6 +711,9 @@ func_mapping = {
     'js': jensen_shannon,
     'jensen-shannon': jensen_shannon,
     'js_clamp': js_clamp,
+    'jr-core': jensen_renyi_core,
+    'jr': jensen_renyi,
+    'jensen-renyi': jensen_renyi,
 }
 
 
@@ -725,6 +940,7 @@ def _parse_specs(specs, Ks, dim, ns):
         args = (Ks, dim)
         if needs_alpha:
             args = (info.alphas,) + args
+        stats_args = args
 
         if hasattr(func, 'chooser_fn'):
             args += (ns,)
@@ -740,6 +956,8 @@ def _parse_specs(specs, Ks, dim, ns):
         for attr in dir(func):
             if not (attr.startswith('__') or attr.startswith('func_')):
                 setattr(new, attr, getattr(func, attr))
+        if hasattr(func, 'bag_stats'):
+            new.bag_stats = partial(func.bag_stats, *stats_args)
         return new
 
     rep_funcs = dict(
@@ -757,17 +975,289 @@ def normalize_div_name(name):
     return name
 
 
+################################################################################
+### Descriptions of which pairs of bags to estimate.
+#
+# The kernels enumerate the pairs described by a PairMask on the fly from a
+# 64-bit job number, so structured masks don't need an n x n array (or the
+# index arrays of its nonzeros) to exist at all. Plain boolean arrays are
+# still accepted everywhere and turned into a SparseMask.
+
+class PairMask(object):
+    '''
+    Base class for descriptions of which (i, j) pairs of bags to estimate.
+    '''
+    is_symmetric = False
+
+    def check(self, n_rows, n_cols):
+        '''Raises ValueError if this doesn't fit an n_rows x n_cols array.'''
+
+    def symmetrized(self):
+        '''
+        A symmetric mask including every pair in this one and its
+        transpose. It may include more pairs than that.
+        '''
+        raise NotImplementedError
+
+    def column(self, j, n_rows):
+        '''A boolean array of which rows are estimated for column j.'''
+        raise NotImplementedError
+
+    def to_array(self, n_rows, n_cols):
+        '''The mask as an n_rows x n_cols boolean array.'''
+        ary = np.empty((n_rows, n_cols), dtype=bool)
+        for j in lazy_range(n_cols):
+            ary[:, j] = self.column(j, n_rows)
+        return ary
+
+    def clear_outside(self, ary, value=np.nan):
+        '''Sets the elements of ary for pairs not in the mask to value.'''
+        for j in lazy_range(ary.shape[1]):
+            ary[~self.column(j, ary.shape[0]), j] = value
+
+    def _job_spec(self, n_rows, n_cols):
+        # (kind, r0, r1, c0, c1, flag, coo_rows, coo_cols): see the kernels
+        raise NotImplementedError
+
+
+class AllPairs(PairMask):
+    '''Estimate every pair.'''
+    is_symmetric = True
+
+    def symmetrized(self):
+        return self
+
+    def column(self, j, n_rows):
+        return np.ones(n_rows, dtype=bool)
+
+    def clear_outside(self, ary, value=np.nan):
+        pass
+
+    def _job_spec(self, n_rows, n_cols):
+        return _JOBS_BLOCK, 0, n_rows, 0, n_cols, False, None, None
+
+
+class UpperTriangle(PairMask):
+    '''Estimate the pairs with i <= j (or i < j, if diagonal is false).'''
+    def __init__(self, diagonal=True):
+        self.diagonal = diagonal
+
+    def check(self, n_rows, n_cols):
+        if n_rows != n_cols:
+            msg = "UpperTriangle needs a square array, not {} x {}"
+            raise ValueError(msg.format(n_rows, n_cols))
+
+    def symmetrized(self):
+        return AllPairs()
+
+    def column(self, j, n_rows):
+        col = np.zeros(n_rows, dtype=bool)
+        col[:j + 1 if self.diagonal else j] = True
+        return col
+
+    def _job_spec(self, n_rows, n_cols):
+        return (_JOBS_TRIANGLE, 0, n_rows, 0, n_cols, self.diagonal,
+                None, None)
+
+
+class BlockMask(PairMask):
+    '''
+    Estimate the pairs with rows[0] <= i < rows[1] and cols[0] <= j < cols[1],
+    as well as the transposed block if symmetric is true.
+    '''
+    def __init__(self, rows, cols, symmetric=False):
+        self.rows = tuple(int(x) for x in rows)
+        self.cols = tuple(int(x) for x in cols)
+        self.symmetric = symmetric
+
+    @property
+    def is_symmetric(self):
+        return self.symmetric or self.rows == self.cols
+
+    def check(self, n_rows, n_cols):
+        for (start, end), n, name in [(self.rows, n_rows, 'rows'),
+                                      (self.cols, n_cols, 'cols')]:
+            if not 0 <= start <= end <= n:
+                msg = "block {} ({}, {}) out of range for {} bags"
+                raise ValueError(msg.format(name, start, end, n))
+        if self.symmetric and n_rows != n_cols:
+            msg = "symmetric BlockMask needs a square array, not {} x {}"
+            raise ValueError(msg.format(n_rows, n_cols))
+
+    def symmetrized(self):
+        if self.is_symmetric:
+            return self
+        return BlockMask(self.rows, self.cols, symmetric=True)
+
+    def column(self, j, n_rows):
+        col = np.zeros(n_rows, dtype=bool)
+        if self.cols[0] <= j < self.cols[1]:
+            col[self.rows[0]:self.rows[1]] = True
+        if self.symmetric and self.rows[0] <= j < self.rows[1]:
+            col[self.cols[0]:self.cols[1]] = True
+        return col
+
+    def _job_spec(self, n_rows, n_cols):
+        return (_JOBS_BLOCK, self.rows[0], self.rows[1],
+                self.cols[0], self.cols[1], self.symmetric, None, None)
+
+
+class SparseMask(PairMask):
+    '''Estimate an explicit list of (rows[k], cols[k]) pairs.'''
+    def __init__(self, rows, cols):
+        self.rows = np.asarray(rows, dtype=np.int32).ravel()
+        self.cols = np.asarray(cols, dtype=np.int32).ravel()
+        if self.rows.shape != self.cols.shape:
+            raise ValueError("rows and cols should be the same length")
+        self._col_order = None
+
+    @classmethod
+    def from_array(cls, mask):
+        return cls(*mask.nonzero())
+
+    def _keys(self, rows, cols):
+        n = max(self.rows.max(), self.cols.max()) + 1 if self.rows.size else 0
+        return np.unique(rows.astype(np.int64) * n + cols)
+
+    @property
+    def is_symmetric(self):
+        return np.array_equal(self._keys(self.rows, self.cols),
+                              self._keys(self.cols, self.rows))
+
+    def check(self, n_rows, n_cols):
+        if self.rows.size and (
+                self.rows.min() < 0 or self.rows.max() >= n_rows or
+                self.cols.min() < 0 or self.cols.max() >= n_cols):
+            msg = "SparseMask has pairs out of range for {} x {} bags"
+            raise ValueError(msg.format(n_rows, n_cols))
+
+    def symmetrized(self):
+        if self.is_symmetric:
+            return self
+        return SparseMask(np.hstack([self.rows, self.cols]),
+                          np.hstack([self.cols, self.rows]))
+
+    def column(self, j, n_rows):
+        if self._col_order is None:
+            self._col_order = np.argsort(self.cols, kind='mergesort')
+            self._sorted_cols = self.cols[self._col_order]
+        start, end = np.searchsorted(self._sorted_cols, [j, j + 1])
+        col = np.zeros(n_rows, dtype=bool)
+        col[self.rows[self._col_order[start:end]]] = True
+        return col
+
+    def _job_spec(self, n_rows, n_cols):
+        return (_JOBS_LIST, 0, n_rows, 0, n_cols, False, self.rows, self.cols)
+
+
+def _as_pair_mask(mask, n_rows, n_cols):
+    if mask is None:
+        return AllPairs()
+    if isinstance(mask, PairMask):
+        mask.check(n_rows, n_cols)
+        return mask
+
+    mask = np.asarray(mask)
+    if mask.shape != (n_rows, n_cols):
+        msg = "mask should be {} x {}, not {}"
+        raise TypeError(msg.format(n_rows, n_cols, mask.shape))
+    elif mask.dtype.kind != 'b':
+        msg = "mask should be a boolean array, not {}"
+        raise TypeError(msg.format(mask.dtype))
+    return SparseMask.from_array(mask)
+
+
+################################################################################
+### Running the meta-estimators on the outputs array
+
+# The number of bags along each side of the tiles that meta-estimators are
+# run on. Beyond the outputs array itself, finalizing needs the per-bag
+# bag_stats plus a few tile-sized temporaries for one meta at a time: about
+# (2 * num_deps + 3) * META_TILE_SIZE ** 2 * num_alphas * num_Ks floats, or
+# around 40MB with the defaults and two Ks.
+META_TILE_SIZE = 1024
+
+
+def _apply_meta(meta, info, out, rhos, other=None, col_rhos=None,
+                tile_size=None):
+    # Runs meta one tile at a time, writing its results into
+    # out[:, :, info.pos, :] in place.
+    #
+    # If other is None, out is square over the bags with within-bag distances
+    # rhos. Otherwise out is from the bags with rhos to those with col_rhos,
+    # and other is the (n_cols, n_rows, ...) array the other way around.
+    if tile_size is None:
+        tile_size = META_TILE_SIZE
+    square = other is None
+    if square:
+        other = out
+        col_rhos = rhos
+    n_rows, n_cols = out.shape[:2]
+
+    needs_T = any(req.needs_transpose for req in meta.needs_results)
+    bag_stats = getattr(meta, 'bag_stats', None)
+    if bag_stats is not None:
+        row_stats = bag_stats(rhos)
+        col_stats = row_stats if square else bag_stats(col_rhos)
+
+    for r0 in lazy_range(0, n_rows, tile_size):
+        r1 = min(r0 + tile_size, n_rows)
+        for c0 in lazy_range(0, n_cols, tile_size):
+            c1 = min(c0 + tile_size, n_cols)
+
+            required = [out[r0:r1, c0:c1, [i], :] for i in info.deps]
+            kwargs = {}
+            if bag_stats is not None:
+                kwargs['row_stats'] = row_stats[r0:r1]
+
+            # tiles on the diagonal are themselves square; the rest are
+            # treated like divergences between two different sets of bags
+            if needs_T and not (square and r0 == c0):
+                kwargs['col_rhos'] = col_rhos[c0:c1]
+                kwargs['transposed'] = [
+                    other[c0:c1, r0:r1, [i], :].transpose(1, 0, 2, 3)
+                    for i in info.deps]
+                if bag_stats is not None:
+                    kwargs['col_stats'] = col_stats[c0:c1]
+
+            r = meta(rhos[r0:r1], required, **kwargs)
+            if r.ndim == 3:
+                r = r[:, :, np.newaxis, :]
+            out[r0:r1, c0:c1, info.pos, :] = r
+
+
+def _drop_meta_only(out, n_meta_only):
+    # Drops the last n_meta_only entries of out's third axis. Rather than
+    # making a contiguous copy, moves the data down within out's own buffer
+    # one row at a time and then shrinks it, so only a row's worth of extra
+    # memory is needed.
+    n_rows, n_cols, n_funcs, n_Ks = out.shape
+    keep = n_funcs - n_meta_only
+    if not (out.flags.c_contiguous and out.flags.owndata):
+        return np.ascontiguousarray(out[:, :, :keep, :])
+
+    flat = out.reshape(-1)
+    row_size = n_cols * keep * n_Ks
+    for i in lazy_range(n_rows):
+        flat[i * row_size:(i + 1) * row_size] = out[i, :, :keep, :].ravel()
+    del flat
+    out.resize((n_rows, n_cols, keep, n_Ks), refcheck=False)
+    return out
+
+
 ################################################################################
 ### The main dealio
 
 class _DivEstimator(object):
     def __init__(self, features, mask=None, specs=['kl'], Ks=[3],
                  cores=None, algorithm=None, min_dist=None,
-                 status_fn=True, progressbar=None, **flann_args):
+                 status_fn=True, progressbar=None, progress_callback=None,
+                 knn_store=None, knn_max_K=None, **flann_args):
         if progressbar is None:
             progressbar = status_fn is True
         self.status_fn = status_fn = get_status_fn(status_fn)
         self.progressbar = progressbar
+        self.progress_callback = progress_callback
 
         if not isinstance(features, Features):
             raise TypeError("features should be a Features instance")
@@ -775,31 +1265,39 @@ class _DivEstimator(object):
         dim = features.dim
         self.features = features
 
-        if mask is None:
-            mask = np.ones((n_bags, n_bags), dtype=bool)
-        else:
-            mask = np.asarray(mask)
-            if mask.shape != (n_bags, n_bags):
-                msg = "mask should be n x n, not {}"
-                raise TypeError(msg.format(mask.shape))
-            elif mask.dtype.kind != 'b':
-                msg = "mask should be a boolean array, not {}"
-                raise TypeError(msg.format(mask.dtype))
-        self.mask = mask
-
+        self.mask = _as_pair_mask(mask, n_bags, n_bags)
+
+        self._setup(features._n_pts, dim, specs=specs, Ks=Ks, cores=cores,
+                    algorithm=algorithm, min_dist=min_dist, **flann_args)
+
+        self.knn_store = knn_store
+        if knn_max_K is not None:
+            if knn_max_K < self.max_K:
+                msg = "knn_max_K is {}, but these specs need K = {}"
+                raise ValueError(msg.format(knn_max_K, self.max_K))
+            if knn_max_K >= features._n_pts.min():
+                msg = "knn_max_K = {}, but there's a bag with only {} points"
+                raise ValueError(msg.format(knn_max_K, features._n_pts.min()))
+            # search for (and store) more neighbors than the estimators use
+            self.knn_max_K = knn_max_K
+        status_fn('kNN processing: K = {} on {!r}'.format(self.knn_max_K,
+                                                          features))
+
+    def _setup(self, n_pts, dim, specs, Ks, cores, algorithm, min_dist,
+               **flann_args):
         self.Ks = Ks = np.array(np.squeeze(Ks), ndmin=1, dtype=np.int32)
         if Ks.ndim != 1:
             msg = "Ks should be 1-dim, got shape {}"
             raise TypeError(msg.format(Ks.shape))
         if Ks.min() < 1:
             raise ValueError("Ks should be positive; got {}".format(Ks.min()))
-        if Ks.max() >= features._n_pts.min():
+        if Ks.max() >= n_pts.min():
             msg = "asked for K = {}, but there's a bag with only {} points"
-            raise ValueError(msg.format(Ks.max(), features._n_pts.min()))
+            raise ValueError(msg.format(Ks.max(), n_pts.min()))
         self.max_K = Ks.max()
 
         self.funcs, self.metas, self.n_meta_only = \
-                _parse_specs(specs, Ks, dim, features._n_pts)
+                _parse_specs(specs, Ks, dim, n_pts)
         self.specs = specs
 
         self.save_all_Ks = False
@@ -810,6 +1308,7 @@ class _DivEstimator(object):
                 # TODO: could be more efficient about this
                 # eg if we need [1, 2, ..., 5] and 20, no need to save 6 to 19
                 # (but that won't happen with the current estimators)
+        self.knn_max_K = self.max_K
 
         if cores is None:
             from multiprocessing import cpu_count
@@ -831,8 +1330,6 @@ class _DivEstimator(object):
             min_dist = default_min_dist(dim)
         self.min_dist = min_dist
 
-        status_fn('kNN processing: K = {} on {!r}'.format(self.max_K, features))
-
     def full_est(self):
         self.build_indices()
         self.get_rhos()
@@ -842,6 +1339,9 @@ class _DivEstimator(object):
 
     def build_indices(self):
         self.status_fn('Building indices...')
+        self.indices = self._build_indices(self.features)
+
+    def _build_indices(self, features):
         # Build indices for each bag. Do this one-at-a-time for now.
         # TODO: should probably multithread this
         def _make_index(bag):
@@ -850,26 +1350,33 @@ class _DivEstimator(object):
             return idx
 
         pbar = progress() if self.progressbar else identity
-        self.indices = [_make_index(b) for b in pbar(self.features.features)]
+        indices = [_make_index(b) for b in pbar(features.features)]
         if self.progressbar:
             pbar.finish()
+        return indices
 
     def get_rhos(self):
         self.status_fn('\nGetting within-bag distances...')
-        # need to throw away the closet neighbor, which will always be self
-        # this means that K=1 corresponds to column 1 in the array
-        which_Ks = slice(1, None) if self.save_all_Ks else self.Ks
-        max_K = self.max_K
-        min_dist = self.min_dist
-        maximum = np.maximum
-        pbar = progress() if self.progressbar else identity
-
-        self.rhos = [
-            maximum(min_dist,
-                    np.sqrt(idx.nn_index(bag, max_K + 1)[1][:, which_Ks]))
-            for bag, idx in izip(self.features.features, pbar(self.indices))]
-        if self.progressbar:
-            pbar.finish()
+        self.rho_sq_dists = [] if self.knn_store is not None else None
+        self.rhos = self._get_rhos(self.features, self.indices,
+                                   sq_dists_out=self.rho_sq_dists)
+        self.log_rhos = _rho_logs(self._rhos_for_metas(self.rhos))
+
+    def _get_rhos(self, features, indices, sq_dists_out=None):
+        # the search leaves out each point itself, so K=1 is column 0
+        which_Ks = slice(None, self.max_K) if self.save_all_Ks \
+            else self.Ks - 1
+        sq_dists = _within_bag_sq_dists(features, indices, self.knn_max_K,
+                                        self.flann_args['cores'])
+        if sq_dists_out is not None:
+            sq_dists_out.append(sq_dists)
+        rhos = np.maximum(self.min_dist, np.sqrt(sq_dists[:, which_Ks]))
+        return np.split(rhos, features._boundaries[1:-1])
+
+    def _rhos_for_metas(self, rhos):
+        if self.save_all_Ks:
+            return [rho[:, self.Ks - 1] for rho in rhos]
+        return rhos
 
     def get_cross_divs(self):
         self.status_fn('\nGetting cross-bag distances and divergences...')
@@ -877,38 +1384,135 @@ class _DivEstimator(object):
         # with the transpose; we'll nan out the unnecessary bits later.
         # TODO: only compute the things we need transposed...
         mask = self.mask
-        self.should_mask = False
         if any(req.needs_transpose for f in self.metas
                                    for req in f.needs_results):
-            if np.any(mask != mask.T):
-                mask = mask + mask.T
-                self.should_mask = True
+            mask = mask.symmetrized()
+
+        if self.knn_store is None:
+            knn_out = None
+        else:
+            # the kernel writes the distances straight into the store
+            self.status_fn('\nSaving kNN distances to {}...'.format(
+                self.knn_store))
+            nu_sq_dists, index = create_knn_store(
+                self.knn_store, self.features, np.vstack(self.rho_sq_dists),
+                mask, self.knn_max_K)
+            knn_out = (nu_sq_dists,) + index
 
         self.outputs = _estimate_cross_divs(
             self.features, self.indices, self.rhos,
-            mask.view(np.uint8), self.funcs,
+            mask, self.funcs,
             self.Ks, self.max_K, self.save_all_Ks,
             self.specs, self.n_meta_only,
-            self.progressbar, self.flann_args['cores'], self.min_dist)
+            self._pair_progress(), self.flann_args['cores'], self.min_dist,
+            log_rhos=self.log_rhos, knn_out=knn_out)
+
+        if knn_out is not None:
+            if isinstance(nu_sq_dists, np.memmap):
+                nu_sq_dists.flush()
+            del knn_out, nu_sq_dists
+
+    def _pair_progress(self):
+        # the progress(done, total, rate) function the kernels report to
+        fns = []
+        if self.progressbar:
+            fns.append(progressbar_callback())
+        if self.progress_callback is not None:
+            fns.append(self.progress_callback)
+        if not fns:
+            return None
+
+        def progress(done, total, rate):
+            for fn in fns:
+                fn(done, total, rate)
+        return progress
 
     def finalize(self):
-        if self.save_all_Ks:
-            rhos = [rho[:, self.Ks - 1] for rho in self.rhos]
-        else:
-            rhos = self.rhos
+        rhos = self._rhos_for_metas(self.rhos)
         for meta, info in iteritems(self.metas):
-            required = [self.outputs[:, :, [i], :] for i in info.deps]
-            r = meta(rhos, required)
-            if r.ndim == 3:
-                r = r[:, :, np.newaxis, :]
-            self.outputs[:, :, info.pos, :] = r
+            _apply_meta(meta, info, self.outputs, rhos)
 
         if self.n_meta_only:
-            self.outputs = np.ascontiguousarray(
-                self.outputs[:, :, :-self.n_meta_only, :])
+            self.outputs = _drop_meta_only(self.outputs, self.n_meta_only)
 
-        if self.should_mask:
-            self.outputs[~self.mask] = np.nan
+        # metas can fill in pairs we didn't estimate (or only estimated for
+        # the sake of their transposes), so clear those out
+        self.mask.clear_outside(self.outputs)
+
+
+class _CrossDivEstimator(_DivEstimator):
+    '''
+    Estimates divergences between each bag in X and each bag in Y, in both
+    directions, without ever making (n_x + n_y)^2 masks or outputs.
+    self.outputs ends up as a pair: the (n_x, n_y, ...) array of
+    D(X[i] || Y[j]) and the (n_y, n_x, ...) array of D(Y[j] || X[i]).
+    '''
+    def __init__(self, X, Y, specs=['kl'], Ks=[3],
+                 cores=None, algorithm=None, min_dist=None,
+                 status_fn=True, progressbar=None, progress_callback=None,
+                 **flann_args):
+        if progressbar is None:
+            progressbar = status_fn is True
+        self.status_fn = status_fn = get_status_fn(status_fn)
+        self.progressbar = progressbar
+        self.progress_callback = progress_callback
+
+        if not isinstance(X, Features) or not isinstance(Y, Features):
+            raise TypeError("X and Y should be Features instances")
+        if X.dim != Y.dim:
+            msg = "X has dimension {}, but Y has {}"
+            raise ValueError(msg.format(X.dim, Y.dim))
+        self.features = X
+        self.Y = Y
+
+        self._setup(np.hstack([X._n_pts, Y._n_pts]), X.dim,
+                    specs=specs, Ks=Ks, cores=cores, algorithm=algorithm,
+                    min_dist=min_dist, **flann_args)
+        status_fn('kNN processing: K = {} from {!r} to {!r}'.format(
+            self.max_K, X, Y))
+
+    def build_indices(self):
+        self.status_fn('Building indices...')
+        self.indices = self._build_indices(self.features)
+        self.Y_indices = self._build_indices(self.Y)
+
+    def get_rhos(self):
+        self.status_fn('\nGetting within-bag distances...')
+        self.rhos = self._get_rhos(self.features, self.indices)
+        self.Y_rhos = self._get_rhos(self.Y, self.Y_indices)
+        self.log_rhos = _rho_logs(self._rhos_for_metas(self.rhos))
+        self.Y_log_rhos = _rho_logs(self._rhos_for_metas(self.Y_rhos))
+
+    def get_cross_divs(self):
+        self.status_fn('\nGetting cross-bag distances and divergences...')
+        est = partial(_estimate_cross_divs, funcs=self.funcs,
+                      Ks=self.Ks, max_K=self.max_K,
+                      save_all_Ks=self.save_all_Ks, specs=self.specs,
+                      n_meta_only=self.n_meta_only,
+                      progress=self._pair_progress(),
+                      cores=self.flann_args['cores'], min_dist=self.min_dist)
+        self.outputs = (
+            est(self.features, self.indices, self.rhos, None,
+                col_features=self.Y, col_indices=self.Y_indices,
+                log_rhos=self.log_rhos),
+            est(self.Y, self.Y_indices, self.Y_rhos, None,
+                col_features=self.features, col_indices=self.indices,
+                log_rhos=self.Y_log_rhos),
+        )
+
+    def finalize(self):
+        X_rhos = self._rhos_for_metas(self.rhos)
+        Y_rhos = self._rhos_for_metas(self.Y_rhos)
+        fwd, bwd = self.outputs
+
+        for meta, info in iteritems(self.metas):
+            _apply_meta(meta, info, fwd, X_rhos, other=bwd, col_rhos=Y_rhos)
+            _apply_meta(meta, info, bwd, Y_rhos, other=fwd, col_rhos=X_rhos)
+
+        if self.n_meta_only:
+            fwd, bwd = [_drop_meta_only(o, self.n_meta_only)
+                        for o in (fwd, bwd)]
+        self.outputs = fwd, bwd
 
 
 def estimate_divs(features,
@@ -918,7 +1522,8 @@ def estimate_divs(features,
                   cores=None,
                   algorithm=None,
                   min_dist=None,
-                  status_fn=True, progressbar=None,
+                  status_fn=True, progressbar=None, progress_callback=None,
+                  knn_store=None, knn_max_K=None,
                   return_opts=False,
                   **flann_args):
     '''
@@ -927,8 +1532,10 @@ def estimate_divs(features,
     Parameters:
         features: a Features instance containing n bags of features.
         mask (optional): an n x n boolean array indicating whether to
-                         estimate each div pair. Any not estimated are returned
-                         as nan in the output. Default: estimate all.
+                         estimate each div pair, or a PairMask such as
+                         UpperTriangle() or BlockMask(rows, cols) describing
+                         them without needing the array. Any not estimated
+                         are returned as nan in the output. Default: all.
         specs: a list of strings of divergence specs. TODO: document
         Ks: a list of K values to estimate the divergences with.
             Note that if you're estimating Jensen differences, we use the K
@@ -947,6 +1554,20 @@ def estimate_divs(features,
         status_fn: a function to print out status messages.
                    None means don't print any; True prints to stderr.
         progressbar: show a progress bar on stderr. Default: (status_fn is True)
+        progress_callback: a function called as
+                           progress_callback(done, total, rate) with the
+                           number of pairs estimated so far, the number to
+                           estimate, and the pairs per second, a few times a
+                           second while the cross-bag divergences are
+                           estimated. Useful for reporting progress somewhere
+                           other than a terminal.
+        knn_store: a filename to save the nearest-neighbor distances to, so
+                   that recompute_divs() can estimate other specs and Ks
+                   without searching again. The store takes knn_max_K
+                   floats for each point, and for each point and other bag
+                   it's estimated against.
+        knn_max_K: the number of neighbors to search for and save.
+                   Default: the largest needed for these specs and Ks.
         return_opts: return a dictionary of options used as the second value.
         other options: passed along to FLANN for nearest-neighbor searches
 
@@ -954,23 +1575,716 @@ def estimate_divs(features,
     value is the estimate of D(features[i] || features[j]) with specs[k] using
     Ks[l].
     '''
-    # TODO: document how progressbar works
-    # TODO: other kinds of callbacks for showing progress bars
     est = _DivEstimator(features=features, mask=mask, specs=specs, Ks=Ks,
                         cores=cores, algorithm=algorithm, min_dist=min_dist,
                         status_fn=status_fn, progressbar=progressbar,
+                        progress_callback=progress_callback,
+                        knn_store=knn_store, knn_max_K=knn_max_K,
                         **flann_args)
     return est.full_est()
 
 
+def estimate_cross_divs(X, Y,
+                        specs=['kl'],
+                        Ks=[3],
+                        cores=None,
+                        algorithm=None,
+                        min_dist=None,
+                        status_fn=True, progressbar=None,
+                        progress_callback=None,
+                        **flann_args):
+    '''
+    Gets the divergences between each bag in X and each bag in Y, in both
+    directions; divergences within X or within Y aren't computed. This is
+    what you want for e.g. comparing test bags to training bags.
+
+    Parameters:
+        X: a Features instance containing n_x bags of features.
+        Y: a Features instance containing n_y bags of the same dimension.
+        other options: as in estimate_divs(). progress_callback is called
+                       for each direction separately.
+
+    Returns (forward, backward), where forward is the
+    (n_x, n_y, num_specs, num_Ks) array of D(X[i] || Y[j]) and backward is
+    the (n_y, n_x, num_specs, num_Ks) array of D(Y[j] || X[i]). These agree
+    with the corresponding blocks of estimate_divs() on the stacked bags.
+    '''
+    est = _CrossDivEstimator(X, Y, specs=specs, Ks=Ks,
+                             cores=cores, algorithm=algorithm,
+                             min_dist=min_dist, status_fn=status_fn,
+                             progressbar=progressbar,
+                             progress_callback=progress_callback,
+                             **flann_args)
+    return est.full_est()
+
+
 ################################################################################
-### Command line interface
+### Per-bag entropies, from the same within-bag distances.
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Compute divergences and set kernels based on "
-                    "KNN statistics.")
+class _EntropyEstimator(_DivEstimator):
+    '''
+    Estimates the Renyi-alpha entropy of each bag from its within-bag kNN
+    distances; there aren't any searches between bags.
+    '''
+    def __init__(self, features, alphas=[1], Ks=[3],
+                 cores=None, algorithm=None, min_dist=None,
+                 status_fn=True, progressbar=None, **flann_args):
+        if progressbar is None:
+            progressbar = status_fn is True
+        self.status_fn = status_fn = get_status_fn(status_fn)
+        self.progressbar = progressbar
+
+        if not isinstance(features, Features):
+            raise TypeError("features should be a Features instance")
+        self.features = features
+        self.dim = features.dim
+
+        self.alphas = alphas = np.array(np.squeeze(alphas), ndmin=1,
+                                        dtype=float)
+        if alphas.ndim != 1:
+            msg = "alphas should be 1-dim, got shape {}"
+            raise TypeError(msg.format(alphas.shape))
+
+        self._setup(features._n_pts, features.dim, specs=[], Ks=Ks,
+                    cores=cores, algorithm=algorithm, min_dist=min_dist,
+                    **flann_args)
+        if alphas.min() <= 0 or alphas.max() >= self.Ks.min() + 1:
+            msg = "need 0 < alpha < K + 1 = {}; got alphas {}"
+            raise ValueError(msg.format(self.Ks.min() + 1, alphas))
+        status_fn('kNN processing: K = {} on {!r}'.format(self.max_K, features))
+
+    def full_est(self):
+        self.build_indices()
+        self.get_rhos()
+        self.get_entropies()
+        return self.outputs
+
+    def get_rhos(self):
+        self.status_fn('\nGetting within-bag distances...')
+        self.rhos = self._get_rhos(self.features, self.indices)
+
+    def get_entropies(self):
+        self.status_fn('Estimating entropies...')
+        Ks = self.Ks
+        dim = self.dim
+        alphas = self.alphas
+
+        # log of the volume of the unit ball
+        log_c = dim / 2 * np.log(np.pi) - gammaln(dim / 2 + 1)
+
+        self.outputs = ents = np.empty(
+            (len(self.rhos), alphas.size, Ks.size), dtype=np.float32)
+
+        shannon = alphas == 1
+        if shannon.any():
+            # log(n - 1) - digamma(K) + d * mean(log rho_K), as in
+            # jensen_shannon
+            bits = _jensen_shannon_bag_stats(Ks, dim, self.rhos)
+            ents[:, shannon, :] = (log_c - psi(Ks) + bits)[:, np.newaxis, :]
+
+        if not shannon.all():
+            renyi_alphas = alphas[~shannon]
+            logs = _renyi_integral_logs(renyi_alphas, Ks, dim, self.rhos)
+            ents[:, ~shannon, :] = \
+                log_c + logs / (1 - renyi_alphas)[:, np.newaxis]
+
+
+def estimate_entropies(features,
+                       alphas=[1],
+                       Ks=[3],
+                       cores=None,
+                       algorithm=None,
+                       min_dist=None,
+                       status_fn=True, progressbar=None,
+                       **flann_args):
+    '''
+    Estimates the Renyi-alpha entropy of each bag,
+        1/(1 - alpha) log \int p^alpha,
+    or the Shannon entropy for alpha = 1, from the distances to each point's
+    Kth nearest neighbor in the same bag. The within-bag searches are the
+    same ones estimate_divs() does, run on all the bags in parallel; each K
+    and alpha then takes a few array operations over all the bags at once.
+
+    Parameters:
+        features: a Features instance containing n bags of features.
+        alphas: the alpha values to use, each 0 < alpha < min(Ks) + 1;
+                1 means the Shannon entropy. Default: [1].
+        Ks: the K values to use.
+        other options: as in estimate_divs().
+
+    Returns an array of shape (n, num_alphas, num_Ks).
+    '''
+    est = _EntropyEstimator(features, alphas=alphas, Ks=Ks,
+                            cores=cores, algorithm=algorithm,
+                            min_dist=min_dist, status_fn=status_fn,
+                            progressbar=progressbar, **flann_args)
+    return est.full_est()
+
+
+################################################################################
+### Saving kNN distances to estimate other divergences from later.
+#
+# All the estimators are functions of the rho and nu distances, so
+# estimate_divs(knn_store=...) can save those to an HDF5 file:
+#
+#   _meta/dim, _meta/max_K      the dimension, and the number of neighbors kept
+#   _meta/n_pts                 the number of points in each bag
+#   _meta/names, _meta/cats     as in the divergence cache files
+#   rho_sq_dists                (total_pts, max_K): the squared distance from
+#                               each point to its K nearest other points in
+#                               its own bag, for K = 1 to max_K
+#   pair_col_ptr, pair_rows     the pairs (i, j) that are stored, column by
+#                               column: column j's are the rows
+#                               pair_rows[pair_col_ptr[j]:pair_col_ptr[j + 1]],
+#                               in increasing order
+#   nu_sq_dists                 (stored_pts, max_K): for each stored pair in
+#                               that order, the n_pts[i] rows of squared
+#                               distances from bag i's points to their
+#                               (k + 1)th nearest neighbors in bag j. Diagonal
+#                               pairs are stored without any rows, since their
+#                               estimates only need rho_sq_dists.
+#
+# so the store only takes space for the pairs that were estimated.
+# recompute_divs() then estimates any specs and Ks (up to max_K) from those.
+
+def _knn_store_index(mask, n_pts):
+    '''
+    Lays out a kNN store's nu_sq_dists for the pairs in mask (a PairMask over
+    bags with n_pts points each), without making the whole mask. Returns
+    (col_ptr, rows, offsets), where column j's pairs have the rows
+    rows[col_ptr[j]:col_ptr[j + 1]], and the kth pair's distances are rows
+    offsets[k] to offsets[k + 1] of nu_sq_dists.
+    '''
+    n = len(n_pts)
+    col_ptr = np.zeros(n + 1, dtype=np.int64)
+    rows = [np.empty(0, dtype=np.int32)]
+    for j in lazy_range(n):
+        col_rows = mask.column(j, n).nonzero()[0].astype(np.int32)
+        rows.append(col_rows)
+        col_ptr[j + 1] = col_ptr[j] + col_rows.size
+    rows = np.hstack(rows)
+
+    cols = np.repeat(np.arange(n, dtype=np.int32), np.diff(col_ptr))
+    lengths = np.where(rows == cols, 0, np.asarray(n_pts)[rows])
+    offsets = np.zeros(rows.size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return col_ptr, rows, offsets
+
+
+def create_knn_store(filename, features, rho_sq_dists, mask, max_K):
+    '''
+    Starts a kNN distance store (see above) for the pairs in mask (a
+    PairMask) of features in filename, replacing it if it exists.
+
+    Returns (nu_sq_dists, index): nu_sq_dists is a writable memory map of the
+    store's (uninitialized) nu_sq_dists, and index is _knn_store_index() of
+    mask, saying where each pair's distances go.
+    '''
+    import h5py
+    col_ptr, rows, offsets = index = _knn_store_index(mask, features._n_pts)
+    shape = (int(offsets[-1]), max_K)
+
+    with h5py.File(filename, 'w') as f:
+        meta = f.create_group('_meta')
+        meta['dim'] = features.dim
+        meta['max_K'] = max_K
+        meta['n_pts'] = features._n_pts
+        reconcile_file_order(f, names=features.names,
+                             cats=features.categories, write=True)
+
+        f.create_dataset('rho_sq_dists', data=rho_sq_dists, dtype=np.float32)
+        f['pair_col_ptr'] = col_ptr
+        f['pair_rows'] = rows
+
+        # contiguous and allocated now, so the kernel can write straight
+        # into the file instead of into a scratch copy
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+        dcpl.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
+        nus = h5py.h5d.create(f.id, b'nu_sq_dists', h5py.h5t.NATIVE_FLOAT,
+                              h5py.h5s.create_simple(shape), dcpl=dcpl)
+        offset = nus.get_offset()
+
+    if offset is None:  # nothing to store
+        return np.empty(shape, dtype=np.float32), index
+    nu_sq_dists = np.memmap(filename, dtype=np.float32, mode='r+',
+                            offset=offset, shape=shape)
+    return nu_sq_dists, index
+
+
+class _StoredDivEstimator(_DivEstimator):
+    '''
+    Estimates divergences from a store written by estimate_divs(knn_store=...),
+    without any nearest-neighbor searches.
+    '''
+    def __init__(self, store, specs=['kl'], Ks=[3], cores=None, min_dist=None,
+                 status_fn=True, progressbar=None, progress_callback=None):
+        if progressbar is None:
+            progressbar = status_fn is True
+        self.status_fn = get_status_fn(status_fn)
+        self.progressbar = progressbar
+        self.progress_callback = progress_callback
+
+        self.store = store
+        meta = store['_meta']
+        self.dim = dim = int(meta['dim'][()])
+        stored_K = int(meta['max_K'][()])
+        self.n_pts = n_pts = meta['n_pts'][()]
+        self.boundaries = np.hstack([[0], np.cumsum(n_pts)])
+
+        self._setup(n_pts, dim, specs=specs, Ks=Ks, cores=cores,
+                    algorithm=None, min_dist=min_dist)
+        if self.max_K > stored_K:
+            msg = "need K = {}, but the store only has up to K = {}"
+            raise ValueError(msg.format(self.max_K, stored_K))
+
+        self.col_ptr = col_ptr = store['pair_col_ptr'][()]
+        self.pair_rows = rows = store['pair_rows'][()]
+        cols = np.repeat(np.arange(len(n_pts)), np.diff(col_ptr))
+        self.mask = SparseMask(rows, cols)
+        lengths = np.where(rows == cols, 0, n_pts[rows])
+        self.offsets = np.zeros(rows.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.knn_store = None
+
+    def build_indices(self):
+        pass
+
+    def get_rhos(self):
+        self.status_fn('Loading within-bag distances...')
+        which_Ks = slice(None, self.max_K) if self.save_all_Ks \
+            else self.Ks - 1
+        sq_dists = self.store['rho_sq_dists'][()]
+        b = self.boundaries
+        self.rhos = [
+            np.maximum(self.min_dist, np.sqrt(sq_dists[s:e, which_Ks]))
+            for s, e in izip(b[:-1], b[1:])]
+
+    def get_cross_divs(self):
+        self.status_fn('Estimating divergences from stored distances...')
+        nus = self.store['nu_sq_dists']
+        if _can_mmap(nus, np.float32):
+            nus = np.memmap(self.store.file.filename, mode='r',
+                            dtype=np.float32, offset=nus.id.get_offset(),
+                            shape=nus.shape)
+        else:
+            nus = nus[()]
+
+        self.outputs = _divs_from_knn_store(
+            self.boundaries, self.n_pts, self.dim, self.rhos, self.mask,
+            self.funcs, self.Ks, self.max_K, self.save_all_Ks, self.specs,
+            self.n_meta_only, self._pair_progress(), self.flann_args['cores'],
+            self.min_dist, (nus, self.col_ptr, self.pair_rows, self.offsets))
+
+
+def recompute_divs(store, specs=['kl'], Ks=[3], cores=None, min_dist=None,
+                   status_fn=True, progressbar=None, progress_callback=None):
+    '''
+    Estimates divergences from the kNN distances saved by
+    estimate_divs(knn_store=...), without searching for neighbors again.
+
+    Parameters:
+        store: the filename of the store, or an open h5py File or Group.
+        specs, Ks: as in estimate_divs(). The Ks needed can't be more than
+                   the store's max_K (the knn_max_K it was saved with).
+        cores: number of threads to use. None uses all cores on the machine.
+        min_dist: the minimum distance to use. Can differ from the one used
+                  when saving. Default: default_min_dist(dim).
+        other options: as in estimate_divs().
+
+    Returns an array of shape (n, n, num_specs, num_Ks), as from
+    estimate_divs(). Pairs that aren't in the store are nan.
+    '''
+    if isinstance(store, str_types):
+        import h5py
+        with h5py.File(store, 'r') as f:
+            return recompute_divs(f, specs=specs, Ks=Ks, cores=cores,
+                                  min_dist=min_dist, status_fn=status_fn,
+                                  progressbar=progressbar,
+                                  progress_callback=progress_callback)
+
+    est = _StoredDivEstimator(store, specs=specs, Ks=Ks, cores=cores,
+                              min_dist=min_dist, status_fn=status_fn,
+                              progressbar=progressbar,
+                              progress_callback=progress_callback)
+    return est.full_est()
+
+
+def block_bounds(n, n_blocks):
+    '''
+    Splits range(n) into n_blocks contiguous, nearly equal-sized blocks.
+    Returns a list of (start, end) pairs.
+    '''
+    if not 1 <= n_blocks <= n:
+        msg = "need between 1 and {} blocks, got {}"
+        raise ValueError(msg.format(n, n_blocks))
+    edges = np.linspace(0, n, n_blocks + 1).round().astype(int)
+    return list(izip(edges[:-1], edges[1:]))
+
+
+def block_pairs(n_blocks):
+    '''
+    The (i, j) block pairs, i <= j, needed to cover an n_blocks x n_blocks
+    grid: estimate_divs_block() computes (i, j) and (j, i) together.
+    '''
+    return [(i, j) for i in lazy_range(n_blocks)
+                   for j in lazy_range(i, n_blocks)]
+
+
+def estimate_divs_block(features, rows, cols, **kwargs):
+    '''
+    Estimates the divergences between the bags in rows and those in cols, in
+    both directions, building indices only for the bags involved.
+
+    Parameters:
+        features: a Features instance containing n bags of features.
+        rows, cols: (start, end) pairs of bag indices, as from block_bounds().
+        other options: passed along to estimate_divs(). min_dist should be
+                       given explicitly if it shouldn't depend on the block.
+
+    Returns (forward, backward), where forward is the
+    (n_rows, n_cols, num_specs, num_Ks) array of D(rows[i] || cols[j]) and
+    backward is the (n_cols, n_rows, num_specs, num_Ks) array of
+    D(cols[j] || rows[i]). Together with the rest of the blocks, these tile
+    the output of estimate_divs(features).
+    '''
+    row_idx = np.arange(*rows)
+    col_idx = np.arange(*cols)
+    if np.intersect1d(row_idx, col_idx).size == 0:
+        return estimate_cross_divs(features[row_idx], features[col_idx],
+                                   **kwargs)
 
+    which = np.union1d(row_idx, col_idx)
+    row_pos = np.searchsorted(which, row_idx)
+    col_pos = np.searchsorted(which, col_idx)
+
+    mask = np.zeros((which.size, which.size), dtype=bool)
+    mask[np.ix_(row_pos, col_pos)] = True
+    mask[np.ix_(col_pos, row_pos)] = True
+
+    divs = estimate_divs(features[which], mask=mask, **kwargs)
+    return divs[np.ix_(row_pos, col_pos)], divs[np.ix_(col_pos, row_pos)]
+
+
+################################################################################
+### Splitting the work into tiles for several machines.
+#
+# Everything happens in a "tile directory" on a filesystem shared by all the
+# workers (by default, the output filename plus '.tiles'):
+#
+#   job.json        the settings for the job, written by the coordinator
+#   I-of-N.claim    created (O_EXCL) by the worker computing tile I; its mtime
+#                   is refreshed while the worker is alive, and the
+#                   coordinator deletes claims that go stale so that another
+#                   worker can pick the tile up
+#   I-of-N.npz      the finished tile, renamed into place once complete
+#
+# Tile I of N is a set of block pairs, as in estimate_divs_block(); the
+# coordinator merges all the tiles into the full divergence array.
+
+DEFAULT_CLAIM_TIMEOUT = 300
+DEFAULT_POLL_INTERVAL = 5
+
+
+def tile_block_pairs(n_tiles, n_bags):
+    '''
+    Splits the block pairs for n_bags bags into n_tiles tiles.
+
+    Returns n_blocks and a list of the block pairs in each tile.
+    '''
+    n_blocks = 1
+    while n_blocks * (n_blocks + 1) // 2 < n_tiles:
+        n_blocks += 1
+    if n_blocks > n_bags:
+        msg = "can't split {} bags into {} tiles"
+        raise ValueError(msg.format(n_bags, n_tiles))
+    pairs = block_pairs(n_blocks)
+    return n_blocks, [pairs[i::n_tiles] for i in lazy_range(n_tiles)]
+
+
+def _tile_path(tile_dir, tile, n_tiles, ext):
+    return os.path.join(tile_dir, '{}-of-{}.{}'.format(tile, n_tiles, ext))
+
+
+def compute_tile(features, tile_dir, tile, n_tiles, specs=['kl'], Ks=[3],
+                 min_dist=None, status_fn=True, **kwargs):
+    '''
+    Computes tile number tile (0-based) of n_tiles, and saves it into
+    tile_dir, which should already exist. Other arguments are as for
+    estimate_divs().
+
+    Returns whether the tile was saved: if tile_dir is gone by the time it's
+    done, the job was finished without it, and it's thrown away.
+    '''
+    status_fn = get_status_fn(status_fn)
+    if min_dist is None:
+        min_dist = default_min_dist(features.dim)
+
+    n_blocks, tiles = tile_block_pairs(n_tiles, len(features))
+    bounds = block_bounds(len(features), n_blocks)
+
+    starts = []
+    blocks = {}
+    for i, j in tiles[tile]:
+        status_fn("Tile {} of {}: block ({}, {})".format(tile, n_tiles, i, j))
+        rows, cols = bounds[i], bounds[j]
+        fwd, bwd = estimate_divs_block(
+            features, rows, cols, specs=specs, Ks=Ks, min_dist=min_dist,
+            status_fn=None, progressbar=False, **kwargs)
+        blocks['block_{}'.format(len(starts))] = fwd
+        starts.append((rows[0], cols[0]))
+        if i != j:
+            blocks['block_{}'.format(len(starts))] = bwd
+            starts.append((cols[0], rows[0]))
+
+    # write somewhere private, then rename so readers never see a partial
+    # file; don't recreate tile_dir if the coordinator's removed it
+    path = _tile_path(tile_dir, tile, n_tiles, 'npz')
+    tmp_path = '{}.tmp-{}-{}'.format(path, socket.gethostname(), os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, starts=np.array(starts, dtype=np.int64).reshape(-1, 2),
+                     specs=np.array(strict_map(normalize_div_name, specs)),
+                     Ks=np.asarray(Ks), min_dist=min_dist, **blocks)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT or os.path.isdir(tile_dir):
+            raise
+        return False
+    return True
+
+
+def _try_claim(path):
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno in (errno.EEXIST, errno.ENOENT):
+            return False
+        raise
+    with os.fdopen(fd, 'w') as f:
+        f.write('{}:{}\n'.format(socket.gethostname(), os.getpid()))
+    return True
+
+
+@contextmanager
+def _heartbeat(path, interval):
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                os.utime(path, None)
+            except OSError:  # the coordinator gave up on us; oh well
+                pass
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _read_job(tile_dir, missing_ok=False):
+    # with missing_ok, returns None if there's no job (any more)
+    try:
+        f = open(os.path.join(tile_dir, 'job.json'))
+    except IOError as e:
+        if missing_ok and e.errno == errno.ENOENT:
+            return None
+        raise
+    with f:
+        return json.load(f)
+
+
+def work_on_tiles(features, tile_dir, cores=None, status_fn=True,
+                  poll_interval=DEFAULT_POLL_INTERVAL):
+    '''
+    Claims and computes tiles of the job in tile_dir until they're all done.
+    The job must already have been set up by coordinate_tiles().
+
+    Returns the number of tiles this worker computed: 0 if the job has
+    already finished and been cleaned up.
+    '''
+    status_fn = get_status_fn(status_fn)
+    job = _read_job(tile_dir, missing_ok=True)
+    if job is None:
+        status_fn("No job in {}; it must be finished.".format(tile_dir))
+        return 0
+    n_tiles = job['n_tiles']
+    n_done = 0
+
+    while True:
+        remaining = False
+        for tile in lazy_range(n_tiles):
+            if not os.path.isdir(tile_dir):  # coordinator finished up
+                return n_done
+            if os.path.exists(_tile_path(tile_dir, tile, n_tiles, 'npz')):
+                continue
+            remaining = True
+
+            claim = _tile_path(tile_dir, tile, n_tiles, 'claim')
+            if not _try_claim(claim):
+                continue
+            with _heartbeat(claim, job['claim_timeout'] / 4):
+                saved = compute_tile(features, tile_dir, tile, n_tiles,
+                                     specs=job['specs'], Ks=job['Ks'],
+                                     min_dist=job['min_dist'], cores=cores,
+                                     status_fn=status_fn, **job['flann_args'])
+            if not saved:  # coordinator finished up without it
+                return n_done
+            n_done += 1
+
+        if not remaining:
+            return n_done
+        # other workers have the rest; wait around in case any of them die
+        time.sleep(poll_interval)
+
+
+def merge_tiles(tile_dir, n_tiles, n_bags, specs, Ks, min_dist):
+    '''
+    Stitches the finished tiles in tile_dir into an array of shape
+    (n_bags, n_bags, num_specs, num_Ks), as returned by estimate_divs().
+    '''
+    specs = strict_map(normalize_div_name, specs)
+    divs = np.empty((n_bags, n_bags, len(specs), len(Ks)), dtype=np.float32)
+    divs.fill(np.nan)
+    done = np.zeros((n_bags, n_bags), dtype=bool)
+
+    for tile in lazy_range(n_tiles):
+        with np.load(_tile_path(tile_dir, tile, n_tiles, 'npz')) as data:
+            if (list(data['specs']) != specs or
+                    list(data['Ks']) != list(Ks) or
+                    data['min_dist'] != min_dist):
+                msg = "tile {} of {} was computed with different settings"
+                raise ValueError(msg.format(tile, n_tiles))
+
+            for k, (row_start, col_start) in enumerate(data['starts']):
+                block = data['block_{}'.format(k)]
+                rows = slice(row_start, row_start + block.shape[0])
+                cols = slice(col_start, col_start + block.shape[1])
+                divs[rows, cols] = block
+                done[rows, cols] = True
+
+    if not done.all():
+        msg = "tiles only covered {} of the {} divergence pairs"
+        raise ValueError(msg.format(done.sum(), done.size))
+    return divs
+
+
+def coordinate_tiles(features, tile_dir, n_tiles, specs=['kl'], Ks=[3],
+                     min_dist=None, flann_args={},
+                     worker_cmd=None, local_workers=0,
+                     claim_timeout=DEFAULT_CLAIM_TIMEOUT,
+                     poll_interval=DEFAULT_POLL_INTERVAL,
+                     status_fn=True):
+    '''
+    Sets up a tiled job in tile_dir, waits for workers (on this machine or
+    any other that can see tile_dir) to finish it, and returns the merged
+    divergences. Tiles left over in tile_dir from an interrupted run of the
+    same job are reused; tile_dir is removed once everything is merged.
+
+    Parameters:
+        features, specs, Ks, min_dist: as for estimate_divs().
+        tile_dir: the shared directory to coordinate through.
+        n_tiles: the number of pieces to split the work into.
+        flann_args: a dict of arguments to pass along to FLANN.
+        worker_cmd: a command (list of strings) that runs work_on_tiles()
+                    for this job, e.g. `estimate_divs ... --worker`.
+        local_workers: launch this many worker_cmd processes here.
+        claim_timeout: seconds after which a tile whose worker has stopped
+                       updating its claim file is given to someone else.
+        poll_interval: seconds between checks on the workers' progress.
+        status_fn: a function to print out status messages.
+                   None means don't print any; True prints to stderr.
+    '''
+    status_fn = get_status_fn(status_fn)
+    if min_dist is None:
+        min_dist = default_min_dist(features.dim)
+    tile_block_pairs(n_tiles, len(features))  # check n_tiles is reasonable
+
+    job = {
+        'n_tiles': n_tiles,
+        'specs': strict_map(normalize_div_name, specs),
+        'Ks': [int(K) for K in Ks],
+        'min_dist': float(min_dist),
+        'flann_args': flann_args,
+        'claim_timeout': claim_timeout,
+    }
+    job_path = os.path.join(tile_dir, 'job.json')
+    if os.path.exists(job_path):
+        old_job = _read_job(tile_dir)
+        old_job['claim_timeout'] = claim_timeout
+        if old_job != job:
+            msg = "{} has a different job in it already"
+            raise ValueError(msg.format(tile_dir))
+    elif not os.path.isdir(tile_dir):
+        os.makedirs(tile_dir)
+    tmp_path = job_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.rename(tmp_path, job_path)
+
+    procs = []
+    if local_workers:
+        if worker_cmd is None:
+            raise ValueError("need a worker_cmd to launch local workers")
+        procs = [subprocess.Popen(worker_cmd) for _ in range(local_workers)]
+
+    try:
+        pending = set(lazy_range(n_tiles))
+        n_pending = None
+        while True:
+            pending = set(
+                tile for tile in pending
+                if not os.path.exists(
+                    _tile_path(tile_dir, tile, n_tiles, 'npz')))
+            if not pending:
+                break
+            if len(pending) != n_pending:
+                n_pending = len(pending)
+                status_fn("Waiting on {} of {} tiles...".format(
+                    n_pending, n_tiles))
+
+            for tile in pending:
+                claim = _tile_path(tile_dir, tile, n_tiles, 'claim')
+                try:
+                    age = time.time() - os.path.getmtime(claim)
+                except OSError:  # not claimed
+                    continue
+                if age > claim_timeout:
+                    status_fn("Tile {} looks abandoned; releasing it.".format(
+                        tile))
+                    try:
+                        os.remove(claim)
+                    except OSError:
+                        pass
+
+            failed = [p.returncode for p in procs if p.poll()]
+            if failed:
+                msg = "local worker failed with exit code {}"
+                raise RuntimeError(msg.format(failed[0]))
+
+            time.sleep(poll_interval)
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+
+    status_fn("Merging tiles...")
+    divs = merge_tiles(tile_dir, n_tiles, len(features),
+                       specs=specs, Ks=Ks, min_dist=job['min_dist'])
+    shutil.rmtree(tile_dir)
+    return divs
+
+
+################################################################################
+### Command line interface
+
+def _add_input_args(parser):
     parser.add_argument('input_file',
         help="The input file, an HDF5 file (e.g. .mat with -v7.3).")
     parser.add_argument('--input-format',
@@ -981,12 +2295,8 @@ def parse_args():
         help="The name of the cell array of row-instance data matrices, "
              "if the input file is matlab format.")
 
-    parser.add_argument('output_file', nargs='?',
-        help="Name of the output file; default input_file.divs.(mat|h5).")
-    parser.add_argument('--output-format',
-        choices=['hdf5', 'mat'], default='hdf5',
-        help="Output file format; default %(default)s.")
 
+def _add_div_args(parser):
     parser.add_argument('--cores', '--n-proc', type=positive_int, default=None,
         help="Number of processes to use; default is as many as CPU cores.")
 
@@ -1010,22 +2320,82 @@ def parse_args():
     parser.add_argument('--flann-args', type=ast.literal_eval, default={},
         help="A dictionary of arguments to FLANN.")
 
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compute divergences and set kernels based on "
+                    "KNN statistics.")
+
+    _add_input_args(parser)
+
+    parser.add_argument('output_file', nargs='?',
+        help="Name of the output file; default input_file.divs.(mat|h5).")
+    parser.add_argument('--output-format',
+        choices=['hdf5', 'mat'], default='hdf5',
+        help="Output file format; default %(default)s.")
+
+    _add_div_args(parser)
+
+    parser.add_argument('--knn-store', default=None, metavar='FILE',
+        help="Also save the nearest-neighbor distances to this HDF5 file, "
+             "so that recompute_divs() can estimate other divergences "
+             "without searching again.")
+    parser.add_argument('--knn-max-K', type=positive_int, default=None,
+        help="The number of neighbors to save with --knn-store; default "
+             "the largest needed for these divergences.")
+
+    tiles = parser.add_argument_group('distributed computation',
+        "Split the work into tiles computed by separate processes, possibly "
+        "on separate machines, that coordinate through files in a shared "
+        "directory (by default, output_file + '.tiles').")
+    mode = tiles.add_mutually_exclusive_group()
+    mode.add_argument('--coordinate', type=positive_int, metavar='N',
+        help="Split the job into N tiles, wait for workers to compute them, "
+             "and then merge them into the output file.")
+    mode.add_argument('--worker', action='store_true', default=False,
+        help="Compute tiles of the job set up by a running --coordinate "
+             "process until they're all done. Div options come from the "
+             "coordinator.")
+    mode.add_argument('--tile', type=_tile_spec, metavar='I/N',
+        help="Compute just tile I (0-based) of N and save it into the tile "
+             "directory, for the coordinator to merge.")
+    tiles.add_argument('--tile-dir', default=None,
+        help="The directory to coordinate through.")
+    tiles.add_argument('--local-workers', type=nonnegative_int, default=0,
+        help="With --coordinate, also run this many workers on this "
+             "machine. Default: %(default)s.")
+    tiles.add_argument('--claim-timeout', type=positive_float,
+        default=DEFAULT_CLAIM_TIMEOUT,
+        help="Seconds before a tile whose worker seems to have died is "
+             "handed to another worker. Default: %(default)s.")
+    tiles.add_argument('--poll-interval', type=positive_float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between checks for finished tiles. "
+             "Default: %(default)s.")
+
     args = parser.parse_args()
+    if args.knn_store is not None and (
+            args.coordinate or args.worker or args.tile is not None):
+        parser.error("--knn-store doesn't work with tiled computation")
     if args.output_file is None:
         args.output_file = '{}.divs.{}'.format(
             args.input_file, 'mat' if args.output_format == 'mat' else 'h5')
+    if args.tile_dir is None:
+        args.tile_dir = args.output_file + '.tiles'
 
     return args
 
 
-def main():
-    import h5py
+def _tile_spec(val):
+    i, n = strict_map(int, val.split('/'))
+    if not 0 <= i < n:
+        raise TypeError("must be I/N with 0 <= I < N")
+    return i, n
 
-    args = parse_args()
-    status_fn = get_status_fn(True)
 
-    status_fn('Reading data...')
+def _load_features(args):
     if args.input_format == 'matlab':
+        import h5py
         with h5py.File(args.input_file, 'r') as f:
             feats = read_cell_array(f, f[args.input_var_name])
             for x in ['cats', 'categories', 'labels']:
@@ -1034,13 +2404,38 @@ def main():
                     break
             else:
                 cats = None
-        bags = Features(feats, categories=cats)
+        return Features(feats, categories=cats)
     else:
-        bags = Features.load(args.input_file)
+        return Features.load(args.input_file)
+
+
+def main():
+    args = parse_args()
+    status_fn = get_status_fn(True)
+
+    status_fn('Reading data...')
+    bags = _load_features(args)
 
     if args.min_dist is None:
         args.min_dist = default_min_dist(bags.dim)
 
+    if args.worker:
+        n = work_on_tiles(bags, args.tile_dir, cores=args.cores,
+                          poll_interval=args.poll_interval)
+        status_fn("Computed {} tiles.".format(n))
+        return
+    elif args.tile is not None:
+        tile, n_tiles = args.tile
+        try:
+            os.makedirs(args.tile_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        compute_tile(bags, args.tile_dir, tile, n_tiles,
+                     specs=args.div_funcs, Ks=args.K, min_dist=args.min_dist,
+                     cores=args.cores, **args.flann_args)
+        return
+
     if args.output_format == 'mat':
         confirm_outfile(args.output_file)
     else:
@@ -1054,14 +2449,34 @@ def main():
     if args.min_dist is None:
         args.min_dist = default_min_dist(args.min_dist)
 
-    divs = estimate_divs(
-            bags, specs=args.div_funcs, Ks=Ks,
-            cores=args.cores,
-            min_dist=args.min_dist,
-            status_fn=True,
-            progressbar=True,
-            return_opts=True,
-            **args.flann_args)
+    if args.coordinate:
+        worker_cmd = [sys.executable, '-m', 'sdm.np_divs',
+                      args.input_file, args.output_file, '--worker',
+                      '--input-format', args.input_format,
+                      '--input-var-name', args.input_var_name,
+                      '--tile-dir', args.tile_dir,
+                      '--poll-interval', str(args.poll_interval)]
+        if args.cores is not None:
+            worker_cmd += ['--cores', str(args.cores)]
+
+        divs = coordinate_tiles(
+                bags, args.tile_dir, args.coordinate,
+                specs=args.div_funcs, Ks=Ks, min_dist=args.min_dist,
+                flann_args=args.flann_args,
+                worker_cmd=worker_cmd, local_workers=args.local_workers,
+                claim_timeout=args.claim_timeout,
+                poll_interval=args.poll_interval)
+    else:
+        divs = estimate_divs(
+                bags, specs=args.div_funcs, Ks=Ks,
+                cores=args.cores,
+                min_dist=args.min_dist,
+                status_fn=True,
+                progressbar=True,
+                knn_store=args.knn_store,
+                knn_max_K=args.knn_max_K,
+                return_opts=True,
+                **args.flann_args)
 
     status_fn("Outputting results to", args.output_file)
 
@@ -10,6 +10,7 @@ from __future__ import division, print_function
 
 from collections import Counter
 from functools import partial, reduce
+import multiprocessing as mp
 from operator import mul
 import os
 import warnings
@@ -34,7 +35,7 @@ from .utils import (positive_int, positive_float, portion,
                     rmse, iteritems, iterkeys, izip, identity, lazy_range,
                     get_status_fn, read_cell_array)
 from .mp_utils import ForkedData, get_pool, progressbar_and_updater
-from .np_divs import (estimate_divs,
+from .np_divs import (estimate_divs, estimate_cross_divs,
                       check_h5_settings, add_to_h5_cache, normalize_div_name)
 
 
@@ -63,17 +64,37 @@ DEFAULT_TRANSFORM_TEST = True
 ################################################################################
 ### PSD projection and friends
 
+DEFAULT_BLOCK_SIZE = 512
 
-def symmetrize(mat, destroy=False):
+
+def symmetrize(mat, destroy=False, block_size=DEFAULT_BLOCK_SIZE):
     '''
     Returns the mean of mat and its transpose.
 
-    If destroy, invalidates the passed-in matrix.
+    If destroy, does it in-place and returns mat itself. This works tile by
+    tile over the upper/lower triangles, so the only temporary is of shape
+    (block_size, block_size).
     '''
-    # TODO: figure out a no-copy version of this that actually works...
-    #       might have to write it in cython. probably not worth it.
-    mat = mat + mat.T
-    mat /= 2
+    if not destroy:
+        mat = mat + mat.T
+        mat /= 2
+        return mat
+
+    n = mat.shape[0]
+    if mat.shape != (n, n):
+        raise ValueError("can only symmetrize square matrices")
+
+    for i in lazy_range(0, n, block_size):
+        i_end = min(i + block_size, n)
+        for j in lazy_range(i, n, block_size):
+            j_end = min(j + block_size, n)
+            upper = mat[i:i_end, j:j_end]
+            lower = mat[j:j_end, i:i_end]
+
+            tile = upper + lower.T
+            tile /= 2
+            upper[...] = tile
+            lower[...] = tile.T
     return mat
 
 
@@ -85,6 +106,23 @@ def _transformer(transform, test_matrix):
     return np.dot(transform, test_matrix.T).T
 
 
+def _reconstruct(vecs, vals, out=None):
+    '''
+    Returns vecs * diag(vals) * vecs.T for vals >= 0, scaling vecs in-place.
+
+    Since this is done as (vecs * sqrt(vals)) (vecs * sqrt(vals)).T, the result
+    is exactly symmetric and there's no n x n temporary. If out is a C-ordered
+    square array of the right dtype, the result is written into its memory.
+    '''
+    vecs *= np.sqrt(vals).reshape(1, -1)
+    if (out is None or out.shape != (vecs.shape[0],) * 2
+            or out.dtype != vecs.dtype or not out.flags.c_contiguous):
+        out = None
+    if out is None:
+        return np.dot(vecs, vecs.T)
+    return np.dot(vecs, vecs.T, out=out)
+
+
 def project_psd(mat, min_eig=0, destroy=False, negatives_likely=True,
                 ret_test_transformer=False):
     '''
@@ -94,7 +132,8 @@ def project_psd(mat, min_eig=0, destroy=False, negatives_likely=True,
 
     Symmetrizes the matrix before projecting.
 
-    If destroy is True, invalidates the passed-in matrix.
+    If destroy is True, invalidates the passed-in matrix (and may reuse its
+    memory for the result).
 
     If negatives_likely (default), optimizes for the case where we expect there
     to be negative eigenvalues.
@@ -110,20 +149,22 @@ def project_psd(mat, min_eig=0, destroy=False, negatives_likely=True,
 
     # TODO: be smart and only get negative eigs?
     vals, vecs = scipy.linalg.eigh(mat, overwrite_a=negatives_likely)
-    vals = vals.reshape(-1, 1)
 
     if ret_test_transformer:
-        clip = np.dot(vecs, (vals > 0) * vecs.T)
+        clip = np.dot(vecs, (vals.reshape(-1, 1) > 0) * vecs.T)
         transform = partial(_transformer, clip)
 
-    if negatives_likely or vals[0, 0] < min_eig:
-        del mat
+    if negatives_likely or vals[0] < min_eig:
+        # mat is either garbage from eigh or about to be replaced; reuse it
         np.maximum(vals, min_eig, vals)  # update vals in-place
-        mat = np.dot(vecs, vals.reshape(-1, 1) * vecs.T)
-        if not ret_test_transformer:
-            del vals, vecs
-        mat = symmetrize(mat, destroy=True)  # should be symmetric, but do it
-                                             # anyway for numerical reasons
+        if min_eig >= 0:
+            mat = _reconstruct(vecs, vals, out=mat)
+        else:
+            del mat
+            mat = np.dot(vecs, vals.reshape(-1, 1) * vecs.T)
+            mat = symmetrize(mat, destroy=True)  # should be symmetric, but do
+                                                 # it for numerical reasons
+        del vals, vecs
 
     if ret_test_transformer:
         return mat, transform
@@ -165,7 +206,8 @@ def flip_psd(mat, destroy=False, negatives_likely=True,
     Turn a real symmetric matrix into PSD by flipping the sign of any negative
     eigenvalues in its spectrum.
 
-    If destroy is True, invalidates the passed-in matrix.
+    If destroy is True, invalidates the passed-in matrix (and may reuse its
+    memory for the result).
 
     If negatives_likely (default), optimizes for the case where we expect there
     to be negative eigenvalues.
@@ -181,19 +223,15 @@ def flip_psd(mat, destroy=False, negatives_likely=True,
 
     # TODO: be smart and only get negative eigs?
     vals, vecs = scipy.linalg.eigh(mat, overwrite_a=negatives_likely)
-    vals = vals.reshape(-1, 1)
 
     if ret_test_transformer:
-        flip = np.dot(vecs, np.sign(vals) * vecs.T)
+        flip = np.dot(vecs, np.sign(vals.reshape(-1, 1)) * vecs.T)
         transform = partial(_transformer, flip)
 
-    if negatives_likely or vals[0, 0] < 0:
-        del mat
+    if negatives_likely or vals[0] < 0:
         np.abs(vals, vals)  # update vals in-place
-        mat = np.dot(vecs, vals * vecs.T)
+        mat = _reconstruct(vecs, vals, out=mat)
         del vals, vecs
-        mat = symmetrize(mat, destroy=True)  # should be symmetric, but do it
-                                             # anyway for numerical reasons
     if ret_test_transformer:
         return mat, transform
     return mat
@@ -236,20 +274,38 @@ psdizers = {
 }
 
 
-def rbf_kernelize(divs, sigma, destroy=False):
+def rbf_kernelize(divs, sigma, destroy=False, dtype=None,
+                  block_size=DEFAULT_BLOCK_SIZE):
     '''
     Passes a distance matrix through an RBF kernel.
 
-    If destroy, does it in-place.
+    If destroy, does it in-place (unless dtype requires a cast).
+
+    dtype gives the dtype of the result; by default, that of divs if it's a
+    floating-point type and float64 otherwise.
+
+    The squaring, scaling, and exponentiation are done together on chunks of
+    about block_size ** 2 elements, so that no full-size temporaries are needed
+    and each chunk stays in cache for all three passes.
     '''
-    if destroy:
+    if dtype is None:
+        dtype = divs.dtype if divs.dtype.kind == 'f' else np.float64
+    dtype = np.dtype(dtype)
+
+    if destroy and divs.dtype == dtype:
         km = divs
-        km **= 2
     else:
-        km = divs ** 2
+        km = np.empty(divs.shape, dtype=dtype)
+
     # TODO do we want to square, say, Renyi divergences?
-    km /= -2 * sigma**2
-    np.exp(km, km)  # inplace
+    scale = -1 / (2 * sigma**2)
+    row_size = reduce(mul, km.shape[1:], 1)
+    rows = max(1, block_size ** 2 // max(row_size, 1))
+    for start in lazy_range(0, km.shape[0], rows):
+        block = km[start:start + rows]
+        np.square(divs[start:start + rows], out=block)
+        block *= scale
+        np.exp(block, out=block)
     return km
 
 
@@ -260,7 +316,8 @@ def make_km(divs, sigma, destroy=False, negatives_likely=True,
     ensures that it's PSD through `method` (see `psdizers`). Default: projects
     to the nearest PSD matrix by clipping any negative eigenvalues.
 
-    If destroy, invalidates the data in divs.
+    If destroy, invalidates the data in divs; the kernel is then computed in
+    divs' memory, so no additional full-size copies are made.
 
     If negatives_likely (default), optimizes memory usage for the case where we
     expect there to be negative eigenvalues.
@@ -272,12 +329,55 @@ def make_km(divs, sigma, destroy=False, negatives_likely=True,
         ret_test_transformer=ret_test_transformer)
 
 
+def _median_positive(divs):
+    gt = divs[divs > 0]
+    if gt.size == 0:
+        raise ValueError("all divergences are zero...")
+    return np.median(gt)
+
+
+def _covers_all(train_idx, test_idx, n):
+    both = np.hstack((train_idx, test_idx))
+    return both.size == n and np.unique(both).size == n
+
+
 def split_km(km, train_idx, test_idx):
     train_km = np.ascontiguousarray(km[np.ix_(train_idx, train_idx)])
     test_km = np.ascontiguousarray(km[np.ix_(test_idx, train_idx)])
     return train_km, test_km
 
 
+class _KMCache(object):
+    '''
+    Caches projected kernel matrices for a single divergence matrix, keyed by
+    sigma. Used by crossvalidate(project_all=True): each fold's transductive
+    kernel is just a permutation of the same full kernel, so we only need to
+    do one eigendecomposition per distinct sigma rather than one per fold.
+
+    uses lists the sigmas that will be asked for (with repeats). Each kernel
+    is dropped after its last use, so if the gets are grouped by sigma, only
+    one full kernel is held at a time.
+    '''
+    def __init__(self, divs, method, uses):
+        self.divs = divs
+        self.method = method
+        self.uses = Counter(uses)
+        self.kms = {}
+
+    def get(self, sigma):
+        "Returns the full projected kernel for sigma, using up one use."
+        if self.uses[sigma] <= 0:
+            raise ValueError("no uses left for sigma {}".format(sigma))
+        self.uses[sigma] -= 1
+
+        km = self.kms.pop(sigma, None)
+        if km is None:
+            km = make_km(self.divs, sigma, method=self.method)
+        if self.uses[sigma] > 0:
+            self.kms[sigma] = km
+        return km
+
+
 ################################################################################
 ### Cached divs helper
 
@@ -351,6 +451,75 @@ def _try_params(cls, tuning_params, sigma_kms, labels, folds, svm_params,
         # TODO: count these like we count the fit_status_ errors
 
 
+def _crossvalidate_fold(fold_idx, sdm, divs, labels, sample_weight, folds,
+                        project_all, parallel=False, n_proc=None,
+                        tuning_fold_seed=None):
+    '''
+    Runs one fold of BaseSDM.crossvalidate(). sdm, divs, labels,
+    sample_weight, and folds are ForkedData.
+
+    If project_all, this only tunes the parameters; crossvalidate() then does
+    the final fits itself, so that the projections can be shared between
+    folds. Otherwise, it also fits and predicts. Returns
+    (fold_idx, test, preds, params, tune_info), with preds None if project_all.
+
+    If parallel, we're in a worker process with our own copy of the SDM, which
+    uses n_proc processes. Tuning folds are seeded from (tuning_fold_seed,
+    fold_idx) either way, so results don't depend on fold_n_proc.
+    '''
+    self = sdm.value
+    divs = divs.value
+    labels = labels.value
+    sample_weight = sample_weight.value
+    status = self.status_fn
+
+    if parallel:
+        self.n_proc = n_proc
+        self.progressbar = False
+        # otherwise every worker has the parent's RNG state
+        np.random.seed([tuning_fold_seed, fold_idx])
+    self._tuning_fold_rng = np.random.RandomState([tuning_fold_seed, fold_idx])
+
+    train, test = folds.value[fold_idx]
+    num_folds = len(folds.value)
+
+    status('')
+    status('Starting fold {} / {}'.format(fold_idx + 1, num_folds))
+
+    if self.classifier:
+        status('Train distribution: {}'.format(dict(Counter(labels[train]))))
+        status('Test distribution: {}'.format(dict(Counter(labels[test]))))
+
+    weights = None if sample_weight is None else sample_weight[train]
+
+    if project_all:
+        # the transductive fit only tunes on the training part, which is the
+        # same whether or not we symmetrize before or after taking it
+        train_divs = divs[np.ix_(train, train)]
+        if self.symmetrize_divs:
+            train_divs = symmetrize(train_divs, destroy=True)
+        self._tune_params(divs=train_divs, labels=labels[train],
+                          sample_weight=weights)
+        del train_divs
+        preds = None
+    else:
+        self.fit(None, labels[train], sample_weight=weights,
+                 divs=divs[np.ix_(train, train)], destroy_divs=True)
+        pred_divs = (divs[np.ix_(test, train)] +
+                     divs[np.ix_(train, test)].T) / 2
+        preds = self.predict(None, divs=pred_divs)
+
+        score = self.eval_score(labels[test], preds)
+        status('Fold {}: {score:{score_fmt}}'.format(
+            self.score_name, score=score, score_fmt=self.score_fmt))
+
+    params = self._tuned_params()
+    tune_info = self.tune_evals_
+    self.clear_fit()
+
+    return fold_idx, test, preds, params, tune_info
+
+
 def _not_implemented(*args, **kwargs):
     raise NotImplementedError
 
@@ -478,9 +647,12 @@ class BaseSDM(sklearn.base.BaseEstimator):
 
         ret_km (optional, boolean): if True, returns the final training kernel
             matrix.
+
+        destroy_divs (optional, boolean): if True, the passed divs may be
+            overwritten in place to avoid making full-size copies of them.
     '''
     def fit(self, X, y, sample_weight=None, divs=None, divs_cache=None,
-            ret_km=False):
+            ret_km=False, destroy_divs=False):
         if X is None:
             if divs is None:
                 raise ValueError("need to pass either X or divs to fit()")
@@ -538,9 +710,11 @@ class BaseSDM(sklearn.base.BaseEstimator):
             self.status_fn('Getting divergences...')
             div_args = self._div_args(for_cache=True)
             divs = get_divs_cache(X, cache_filename=divs_cache, **div_args)
+            destroy_divs = True  # it's our own copy
 
         if self.symmetrize_divs:
-            divs = symmetrize(divs)
+            divs = symmetrize(divs, destroy=destroy_divs)
+            destroy_divs = True  # either it was already, or this is a copy
 
         # tune params
         self.status_fn('Tuning SVM parameters...')
@@ -550,22 +724,21 @@ class BaseSDM(sklearn.base.BaseEstimator):
 
         # project the final Gram matrix
         self.status_fn('Doing final projection')
-        fn = partial(make_km, divs, self.sigma_, method=self.km_method)
+        fn = partial(make_km, divs, self.sigma_, method=self.km_method,
+                     destroy=destroy_divs)
+        del divs
         if self.transform_test:
             full_km, self.test_transformer_ = fn(ret_test_transformer=True)
         else:
             full_km = fn()
-        train_km = np.ascontiguousarray(full_km[np.ix_(train_idx, train_idx)])
-
-        # train the selected SVM
-        self.status_fn('Training final SVM')
-        params = self._svm_params(tuning=False)
-        clf = self.svm_class(**params)
-        if self.oneclass:
-            clf.fit(train_km, sample_weight=train_sample_weight)
+        del fn
+        if train_idx.all():
+            train_km = full_km
         else:
-            clf.fit(train_km, train_y, sample_weight=train_sample_weight)
-        self.svm_ = clf
+            train_km = np.ascontiguousarray(
+                full_km[np.ix_(train_idx, train_idx)])
+
+        self._fit_svm(train_km, train_y, sample_weight=train_sample_weight)
 
         if ret_km:
             return full_km
@@ -573,6 +746,17 @@ class BaseSDM(sklearn.base.BaseEstimator):
         y: a vector of class labels (depending on the subclass)
         """)
 
+    def _fit_svm(self, train_km, train_y, sample_weight=None):
+        "Trains the final SVM on a training kernel, with the tuned params."
+        self.status_fn('Training final SVM')
+        params = self._svm_params(tuning=False)
+        clf = self.svm_class(**params)
+        if self.oneclass:
+            clf.fit(train_km, sample_weight=sample_weight)
+        else:
+            clf.fit(train_km, train_y, sample_weight=sample_weight)
+        self.svm_ = clf
+
     def _prediction_km(self, data=None, divs=None, km=None):
         # TODO: smarter projection options for inductive use
         if getattr(self, 'svm_', None) is None:
@@ -588,19 +772,15 @@ class BaseSDM(sklearn.base.BaseEstimator):
                 raise ValueError("SDM that doesn't save_bags can't predict "
                                  "without explicit divs")
 
-            n_train = len(self.train_bags_)
-            n_test = len(data)
+            if not isinstance(data, Features):
+                data = Features(data)
 
             self.status_fn('Getting test bag divergences...')
 
-            mask = np.zeros((n_train + n_test, n_train + n_test), dtype=bool)
-            mask[:n_train, -n_test:] = True
-            mask[-n_test:, :n_train] = True
-
-            divs = np.squeeze(estimate_divs(
-                    self.train_bags_ + data, mask=mask,
-                    **self._div_args(for_cache=False)))
-            divs = (divs[-n_test:, :n_train] + divs[:n_train, -n_test].T) / 2
+            fwd, bwd = estimate_cross_divs(
+                    data, self.train_bags_,
+                    **self._div_args(for_cache=False))
+            divs = (fwd[:, :, 0, 0] + bwd[:, :, 0, 0].T) / 2
             destroy_divs = True
 
         km = rbf_kernelize(divs, self.sigma_, destroy=destroy_divs)
@@ -627,7 +807,8 @@ class BaseSDM(sklearn.base.BaseEstimator):
         return self.eval_score(labels, preds)
 
     def transduct(self, train_bags, train_labels, test_bags, divs=None,
-                  train_weight=None, mode='predict', save_fit=False):
+                  train_weight=None, mode='predict', save_fit=False,
+                  destroy_divs=False):
         '''
         Trains an SDM transductively, where the kernel matrix is constructed on
         the training + test points, the SVM is trained on training points, and
@@ -663,6 +844,9 @@ class BaseSDM(sklearn.base.BaseEstimator):
         save_fit (boolean, default false): By default, the SDM object does not
             save its fit and is reset to an un-fit state as if it had just been
             constructed. Passing save_fit=True makes the fit persistent.
+
+        destroy_divs (boolean, default false): if True, the passed divs may be
+            overwritten in place to avoid making full-size copies of them.
         '''
         # TODO: support transparent divs caching by passing in indices
         # TODO: support passing in pre-stacked train/test features,
@@ -729,7 +913,8 @@ class BaseSDM(sklearn.base.BaseEstimator):
             train_weight = np.r_[train_weight, np.zeros(n_test)]
 
         full_km = BaseSDM.fit(self, X=combo_bags, y=combo_labels, divs=divs,
-                              sample_weight=train_weight, ret_km=True)
+                              sample_weight=train_weight, ret_km=True,
+                              destroy_divs=destroy_divs)
         preds = pred_fn(test_bags, km=full_km[-n_test:, :n_train])
 
         if not save_fit:
@@ -796,10 +981,11 @@ class BaseSDM(sklearn.base.BaseEstimator):
         # figure out the hypergrid of parameter options
         param_d = self._param_grid_dict()
         if self.scale_sigma:
-            gt = divs[divs > 0]
-            if gt.size == 0:
-                raise ValueError("all divergences are zero...")
-            param_d['sigma'] = param_d['sigma'] * np.median(gt)
+            # HACK: crossvalidate() can fix the scale across folds
+            scale = getattr(self, '_sigma_scale', None)
+            if scale is None:
+                scale = _median_positive(divs)
+            param_d['sigma'] = param_d['sigma'] * scale
             # make sure not to modify self.sigma_vals...
 
         # HACK: support just giving the folds directly
@@ -897,7 +1083,8 @@ class BaseSDM(sklearn.base.BaseEstimator):
         cv_means = scores.mean(axis=fold_idx_idx)
         best_elts = cv_means == cv_means.min()
         b = np.transpose(best_elts.nonzero())
-        best_indices = b[np.random.choice(b.shape[0])]
+        rng = getattr(self, '_tuning_fold_rng', np.random)
+        best_indices = b[rng.choice(b.shape[0])]
         assert len(nonfold_param_names) == len(best_indices)
         the_params = dict(
                 (name, param_d[name][idx])
@@ -913,13 +1100,88 @@ class BaseSDM(sklearn.base.BaseEstimator):
 
     ############################################################################
     ### Cross-validation helper
+    def _transduct_fold(self, divs, km_cache, train, test, labels,
+                        sample_weight, params):
+        '''
+        Does the final transductive fit for one fold of crossvalidate(), with
+        the parameters its tuning chose, and returns the test predictions.
+        Uses the km_cache projections if given; otherwise projects the fold's
+        own submatrix.
+        '''
+        if km_cache is not None:
+            train_km, test_km = split_km(
+                km_cache.get(params['sigma']), train, test)
+        else:
+            both = np.hstack((train, test))
+            both_divs = divs[np.ix_(both, both)]
+            if self.symmetrize_divs:
+                both_divs = symmetrize(both_divs, destroy=True)
+            km = make_km(both_divs, params['sigma'], method=self.km_method,
+                         destroy=True)
+            del both_divs
+            n_train = train.size
+            train_km = np.ascontiguousarray(km[:n_train, :n_train])
+            test_km = np.ascontiguousarray(km[n_train:, :n_train])
+            del km
+
+        for name, val in iteritems(params):  # undo _tuned_params()
+            setattr(self, name + '_', val)
+        weights = None if sample_weight is None else sample_weight[train]
+        self._fit_svm(train_km, labels[train], sample_weight=weights)
+        del train_km
+        preds = self.predict(None, km=test_km)
+        self.clear_fit()
+
+        score = self.eval_score(labels[test], preds)
+        self.status_fn('Fold {}: {score:{score_fmt}}'.format(
+            self.score_name, score=score, score_fmt=self.score_fmt))
+        return preds
+
     def crossvalidate(self, bags, labels, project_all=True,
                       sample_weight=None,
                       num_folds=10, stratified_cv=False, folds=None,
                       ret_fold_info=False, ret_tune_info=False,
                       divs=None, divs_cache=None,
-                      tuning_fold_seed=None):
-        # TODO: document crossvalidate()
+                      tuning_fold_seed=None, fold_n_proc=1,
+                      share_sigma_scale=False):
+        '''
+        Estimates the SDM's performance with cross-validation.
+
+        Arguments
+        ---------
+
+        bags: a Features instance, list of row-instance data matrices, or
+            None if divs is passed.
+
+        labels: a label vector for the bags.
+
+        project_all (default True): fit each fold transductively, projecting
+            the kernel matrix of the training and test bags together.
+
+        num_folds, stratified_cv, folds: the folds to use: either
+            num_folds (stratified if stratified_cv) shuffled folds, or a list
+            of (train, test) index arrays.
+
+        ret_fold_info, ret_tune_info: also return the folds and the
+            parameters chosen for each, and the tuning results.
+
+        divs, divs_cache: precomputed divergences, or a file to cache them in.
+
+        tuning_fold_seed (optional): a seed for the folds used for parameter
+            tuning inside each fold. Default: drawn from numpy's global RNG.
+
+        fold_n_proc (default 1): how many folds to run at once. The n_proc
+            processes are split between them for tuning. Each fold running
+            keeps its own kernel matrices, so memory use grows with this.
+
+        share_sigma_scale (default False): with scale_sigma and project_all,
+            scale sigma by the median of all the divergences, rather than of
+            each fold's training divergences, so that folds which choose the
+            same sigma can share projections.
+
+        Returns (score, preds), plus (folds, params) if ret_fold_info and then
+        tune_info if ret_tune_info.
+        '''
         # TODO: nicer interface for ret_tune_info
         status = self.status_fn
 
@@ -963,53 +1225,75 @@ class BaseSDM(sklearn.base.BaseEstimator):
         else:
             num_folds = len(folds)
 
-        # specify seed for tuning folds
-        if tuning_fold_seed is not None:
-            self._tuning_fold_rng = np.random.RandomState(tuning_fold_seed)
+        # When projecting transductively, every fold that covers all the bags
+        # projects a permutation of the same matrix; cache the projections by
+        # sigma. Folds only choose the same sigma if they scale it the same
+        # way, though, so share_sigma_scale uses the median of all the
+        # divergences (which the projection sees anyway).
+        if project_all:
+            proj_divs = symmetrize(divs) if self.symmetrize_divs else divs
+            if self.scale_sigma and share_sigma_scale:
+                self._sigma_scale = _median_positive(proj_divs)
+
+        # derive the tuning folds' seeds here, so they follow numpy's global
+        # seed however the folds are run
+        if tuning_fold_seed is None:
+            tuning_fold_seed = np.random.randint(2 ** 31)
 
         old_save_bags = self.save_bags
         self.save_bags = False  # avoid keeping copies around
 
-        params = []
-        tune_info = []
-        for i, (train, test) in enumerate(folds, 1):
-            status('')
-            status('Starting fold {} / {}'.format(i, num_folds))
-
-            both = np.hstack((train, test))
-
-            if self.classifier:
-                status('Train distribution: {}'.format(
-                    dict(Counter(labels[train]))))
-                status('Test distribution: {}'.format(
-                    dict(Counter(labels[test]))))
-
-            weights = None if sample_weight is None else sample_weight[train]
-
-            if project_all:
-                preds[test] = self.transduct(
-                    None, labels[train], None,
-                    train_weight=weights,
-                    divs=divs[np.ix_(both, both)], save_fit=True)
-            else:
-                self.fit(None, labels[train], sample_weight=weights,
-                         divs=divs[np.ix_(train, train)])
-                pred_divs = (divs[np.ix_(test, train)] +
-                             divs[np.ix_(train, test)].T) / 2
-                preds[test] = self.predict(None, divs=pred_divs)
-
-            score = self.eval_score(labels[test], preds[test])
-            status('Fold {}: {score:{score_fmt}}'.format(
-                self.score_name, score=score, score_fmt=self.score_fmt))
-
-            params.append(self._tuned_params())
-            tune_info.append(self.tune_evals_)
-            self.clear_fit()
-
-        try:
-            del self._tuning_fold_rng
-        except AttributeError:
-            pass
+        # split our processes between running folds and tuning inside them
+        fold_n_proc = min(num_folds, fold_n_proc)
+        if fold_n_proc == 1:
+            inner_n_proc = self.n_proc
+        else:
+            inner_n_proc = max(1, (self.n_proc or mp.cpu_count())
+                                  // fold_n_proc)
+            status('Running {} folds at a time, with {} processes each'.format(
+                fold_n_proc, inner_n_proc))
+
+        folds = list(folds)
+        do_fold = partial(_crossvalidate_fold,
+            sdm=ForkedData(self), divs=ForkedData(divs),
+            labels=ForkedData(labels), sample_weight=ForkedData(sample_weight),
+            folds=ForkedData(folds), project_all=project_all,
+            parallel=fold_n_proc != 1, n_proc=inner_n_proc,
+            tuning_fold_seed=tuning_fold_seed)
+
+        params = [None] * num_folds
+        tune_info = [None] * num_folds
+        with get_pool(fold_n_proc, daemon=False) as pool:
+            for i, test, fold_preds, fold_params, fold_tune_info in \
+                    pool.imap_unordered(do_fold, lazy_range(num_folds)):
+                if fold_preds is not None:
+                    preds[test] = fold_preds
+                params[i] = fold_params
+                tune_info[i] = fold_tune_info
+        del do_fold
+
+        if project_all:
+            # Do the final fits here, rather than in the fold workers, so that
+            # there's only one copy of each projection. Going through the
+            # folds by sigma means we only need each one once.
+            covers = [_covers_all(train, test, num_bags)
+                      for train, test in folds]
+            km_cache = _KMCache(proj_divs, method=self.km_method,
+                uses=[p['sigma'] for p, c in izip(params, covers) if c])
+            del proj_divs
+            for i in sorted(lazy_range(num_folds),
+                            key=lambda i: params[i]['sigma']):
+                train, test = folds[i]
+                preds[test] = self._transduct_fold(
+                    divs, km_cache if covers[i] else None, train, test,
+                    labels, sample_weight, params[i])
+            del km_cache
+
+        for attr in ['_tuning_fold_rng', '_sigma_scale']:
+            try:
+                delattr(self, attr)
+            except AttributeError:
+                pass
         self.save_bags = old_save_bags
 
         score = self.eval_score(labels, preds)
@@ -1092,10 +1376,10 @@ class BaseSDMClassifier(BaseSDM):
         return self.svm_.predict_log_proba(km)
 
     def fit(self, X, y, sample_weight=None, divs=None, divs_cache=None,
-            ret_km=False):
+            ret_km=False, destroy_divs=False):
         return super(BaseSDMClassifier, self).fit(
             X, y, sample_weight=sample_weight, divs=divs, divs_cache=divs_cache,
-            ret_km=ret_km)
+            ret_km=ret_km, destroy_divs=destroy_divs)
     fit.__doc__ = BaseSDM._fit_docstr.format(y_doc="""
         y: a vector of nonnegative integer class labels.
             -1 corresponds to data that should be used semi-supervised, i.e. its
@@ -1224,10 +1508,10 @@ class BaseSDMRegressor(BaseSDM):
     score_fmt = ''
 
     def fit(self, X, y, sample_weight=None, divs=None, divs_cache=None,
-            ret_km=False):
+            ret_km=False, destroy_divs=False):
         return super(BaseSDMRegressor, self).fit(
             X, y, sample_weight=sample_weight, divs=divs, divs_cache=divs_cache,
-            ret_km=ret_km)
+            ret_km=ret_km, destroy_divs=destroy_divs)
     fit.__doc__ = BaseSDM._fit_docstr.format(y_doc="""
         y: a vector of real-valued labels.
             nan corresponds to data that should be used semi-supervised, i.e.
@@ -1405,7 +1689,7 @@ class OneClassSDM(BaseSDM):
         return d
 
     def fit(self, X, sample_weight=None, divs=None, divs_cache=None,
-            ret_km=False):
+            ret_km=False, destroy_divs=False):
         if X is not None:
             y = np.zeros(len(X))  # fake labels so superclass doesn't flip out
         elif divs is not None:
@@ -1414,11 +1698,11 @@ class OneClassSDM(BaseSDM):
             raise ValueError("need to pass either X or divs to fit")
         return super(OneClassSDM, self).fit(
             X, y, sample_weight=sample_weight, ret_km=ret_km,
-            divs=divs, divs_cache=divs_cache)
+            divs=divs, divs_cache=divs_cache, destroy_divs=destroy_divs)
     fit.__doc__ = BaseSDM._fit_docstr.format(y_doc='')
 
     def transduct(self, train_bags, test_bags, divs=None, train_weight=None,
-                  mode='predict', save_fit=False):
+                  mode='predict', save_fit=False, destroy_divs=False):
         if train_bags is not None:
             y = np.zeros(len(train_bags))
         elif divs is not None:
@@ -1427,7 +1711,7 @@ class OneClassSDM(BaseSDM):
             raise ValueError("need to pass either train_bags or divs to fit")
         return super(OneClassSDM, self).transduct(
             train_bags, y, test_bags, divs=divs, train_weight=train_weight,
-            mode=mode, save_fit=save_fit)
+            mode=mode, save_fit=save_fit, destroy_divs=destroy_divs)
 
 
 sdm_for_mode = {
@@ -1702,6 +1986,13 @@ def parse_args():
     cv._add_action(ActionNoYes('stratified-cv', default=False,
         help="Choose CV folds to keep approximately the same class "
              "distribution in each one (by default, doesn't)."))
+    cv.add_argument('--fold-n-proc', type=positive_int, default=1,
+        help="The number of CV folds to run at once; --n-proc processes are "
+             "split between them. Memory use grows with this " + _def)
+    cv._add_action(ActionNoYes('share-sigma-scale', default=False,
+        help="In transduct mode, scale sigma by the median of all the "
+             "divergences rather than each fold's training divergences, so "
+             "that folds can share projections (by default, doesn't)."))
 
     add_opts(parser_cv)
 
@@ -1918,7 +2209,9 @@ def do_cv(args):
         num_folds=args.cv_folds, stratified_cv=args.stratified_cv,
         project_all=args.mode == 'transduct',
         ret_fold_info=True,
-        divs_cache=args.div_cache_file)
+        divs_cache=args.div_cache_file,
+        fold_n_proc=args.fold_n_proc,
+        share_sigma_scale=args.share_sigma_scale)
 
     status_fn('')
     status_fn('{score_name}: {score:{score_fmt}}'.format(score=score,
@@ -1,7 +1,11 @@
 from __future__ import division
 from functools import partial
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
 if sys.version_info.major == 2:
     from StringIO import StringIO
@@ -10,13 +14,19 @@ else:
 
 import numpy as np
 import h5py
-from scipy.special import psi
+from scipy.spatial.distance import cdist
+from scipy.special import psi, gammaln
 
 if __name__ == '__main__':
     _this_dir = os.path.dirname(os.path.abspath(__file__))
     sys.path.insert(0, os.path.dirname(os.path.dirname(_this_dir)))
 
-from sdm.np_divs import estimate_divs, normalize_div_name
+from sdm.np_divs import (estimate_divs, estimate_cross_divs,
+                         normalize_div_name, block_bounds, block_pairs,
+                         estimate_divs_block, AllPairs, UpperTriangle,
+                         BlockMask, SparseMask, recompute_divs,
+                         estimate_entropies)
+from sdm import np_divs, _np_divs
 from sdm.features import Features
 from sdm.utils import iteritems, itervalues, strict_map
 
@@ -224,6 +234,385 @@ def test_js_simple():
                         status_fn=None).squeeze()
     assert_close(est, expected, atol=5e-5, msg="JS estimate not as expected")
 
+
+def test_blocks():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    name = 'gaussian-2d-mean0-std1,2'
+    feats = Features.load_from_hdf5(os.path.join(dir, name + '.h5'))
+
+    args = dict(specs=['kl', 'l2', 'js'], Ks=[3, 5], min_dist=1e-10,
+                status_fn=None)
+    expected = estimate_divs(feats, **args)
+
+    assert block_bounds(7, 3) == [(0, 2), (2, 5), (5, 7)]
+    bounds = block_bounds(len(feats), 3)
+    got = np.empty_like(expected)
+    got.fill(np.nan)
+    for i, j in block_pairs(3):
+        (a, b), (c, d) = bounds[i], bounds[j]
+        got[a:b, c:d], got[c:d, a:b] = \
+            estimate_divs_block(feats, bounds[i], bounds[j], **args)
+    assert_close(got, expected, atol=5e-5, msg="blocks disagree with full")
+
+
+def test_pair_masks():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    name = 'gaussian-2d-mean0-std1,2'
+    feats = Features.load_from_hdf5(os.path.join(dir, name + '.h5'))
+    n = len(feats)
+
+    args = dict(specs=['kl', 'l2', 'js', 'renyi:.9', 'linear'], Ks=[3, 5],
+                min_dist=1e-10, status_fn=None)
+    full = estimate_divs(feats, **args)
+
+    rs = np.random.RandomState(12)
+    masks = [AllPairs(), UpperTriangle(), UpperTriangle(diagonal=False),
+             BlockMask((1, 4), (2, 7)), BlockMask((1, 4), (2, 7), True),
+             BlockMask((0, 3), (5, n)), SparseMask([0, 3, 5], [4, 1, 5]),
+             rs.rand(n, n) < .3]
+
+    def check(mask):
+        got = estimate_divs(feats, mask=mask, **args)
+        if not isinstance(mask, np.ndarray):
+            mask = mask.to_array(n, n)
+        assert np.all(np.isnan(got[~mask]))
+        got, expected = got[mask], full[mask]
+        assert np.all(np.isnan(got) == np.isnan(expected))
+        ok = ~np.isnan(expected)
+        assert_close(got[ok], expected[ok], atol=5e-5,
+                     msg="masked divs disagree with full")
+
+    for mask in masks:
+        yield check, mask
+
+
+def test_progress_callback():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    name = 'gaussian-2d-mean0-std1,2'
+    feats = Features.load_from_hdf5(os.path.join(dir, name + '.h5'))
+    n = len(feats)
+
+    def check(mask, n_pairs):
+        calls = []
+        estimate_divs(feats, mask=mask, specs=['kl'], Ks=[3], status_fn=None,
+                      progress_callback=lambda *a: calls.append(a))
+        dones, totals, rates = zip(*calls)
+        assert set(totals) == set([n_pairs])
+        assert dones[0] == 0 and dones[-1] == n_pairs
+        assert list(dones) == sorted(dones)
+        assert min(rates) >= 0
+
+    yield check, None, n * n
+    yield check, UpperTriangle(diagonal=False), n * (n - 1) // 2
+
+
+def test_cross_divs():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    name = 'gaussian-2d-mean0-std1,2'
+    feats = Features.load_from_hdf5(os.path.join(dir, name + '.h5'))
+    X, Y = feats[:3], feats[3:]
+
+    args = dict(specs=['kl', 'l2', 'js', 'renyi:.9', 'hellinger', 'linear'],
+                Ks=[3, 5], min_dist=1e-10, status_fn=None)
+    expected = estimate_divs(X + Y, **args)
+    fwd, bwd = estimate_cross_divs(X, Y, **args)
+    assert fwd.shape == (len(X), len(Y), 6, 2)
+    assert bwd.shape == (len(Y), len(X), 6, 2)
+    assert_close(fwd, expected[:3, 3:], atol=5e-5,
+                 msg="forward cross divs disagree with full")
+    assert_close(bwd, expected[3:, :3], atol=5e-5,
+                 msg="backward cross divs disagree with full")
+
+def test_recompute_divs():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    name = 'gaussian-2d-mean0-std1,2'
+    feats = Features.load_from_hdf5(os.path.join(dir, name + '.h5'))
+    n = len(feats)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        store = os.path.join(tempdir, 'knn.h5')
+        saved = estimate_divs(feats, specs=['kl'], Ks=[3], min_dist=1e-10,
+                              status_fn=None, knn_store=store, knn_max_K=6)
+        with h5py.File(store, 'r') as f:
+            # every point against each of the other bags
+            assert f['nu_sq_dists'].shape == ((n - 1) * feats.total_points, 6)
+            assert np.all(f['pair_col_ptr'][()] == np.arange(n + 1) * n)
+            assert np.all(f['_meta/names'][()] == feats.names)
+            nus = f['nu_sq_dists'][()]
+        assert not [x for x in os.listdir(tempdir) if x != 'knn.h5']
+
+        # the pure-Python kernel lays the store out the same way
+        old_estimate = np_divs._estimate_cross_divs
+        try:
+            np_divs._estimate_cross_divs = _np_divs._estimate_cross_divs
+            py_store = os.path.join(tempdir, 'knn-py.h5')
+            estimate_divs(feats, specs=['kl'], Ks=[3], min_dist=1e-10,
+                          status_fn=None, knn_store=py_store, knn_max_K=6)
+        finally:
+            np_divs._estimate_cross_divs = old_estimate
+        with h5py.File(py_store, 'r') as f:
+            assert_close(f['nu_sq_dists'][()], nus, atol=1e-5,
+                         msg="Cython and Python kNN stores disagree")
+
+        got = recompute_divs(store, specs=['kl'], Ks=[3], min_dist=1e-10,
+                             status_fn=None)
+        assert_close(got, saved, atol=5e-5, msg="recomputed kl disagrees")
+
+        args = dict(specs=['kl', 'l2', 'js', 'renyi:.9', 'linear'],
+                    Ks=[3, 5], min_dist=1e-10, status_fn=None)
+        got = recompute_divs(store, **args)
+        expected = estimate_divs(feats, **args)
+        assert np.all(np.isnan(got) == np.isnan(expected))
+        ok = ~np.isnan(expected)
+        assert_close(got[ok], expected[ok], atol=5e-5,
+                     msg="recomputed divs disagree with estimate_divs")
+
+        try:
+            recompute_divs(store, Ks=[7], status_fn=None)
+        except ValueError:
+            pass
+        else:
+            assert False, "recompute_divs allowed K > the stored max_K"
+
+        # a masked store only has room for the masked pairs (here
+        # symmetrized, since js needs the transpose)
+        args = dict(mask=BlockMask((1, 4), (2, 7)), specs=['kl', 'js'],
+                    Ks=[3], min_dist=1e-10, status_fn=None)
+        expected = estimate_divs(feats, knn_store=store, **args)
+        with h5py.File(store, 'r') as f:
+            pairs = BlockMask((1, 4), (2, 7), True).to_array(n, n)
+            np.fill_diagonal(pairs, False)
+            n_pts = feats._n_pts
+            stored = sum(n_pts[i] for i, j in zip(*pairs.nonzero()))
+            assert f['nu_sq_dists'].shape == (stored, 3)
+            assert 'done' not in f
+        del args['mask']
+        got = recompute_divs(store, **args)
+        ok = ~np.isnan(expected)
+        assert np.all(np.isnan(got) == (~pairs[:, :, None, None] & ~ok))
+        assert_close(got[ok], expected[ok], atol=5e-5,
+                     msg="recomputed masked divs disagree")
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_recompute_divs_unequal():
+    # js and jr need all the Ks and the bag sizes, and equal-sized bags put
+    # the ball weights right on K / (n + m - 1)
+    rs = np.random.RandomState(4)
+    sizes = [60, 60, 85, 40, 60, 130, 85, 40]
+    feats = Features([rs.normal(scale=rs.uniform(.5, 2), size=(n, 3))
+                      for n in sizes])
+    args = dict(specs=['kl', 'js', 'renyi:.9', 'jr:.8'], Ks=[3, 5],
+                min_dist=1e-10, status_fn=None)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        store = os.path.join(tempdir, 'knn.h5')
+        expected = estimate_divs(feats, knn_store=store, knn_max_K=12, **args)
+        got = recompute_divs(store, **args)
+        assert np.all(np.isnan(got) == np.isnan(expected))
+        ok = ~np.isnan(expected)
+        assert_close(got[ok], expected[ok], atol=1e-6,
+                     msg="recomputed divs disagree for unequal sizes")
+
+        old_estimate = np_divs._estimate_cross_divs
+        old_recompute = np_divs._divs_from_knn_store
+        try:
+            np_divs._estimate_cross_divs = _np_divs._estimate_cross_divs
+            np_divs._divs_from_knn_store = _np_divs._divs_from_knn_store
+            py_expected = estimate_divs(feats, **args)
+            py_got = recompute_divs(store, **args)
+        finally:
+            np_divs._estimate_cross_divs = old_estimate
+            np_divs._divs_from_knn_store = old_recompute
+        assert_close(py_expected[ok], expected[ok], atol=5e-5,
+                     msg="Cython and Python divs disagree for unequal sizes")
+        assert_close(py_got[ok], expected[ok], atol=5e-5,
+                     msg="Python recomputed divs disagree for unequal sizes")
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_meta_tiles():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    name = 'gaussian-2d-mean0-std1,2'
+    feats = Features.load_from_hdf5(os.path.join(dir, name + '.h5'))
+    X, Y = feats[:8], feats[8:]
+
+    args = dict(specs=['kl', 'l2', 'js', 'renyi:.9', 'hellinger'],
+                Ks=[3, 5], min_dist=1e-10, status_fn=None)
+    whole = estimate_divs(feats, **args)
+    whole_fwd, whole_bwd = estimate_cross_divs(X, Y, **args)
+
+    old_size = np_divs.META_TILE_SIZE
+    try:
+        np_divs.META_TILE_SIZE = 3
+        tiled = estimate_divs(feats, **args)
+        tiled_fwd, tiled_bwd = estimate_cross_divs(X, Y, **args)
+    finally:
+        np_divs.META_TILE_SIZE = old_size
+
+    for got, expected in [(tiled, whole), (tiled_fwd, whole_fwd),
+                          (tiled_bwd, whole_bwd)]:
+        assert got.shape == expected.shape
+        assert got.flags.c_contiguous
+        assert np.all(np.isnan(got) == np.isnan(expected))
+        ok = ~np.isnan(expected)
+        assert_close(got[ok], expected[ok], atol=1e-6,
+                     msg="tiled meta-estimators disagree with whole ones")
+
+
+def test_bag_stats():
+    rs = np.random.RandomState(3)
+    rhos = [rs.rand(n, 2).astype(np.float32) + .1 for n in [5, 12, 7, 30]]
+    Ks = np.array([3, 5])
+    dim = 3
+
+    quads = np_divs._quadratics(Ks, dim, rhos)
+    expected = [np_divs.quadratic(Ks, dim, rho) for rho in rhos]
+    assert_close(quads, expected, msg="vectorized quadratics are wrong")
+
+    bits = np_divs._jensen_shannon_bag_stats(Ks, dim, rhos)
+    expected = [np.log(len(rho) - 1) + dim * np.log(rho).mean(axis=0)
+                for rho in rhos]
+    assert_close(bits, expected, atol=1e-6,
+                 msg="vectorized JS bag stats are wrong")
+
+
+def test_jensen_renyi():
+    rs = np.random.RandomState(7)
+    bags = [rs.normal(size=(40, 2)), rs.normal(size=(40, 2)),
+            rs.normal(scale=2, size=(40, 2)),
+            rs.normal(size=(25, 2)), rs.normal(scale=2, size=(60, 2))]
+    feats = Features(bags)
+    alphas = [.5, .9, 1.5]
+    Ks = [3, 5]
+    args = dict(specs=['jr:{}'.format(a) for a in alphas], Ks=Ks,
+                min_dist=1e-10, status_fn=None)
+    divs = estimate_divs(feats, **args)
+
+    # for equal-sized bags, this is the usual kNN Renyi entropy estimator on
+    # the pooled sample minus those on each sample
+    def log_integral(X, alpha, K):
+        dists = np.sort(cdist(X, X), axis=1)[:, K]
+        n, d = X.shape
+        return (np.log(np.mean(((n - 1) * dists ** d) ** (1 - alpha)))
+                + gammaln(K) - gammaln(K + 1 - alpha))
+
+    def jr(X, Y, alpha, K):
+        ints = [log_integral(Z, alpha, K) for Z in [np.vstack([X, Y]), X, Y]]
+        return max(0, (ints[0] - ints[1] / 2 - ints[2] / 2) / (1 - alpha))
+
+    expected = np.array([[[[jr(bags[i], bags[j], alpha, K) for K in Ks]
+                           for alpha in alphas]
+                          for j in range(3)] for i in range(3)])
+    for i in range(3):
+        expected[i, i] = 0
+    assert_close(divs[:3, :3], expected, atol=1e-5,
+                 msg="JR disagrees with pooled Renyi entropies")
+
+    # the Cython and pure-Python versions should agree for unequal sizes too
+    old_estimate = np_divs._estimate_cross_divs
+    try:
+        np_divs._estimate_cross_divs = _np_divs._estimate_cross_divs
+        py_divs = estimate_divs(feats, **args)
+    finally:
+        np_divs._estimate_cross_divs = old_estimate
+    assert_close(divs, py_divs, atol=1e-5,
+                 msg="Cython and Python JR disagree")
+    assert np.all(divs >= 0)
+    assert np.all(np.diagonal(divs) == 0)
+
+
+def test_entropies():
+    rs = np.random.RandomState(9)
+    bags = [rs.normal(scale=s, size=(n, 3))
+            for s, n in [(1, 30), (2, 45), (.5, 20), (1, 60)]]
+    feats = Features(bags)
+    alphas = [.5, .99, 1, 1.5]
+    Ks = [2, 4]
+
+    def entropy(X, alpha, K):
+        n, d = X.shape
+        rho = np.sort(cdist(X, X), axis=1)[:, K]
+        log_c = d / 2 * np.log(np.pi) - gammaln(d / 2 + 1)
+        if alpha == 1:
+            return log_c + np.log(n - 1) - psi(K) + d * np.mean(np.log(rho))
+        return log_c + (
+            np.log(np.mean(((n - 1) * rho ** d) ** (1 - alpha)))
+            + gammaln(K) - gammaln(K + 1 - alpha)) / (1 - alpha)
+
+    expected = np.array([[[entropy(X, alpha, K) for K in Ks]
+                          for alpha in alphas] for X in bags])
+    got = estimate_entropies(feats, alphas=alphas, Ks=Ks, min_dist=1e-10,
+                             status_fn=None)
+    assert got.shape == (len(bags), len(alphas), len(Ks))
+    assert_close(got, expected, atol=1e-4,
+                 msg="entropies disagree with brute force")
+
+    # wider distributions have higher entropy
+    assert np.all(got[1] > got[0]) and np.all(got[0] > got[2])
+
+
+def test_tiled_workers():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    feats_file = os.path.join(dir, 'gaussian-2d-mean0-std1,2.h5')
+    feats = Features.load_from_hdf5(feats_file)
+    specs = ['kl', 'l2', 'js']
+    Ks = [3, 5]
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        out_file = os.path.join(tempdir, 'divs.h5')
+        tile_dir = out_file + '.tiles'
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + env.get('PYTHONPATH', '').split(os.pathsep))
+
+        def run(*args):
+            cmd = [sys.executable, '-m', 'sdm.np_divs', feats_file, out_file,
+                   '--div-funcs'] + specs + ['-K'] + [str(K) for K in Ks] + [
+                   '--min-dist', '1e-10', '--cores', '1',
+                   '--poll-interval', '.1'] + list(args)
+            return subprocess.Popen(cmd, env=env, stderr=devnull)
+
+        with open(os.devnull, 'w') as devnull:
+            # one tile done by hand before the coordinator even starts
+            assert run('--tile', '1/5').wait() == 0
+
+            coord = run('--coordinate', '5')
+            while not os.path.exists(os.path.join(tile_dir, 'job.json')):
+                assert coord.poll() is None
+                time.sleep(.1)
+
+            # stand-ins for workers on other machines
+            workers = [run('--worker') for _ in range(3)]
+            assert coord.wait() == 0
+            assert all(w.wait() == 0 for w in workers)
+
+            # a worker that turns up late finds nothing to do
+            assert run('--worker').wait() == 0
+
+        assert not os.path.exists(tile_dir)
+
+        # nor does one that finishes a tile after the coordinator's done
+        assert not np_divs.compute_tile(feats, tile_dir, 0, 5, specs=specs,
+                                        Ks=Ks, min_dist=1e-10, status_fn=None)
+        assert not os.path.exists(tile_dir)
+        with h5py.File(out_file, 'r') as f:
+            got = load_divs(f, specs, Ks)
+    finally:
+        shutil.rmtree(tempdir)
+
+    expected = estimate_divs(feats, specs=specs, Ks=Ks, min_dist=1e-10,
+                             status_fn=None)
+    assert_close(got, expected, atol=5e-5,
+                 msg="tiled divs disagree with estimate_divs")
+
 ################################################################################
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import warnings
+
+from nose.plugins.skip import SkipTest
+import numpy as np
+
+from .. import Features
+try:
+    from .. import extract_image_features as eif
+except ImportError:
+    eif = None
+
+
+def _need_vlfeat():
+    if eif is None:
+        raise SkipTest("vlfeat isn't installed")
+
+
+def _fake_get_features(img, calls, **kwargs):
+    # the "image" is just [id, n_feats]; frames and descrs are made from those
+    ident, n = img
+    calls.append(ident)
+    frames = np.tile([ident, 0, 1], (n, 1)).astype(np.float32)
+    descrs = np.arange(n * 4, dtype=np.float32).reshape(n, 4) + ident
+    return frames, descrs
+
+
+def test_save_image_features_resume():
+    _need_vlfeat()
+
+    tempdir = tempfile.mkdtemp()
+    old_get_features = eif.get_features
+    calls = []
+    try:
+        n_feats = [3, 5, 0, 2, 4, 1, 6]
+        paths = []
+        for ident, n in enumerate(n_feats):
+            path = os.path.join(tempdir, 'img{}.png'.format(ident))
+            with open(path, 'wb') as f:
+                np.save(f, np.array([ident, n]))
+            paths.append(path)
+        cats = ['a', 'b'] * 3 + ['a']
+
+        eif._imread_cache[('npy-test',)] = ('npy-test', np.load)
+        eif.get_features = \
+            lambda img, **kwargs: _fake_get_features(img, calls, **kwargs)
+
+        save_path = os.path.join(tempdir, 'feats.h5')
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            n = eif.save_image_features(
+                paths[:4], cats[:4], save_path, imread_mode='npy-test',
+                chunksize=2, max_in_flight=2)
+        assert n == 3  # img2 has no features
+        assert calls == [0, 1, 2, 3]
+        assert any('got no features' in str(x.message) for x in w)
+
+        # resuming only does the ones that aren't there yet; img2 was never
+        # written, so it gets tried again
+        del calls[:]
+        n = eif.save_image_features(
+            paths, cats, save_path, resume=True, imread_mode='npy-test',
+            io_threads=0)
+        assert n == 3
+        assert calls == [2, 4, 5, 6]
+
+        feats = Features.load(save_path)
+        expected = [(cats[i], 'img{}.png'.format(i))
+                    for i, n_i in enumerate(n_feats) if n_i]
+        got = sorted(zip(feats.categories, feats.names))
+        assert got == sorted(expected)
+        for cat, name, bag, frames in zip(feats.categories, feats.names,
+                                          feats.features, feats.frames):
+            ident = int(name[len('img'):-len('.png')])
+            assert bag.shape == (n_feats[ident], 4)
+            assert np.all(bag[:, 0] == 4 * np.arange(n_feats[ident]) + ident)
+            assert np.all(frames[:, 0] == ident)
+    finally:
+        eif.get_features = old_get_features
+        eif._imread_cache.pop(('npy-test',), None)
+        shutil.rmtree(tempdir)
@@ -0,0 +1,282 @@
+from contextlib import closing
+from functools import partial
+from glob import glob
+import json
+import operator as op
+import os
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+import numpy as np
+
+from .. import Features
+from ..features import _shard_bounds
+from ..utils import reduce
+try:
+    from .. import typedbytes_utils as tbu
+except ImportError:
+    tbu = None
+
+
+def _make_feats():
+    n_pts = np.random.randint(1, 10, size=23)
+    bags = [np.random.normal(size=(n, 3)).astype(np.float32) for n in n_pts]
+    return Features(bags, categories=['a'] * 11 + ['b'] * 12,
+                    label=np.arange(23), frames=[b * 2 for b in bags])
+
+
+def _check_same(feats, loaded):
+    assert len(feats) == len(loaded)
+    assert np.all(feats.categories == loaded.categories)
+    assert np.all(feats.names == loaded.names)
+    assert np.all(feats.label == loaded.label)
+    for a, b in zip(feats.features, loaded.features):
+        assert np.all(a == b)
+    for a, b in zip(feats.frames, loaded.frames):
+        assert np.all(a == b)
+
+
+def _sorted(feats):
+    return feats[np.lexsort((feats.label,))]
+
+
+def test_hdf5_layouts():
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        for layout in ['groups', 'stacked']:
+            fname = os.path.join(tempdir, layout + '.h5')
+            feats.save_as_hdf5(fname, layout=layout, thing=3)
+
+            loaded, attrs = Features.load(fname, load_attrs=True)
+            yield _check_same, feats, _sorted(loaded)
+            assert attrs == {'thing': 3}
+
+            which = feats.label % 3 == 0
+            pairs = set(zip(feats.categories[which], feats.names[which]))
+            loaded = Features.load_from_hdf5(fname, pairs=pairs)
+            yield _check_same, feats[which], _sorted(loaded)
+
+            batches = list(Features.iter_from_hdf5(
+                fname, batch_size=5, max_points=20))
+            assert all(len(b) <= 5 for b in batches)
+            assert all(b.total_points <= 20 or len(b) == 1 for b in batches)
+            loaded = reduce(op.add, batches)
+            yield _check_same, feats, _sorted(loaded)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_hdf5_stacked_chunked():
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tempdir, 'feats.h5')
+        feats.save_as_hdf5(fname, layout='stacked',
+                           stacked_opts={'compression': 'gzip'})
+        loaded = Features.load(fname, mmap=True)
+        assert loaded._features.base is None
+        _check_same(feats, loaded)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_hdf5_stacked_subsample():
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tempdir, 'feats.h5')
+        feats.save_as_hdf5(fname, layout='stacked')
+
+        names = Features.load_from_hdf5(fname, names_only=True)
+        assert names == list(zip(feats.categories, feats.names))
+
+        loaded = Features.load(fname, mmap=True)
+        assert isinstance(loaded._features.base, np.memmap)
+        _check_same(feats, loaded)
+        loaded._features[0] = 12  # copy-on-write
+        assert np.all(Features.load(fname).features[0][0] == feats.features[0][0])
+        del loaded
+
+        loaded = Features.load(fname, mmap=True, pairs=set([('b', '12')]))
+        assert isinstance(loaded._features.base, np.memmap)
+        _check_same(feats[12:13], loaded)
+
+        rev = partial(sorted, reverse=True)
+        loaded = Features.load_from_hdf5(fname, subsample_fn=rev, mmap=True,
+                                         features_dtype=np.float64)
+        assert loaded.dtype == np.float64
+        assert loaded._features.base is None
+        _check_same(_sorted(feats), _sorted(loaded))
+
+        # batches mixing a forward run with reversed single bags
+        sub = lambda pairs: pairs[10:] + pairs[9::-1]
+        batches = list(Features.iter_from_hdf5(fname, batch_size=4,
+                                               subsample_fn=sub))
+        loaded = reduce(op.add, batches)
+        order = np.r_[10:23, 9:-1:-1]
+        _check_same(feats[order], loaded)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_perbag():
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        feats.save_as_perbag(tempdir, thing=3)
+        for n_threads in [1, 4]:
+            loaded, attrs = Features.load(tempdir, load_attrs=True,
+                                          n_threads=n_threads)
+            _check_same(feats, _sorted(loaded))
+            assert attrs == {'thing': 3}
+
+        loaded = Features.load_from_perbag(tempdir, cats=set(['b']),
+                                           features_dtype=np.float64)
+        assert loaded.dtype == np.float64
+        _check_same(feats[11:], _sorted(loaded))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def _need_typedbytes():
+    if tbu is None:
+        raise SkipTest("typedbytes isn't installed")
+
+
+def test_typedbytes_shards():
+    _need_typedbytes()
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'feats')
+        feats.save_as_typedbytes(path, shard_bags=5, thing=3)
+        assert len(glob(os.path.join(path, 'data_*.tb'))) == 5
+
+        for n_threads in [1, 4]:
+            loaded, attrs = Features.load(path, load_attrs=True,
+                                          n_threads=n_threads)
+            _check_same(feats, loaded)
+            assert attrs == {'thing': 3}
+
+        loaded = Features.load_from_typedbytes(path, cats=set(['b']),
+                                               features_dtype=np.float64)
+        assert loaded.dtype == np.float64
+        _check_same(feats[11:], loaded)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_typedbytes_manifest():
+    _need_typedbytes()
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'feats')
+        for n_proc in [1, 3]:
+            feats.save_as_typedbytes(path, splits=[7, 15], n_proc=n_proc)
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+            assert manifest['n_bags'] == len(feats)
+            shards = [(s['file'], s['start'], s['end'])
+                      for s in manifest['shards']]
+            assert shards == [('data_0.tb', 0, 7), ('data_7.tb', 7, 15),
+                              ('data_15.tb', 15, 23)]
+
+            for fname, start, end in shards:
+                with closing(np.load(os.path.join(
+                        path, fname[:-len('.tb')] + '.idx.npz'))) as index:
+                    assert np.all(index['names'] == feats.names[start:end])
+            _check_same(feats, Features.load(path))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_typedbytes_index():
+    _need_typedbytes()
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'indexed')
+        feats.save_as_typedbytes(path, shard_bags=6)
+        scan_path = os.path.join(tempdir, 'scanned')
+        shutil.copytree(path, scan_path)
+        for fname in glob(os.path.join(scan_path, '*.idx.npz')):
+            os.remove(fname)
+
+        # the offsets should point at the start of each record
+        for fname in glob(os.path.join(path, 'data_*.tb')):
+            with closing(np.load(fname[:-len('.tb')] + '.idx.npz')) as index:
+                with open(fname, 'rb') as f:
+                    inp = tbu.tb.Input(f)
+                    tbu.register_read(inp)
+                    for cat, name, offset, length in zip(
+                            index['categories'], index['names'],
+                            index['offsets'], index['lengths']):
+                        f.seek(offset)
+                        assert inp.read() == '{}/{}'.format(cat, name)
+                        inp.read()
+                        assert f.tell() == offset + length
+                    assert inp.read() is None
+
+        which = feats.label % 3 == 0
+        pairs = set(zip(feats.categories[which], feats.names[which]))
+        rev = lambda bag_names: bag_names[::-1]
+        for kwargs, expected in [
+                ({}, feats),
+                ({'cats': set(['b'])}, feats[11:]),
+                ({'pairs': pairs}, feats[which]),
+                ({'subsample_fn': rev}, feats[::-1]),
+                ({'cats': set(['a']), 'subsample_fn': rev}, feats[10::-1]),
+                ]:
+            for p in [path, scan_path]:
+                _check_same(expected, Features.load(p, **kwargs))
+                names = Features.load(p, names_only=True, **kwargs)
+                assert names == list(zip(expected.categories, expected.names))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_shard_bounds():
+    sizes = [10, 20, 30, 5, 5, 50, 1]
+    assert _shard_bounds(sizes, shard_bytes=25) == \
+        [(0, 2), (2, 3), (3, 6), (6, 7)]
+    assert _shard_bounds(sizes) == [(0, 7)]
+    assert _shard_bounds(sizes, shard_bags=3) == [(0, 3), (3, 6), (6, 7)]
+    assert _shard_bounds(sizes, splits=[5, 2]) == [(0, 2), (2, 5), (5, 7)]
+    assert _shard_bounds(sizes, splits=[0, 6]) == [(0, 6), (6, 7)]
+
+
+def test_open_writer():
+    feats = _make_feats()
+    tempdir = tempfile.mkdtemp()
+    try:
+        formats = ['hdf5', 'perbag']
+        if tbu is not None:
+            formats.append('typedbytes')
+        for format in formats:
+            path = os.path.join(tempdir, format)
+            with Features.open_writer(path, format=format, thing=3) as w:
+                for bag in feats[:10]:
+                    w.write(bag['category'], bag['name'], bag['features'],
+                            label=bag['label'], frames=bag['frames'])
+
+            with Features.open_writer(path, format=format, resume=True,
+                                      thing=3) as w:
+                assert ('a', '3') in w
+                assert ('b', '12') not in w
+                for bag in feats:
+                    if (bag['category'], bag['name']) not in w:
+                        w.write(bag['category'], bag['name'],
+                                bag['features'], label=bag['label'],
+                                frames=bag['frames'])
+
+            loaded, attrs = Features.load(path, load_attrs=True)
+            yield _check_same, feats, _sorted(loaded)
+            assert attrs == {'thing': 3}
+
+            with Features.open_writer(path, format=format) as w:
+                assert ('a', '3') not in w
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+
+from sdm.features import Features
+from sdm.np_divs import estimate_divs
+from sdm.tests.test_divs import load_divs, assert_close
+
+
+def _script(func):
+    return '"{}" -c "import sdm.hadoop_divs as h; h.{}()"'.format(
+        sys.executable, func)
+
+
+def test_streaming_pipeline():
+    dir = os.path.join(os.path.dirname(__file__), 'data')
+    feats_file = os.path.join(dir, 'gaussian-2d-mean0-std1,2.h5')
+    feats = Features.load_from_hdf5(feats_file)
+
+    specs = ['kl', 'l2', 'js']
+    Ks = [3, 5]
+    div_args = '--div-funcs {} -K {} --min-dist 1e-10 --cores 1'.format(
+        ' '.join(specs), ' '.join(map(str, Ks)))
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        out_file = os.path.join(tempdir, 'divs.h5')
+        cmd = ('{mapper} "{feats}" --n-blocks 3 --list-tiles '
+               '| {mapper} "{feats}" --n-blocks 3 {args} '
+               '| sort '
+               '| {reducer} "{feats}" "{out}" {args}').format(
+            mapper=_script('mapper_main'), reducer=_script('reducer_main'),
+            feats=feats_file, out=out_file, args=div_args)
+
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + env.get('PYTHONPATH', '').split(os.pathsep))
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, shell=True, env=env, stderr=devnull)
+
+        with h5py.File(out_file, 'r') as f:
+            got = load_divs(f, specs, Ks)
+            assert np.all(f['_meta/names'][()] == feats.names)
+    finally:
+        shutil.rmtree(tempdir)
+
+    expected = estimate_divs(feats, specs=specs, Ks=Ks, min_dist=1e-10,
+                             status_fn=None)
+    assert_close(got, expected, atol=5e-5,
+                 msg="streaming divs disagree with estimate_divs")
@@ -0,0 +1,85 @@
+import random
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from ..mp_utils import imap_bounded
+
+
+class _CountingPool(object):
+    '''
+    Wraps a pool to keep track of how many chunks have been submitted but not
+    yet gotten by the consumer.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+        self._processes = pool._processes
+        self.n_submitted = 0
+        self.n_gotten = 0
+        self.most_in_flight = 0
+
+    def apply_async(self, func, args):
+        self.n_submitted += 1
+        self.most_in_flight = max(self.most_in_flight,
+                                  self.n_submitted - self.n_gotten)
+        return _CountingResult(self, self.pool.apply_async(func, args))
+
+
+class _CountingResult(object):
+    def __init__(self, counter, result):
+        self.counter = counter
+        self.result = result
+
+    def get(self):
+        res = self.result.get()
+        self.counter.n_gotten += 1
+        return res
+
+
+def _slow_square(x, lock=threading.Lock(), rng=random.Random(3)):
+    # sleep a random bit so that chunks finish out of order
+    with lock:
+        delay = rng.uniform(0, .005)
+    time.sleep(delay)
+    return x * x
+
+
+def test_imap_bounded():
+    pool = ThreadPool(3)
+    try:
+        for chunksize, max_in_flight in [(1, 2), (4, 3), (3, None), (50, 1)]:
+            counting = _CountingPool(pool)
+            n_read = [0]
+
+            def inputs():
+                for i in range(40):
+                    n_read[0] += 1
+                    yield i
+
+            results = imap_bounded(counting, _slow_square, inputs(),
+                                   chunksize=chunksize,
+                                   max_in_flight=max_in_flight)
+            bound = 2 * 3 if max_in_flight is None else max_in_flight
+
+            first = next(results)
+            assert n_read[0] <= bound * chunksize
+
+            got = [first] + list(results)
+            assert got == [i * i for i in range(40)]
+            assert counting.n_submitted == -(-40 // chunksize)
+            assert counting.n_gotten == counting.n_submitted
+            assert counting.most_in_flight <= bound, \
+                (chunksize, max_in_flight, counting.most_in_flight)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_imap_bounded_empty():
+    pool = ThreadPool(2)
+    try:
+        assert list(imap_bounded(pool, _slow_square, [], chunksize=3)) == []
+    finally:
+        pool.close()
+        pool.join()
@@ -1,10 +1,16 @@
 from functools import partial
 import os
 
+from nose.tools import assert_raises
 import numpy as np
+from sklearn.cross_validation import KFold
 from sklearn.preprocessing import LabelEncoder
 
 from .. import SDC, NuSDC, Features
+from .. import sdm as sdm_module
+from ..sdm import (symmetrize, rbf_kernelize, project_psd, make_km, _KMCache,
+                   _median_positive)
+from ..np_divs import estimate_divs
 
 data_dir = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -38,6 +44,141 @@ def test_simple():
                         yield fn
 
 
+def test_parallel_folds():
+    feats = Features.load_from_hdf5(
+        os.path.join(data_dir, 'gaussian-2d-mean0-std1,2.h5'))
+    y = LabelEncoder().fit_transform(feats.categories)
+
+    folds = list(KFold(n=len(feats), n_folds=4, shuffle=True, random_state=3))
+
+    for project_all in [True, False]:
+        results = []
+        for fold_n_proc in [1, 2]:
+            clf = SDC(div_func='l2', K=3, n_proc=4)
+            acc, preds, _, params = clf.crossvalidate(
+                feats, y, folds=folds, fold_n_proc=fold_n_proc,
+                project_all=project_all, tuning_fold_seed=12,
+                ret_fold_info=True)
+            assert np.all(preds >= 0)
+            _check_acc(acc)
+            assert not hasattr(clf, 'svm_')
+            assert not hasattr(clf, '_tuning_fold_rng')
+            results.append((preds, params))
+        assert np.all(results[0][0] == results[1][0])
+        assert np.all(results[0][1] == results[1][1])
+
+    # without tuning_fold_seed, numpy's global seed fixes the tuning folds
+    results = []
+    for fold_n_proc in [1, 2, 2]:
+        np.random.seed(7)
+        clf = SDC(div_func='l2', K=3, n_proc=4)
+        acc, preds, _, params = clf.crossvalidate(
+            feats, y, folds=folds, fold_n_proc=fold_n_proc, ret_fold_info=True)
+        results.append((preds, params))
+    for preds, params in results[1:]:
+        assert np.all(preds == results[0][0])
+        assert np.all(params == results[0][1])
+
+
+def test_crossvalidate_projections():
+    feats = Features.load_from_hdf5(
+        os.path.join(data_dir, 'gaussian-2d-mean0-std1,2.h5'))
+    y = LabelEncoder().fit_transform(feats.categories)
+    n = len(feats)
+
+    # fold workers' own make_km calls don't make it back here, but the full
+    # projections should all happen in this process anyway
+    shapes = []
+    live = [0, 0]  # current, max number of full kernels held by the cache
+    real_make_km = sdm_module.make_km
+    real_get = _KMCache.get
+    def make_km(divs, *args, **kwargs):
+        shapes.append(divs.shape)
+        return real_make_km(divs, *args, **kwargs)
+    def get(cache, sigma):
+        km = real_get(cache, sigma)
+        live[0] = len(cache.kms)
+        live[1] = max(live)
+        return km
+
+    divs = np.squeeze(estimate_divs(feats, specs=['l2'], Ks=[3],
+                                    status_fn=None))
+    sym_divs = symmetrize(divs)
+    sigma_vals = np.asarray(SDC().sigma_vals)
+
+    sdm_module.make_km = make_km
+    _KMCache.get = get
+    try:
+        for fold_n_proc, share in [(1, False), (1, True), (2, True)]:
+            del shapes[:]
+            live[:] = [0, 0]
+            clf = SDC(div_func='l2', K=3, n_proc=2)
+            acc, preds, folds, params = clf.crossvalidate(
+                feats, y, num_folds=4, fold_n_proc=fold_n_proc, divs=divs,
+                project_all=True, tuning_fold_seed=5, ret_fold_info=True,
+                share_sigma_scale=share)
+            n_full = sum(1 for shape in shapes if shape == (n, n))
+            assert n_full == np.unique(params['sigma']).size
+            assert live[0] == 0 and live[1] <= 1
+
+            # sigma's scaled by each fold's training divergences by default
+            for (train, test), sigma in zip(folds, params['sigma']):
+                scale = _median_positive(sym_divs if share
+                                         else sym_divs[np.ix_(train, train)])
+                assert np.any(np.isclose(sigma, sigma_vals * scale))
+    finally:
+        sdm_module.make_km = real_make_km
+        _KMCache.get = real_get
+
+
+def test_symmetrize_inplace():
+    for n, block_size in [(1, 4), (10, 3), (17, 4), (32, 8), (20, 512)]:
+        for dtype in [np.float32, np.float64]:
+            mat = np.random.normal(size=(n, n)).astype(dtype)
+            expected = (mat + mat.T) / 2
+            res = symmetrize(mat, destroy=True, block_size=block_size)
+            assert res is mat
+            assert res.dtype == dtype
+            assert np.allclose(res, expected)
+
+
+def test_rbf_kernelize():
+    divs = np.random.uniform(0, 3, size=(50, 37)).astype(np.float32)
+    expected = np.exp(-divs.astype(np.float64) ** 2 / (2 * 1.3 ** 2))
+
+    km = rbf_kernelize(divs, 1.3, block_size=4)
+    assert km.dtype == np.float32 and km is not divs
+    assert np.allclose(km, expected, atol=1e-6)
+
+    km = rbf_kernelize(divs, 1.3, destroy=True, block_size=4)
+    assert km is divs
+    assert np.allclose(km, expected, atol=1e-6)
+
+
+def test_project_psd_inplace():
+    mat = np.random.normal(size=(30, 30))
+    mat = mat + mat.T
+    vals, vecs = np.linalg.eigh(mat)
+    expected = np.dot(vecs, np.maximum(vals, 0)[:, None] * vecs.T)
+
+    res = project_psd(mat.copy(), destroy=True)
+    assert np.allclose(res, expected)
+    assert np.all(res == res.T)
+
+
+def test_km_cache():
+    divs = np.abs(np.random.normal(size=(20, 20)))
+    divs = symmetrize(divs)
+    cache = _KMCache(divs, method='clip', uses=[.5, 1, .5])
+
+    assert np.allclose(cache.get(.5), make_km(divs, .5))
+    assert list(cache.kms) == [.5]
+    assert np.allclose(cache.get(.5), make_km(divs, .5))
+    assert not cache.kms
+    assert np.allclose(cache.get(1), make_km(divs, 1))
+    assert not cache.kms
+    assert_raises(ValueError, cache.get, 1)
+
 
 ################################################################################
 
@@ -1,11 +1,18 @@
 from cStringIO import StringIO
 from contextlib import closing
+import fcntl
 from functools import partial
+import os
+import tempfile
 
+from nose.plugins.skip import SkipTest
 import numpy as np
 
 import cyflann
-from ..typedbytes_utils import tb, register_read, register_write
+from .. import typedbytes_utils as tbu
+from ..typedbytes_utils import (tb, register_read, register_write,
+                                read_ndarray, write_ndarray, _npy_size,
+                                flann_to_typedbytes)
 
 # TODO: test with non-seekable files
 
@@ -16,7 +23,9 @@ def _check_all_eq(expected, real):
 def test_typedbytes_ndarray():
     for ary in [np.arange(30, dtype=np.uint8),
                 np.random.normal(size=(10, 12, 100)),
-                np.linspace(1, 3.2, 121).astype(np.float128)]:
+                np.linspace(1, 3.2, 121).astype(np.float128),
+                np.asfortranarray(np.random.normal(size=(5, 7))),
+                np.random.normal(size=(6, 8))[::2, 1::3]]:
         with closing(StringIO()) as sio:
             out = tb.Output(sio)
             register_write(out)
@@ -30,6 +39,46 @@ def test_typedbytes_ndarray():
             yield partial(_check_all_eq, ary, ary2)
 
 
+def _check_ndarray_pipe(ary):
+    with closing(StringIO()) as sio:
+        write_ndarray(sio, ary)
+        raw = sio.getvalue()
+    assert len(raw) == 1 + 4 + _npy_size(ary)
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        os.write(w, raw[1:])
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        ary2 = read_ndarray(f, file_is_seekable=False)
+    os.waitpid(pid, 0)
+    assert ary2.flags.writeable
+    assert np.all(ary == ary2)
+
+def _check_ndarray_mmap(ary):
+    with closing(StringIO()) as sio:
+        write_ndarray(sio, ary)
+        raw = sio.getvalue()
+
+    with tempfile.TemporaryFile() as f:
+        f.write(raw[1:] + b'after')
+        f.seek(0)
+        ary2 = read_ndarray(f, mmap_min_bytes=0)
+        assert isinstance(ary2, np.memmap)
+        assert np.all(ary == ary2)
+        assert f.read() == b'after'
+
+def test_ndarray_nonseekable():
+    for ary in [np.random.normal(size=(100, 20)),
+                np.asfortranarray(np.random.normal(size=(30, 4))),
+                np.arange(10, dtype=np.int16)]:
+        yield partial(_check_ndarray_pipe, ary)
+        yield partial(_check_ndarray_mmap, ary)
+
+
 def _check_flann(idx1, idx2):
     assert np.all(idx1.data == idx2.data)
     assert np.allclose(idx1.nn_index(idx1.data)[1], idx2.nn_index(idx1.data)[1])
@@ -53,3 +102,48 @@ def test_typedbytes_flann():
             fn = partial(_check_flann, idx, idx2)
             fn.description = "flann typedbytes io - {}".format(algorithm)
             yield fn
+
+
+def _flann_roundtrip(idx, **kwargs):
+    with closing(StringIO()) as sio:
+        out = tb.Output(sio)
+        register_write(out)
+        flann_to_typedbytes(out, idx, **kwargs)
+
+        sio.seek(0)
+        inp = tb.Input(sio)
+        register_read(inp)
+        return inp.read()
+
+def test_flann_scratch_fallback():
+    # without memfd_create, or if it fails, indices go through a tempfile
+    pts = np.random.normal(size=(100, 2))
+    idx = cyflann.FLANNIndex(algorithm='kdtree_single')
+    idx.build_index(pts)
+
+    old_memfd_create = tbu._memfd_create
+    tempdir = tempfile.mkdtemp()
+    try:
+        for memfd_create in [None, lambda name, flags: -1]:
+            tbu._memfd_create = memfd_create
+
+            seen = []
+            with tbu._scratch_file(tempdir) as (path, fd):
+                assert os.path.dirname(path) == tempdir
+                assert os.path.exists(path)
+                seen.append(path)
+            assert not os.path.exists(seen[0])
+
+            _check_flann(idx, _flann_roundtrip(idx, tempdir=tempdir))
+            assert os.listdir(tempdir) == []
+    finally:
+        tbu._memfd_create = old_memfd_create
+        os.rmdir(tempdir)
+
+def test_flann_scratch_memfd():
+    if tbu._memfd_create is None:
+        raise SkipTest("memfd_create isn't available")
+
+    with tbu._scratch_file('/nonexistent') as (path, fd):
+        assert path == '/proc/self/fd/{}'.format(fd)
+        assert fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC
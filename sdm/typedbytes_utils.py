@@ -1,8 +1,7 @@
-from cStringIO import StringIO
-from contextlib import closing
+from contextlib import contextmanager
+import ctypes
 import errno
 import os
-from shutil import copyfileobj
 import struct
 import tempfile
 
@@ -118,18 +117,29 @@ class TypedbytesSequenceFileInput(object):
 NUMPY_CODE = 0xaa
 
 
-def _npy_size(ary):
-    assert not ary.dtype.hasobject
-    magic_len = npy.MAGIC_LEN
+_ARRAY_ALIGN = getattr(npy, 'ARRAY_ALIGN', 16)
+
+# arrays at least this big in regular files are memory-mapped (copy-on-write)
+# rather than read in; set to None to always read.
+DEFAULT_MMAP_MIN_BYTES = 16 * 2**20
+
 
-    # TODO: could calculate this directly
-    with closing(StringIO()) as sio:
-        npy.write_array_header_1_0(sio, npy.header_data_from_array_1_0(ary))
-        header_len = sio.tell()
+def _npy_header(ary):
+    '''
+    The .npy (format version 1.0) header for ary, including the magic string,
+    padded so that the data is aligned like np.save() does.
+    '''
+    d = npy.header_data_from_array_1_0(ary)
+    header = "{{'descr': {!r}, 'fortran_order': {!r}, 'shape': {!r}, }}".format(
+        d['descr'], d['fortran_order'], d['shape'])
+    header_len = npy.MAGIC_LEN + 2 + len(header) + 1
+    header += ' ' * (-header_len % _ARRAY_ALIGN) + '\n'
+    return npy.magic(1, 0) + struct.pack('<H', len(header)) + header
 
-    data_len = ary.dtype.itemsize * ary.size
 
-    return magic_len + header_len + data_len
+def _npy_size(ary):
+    assert not ary.dtype.hasobject
+    return len(_npy_header(ary)) + ary.nbytes
 
 
 def _file_is_seekable(f):
@@ -149,7 +159,39 @@ def check_seekable(the_obj):
         the_obj._file_seekable = _file_is_seekable(the_obj.file)
 
 
-def read_ndarray(f, file_is_seekable=None):
+def _read_exactly(f, n_bytes):
+    '''
+    Reads n_bytes from f into a new bytearray, using readinto if f supports
+    it to avoid making an intermediate string.
+    '''
+    if not hasattr(f, 'readinto'):
+        buf = bytearray(f.read(n_bytes))
+    else:
+        buf = bytearray(n_bytes)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n_bytes:
+            amt = f.readinto(view[pos:])
+            if not amt:
+                break
+            pos += amt
+        del view
+    if len(buf) != n_bytes:
+        raise ValueError("EOF while reading array: expected {} bytes, got {}"
+                         .format(n_bytes, len(buf)))
+    return buf
+
+
+def read_ndarray(f, file_is_seekable=None,
+                 mmap_min_bytes=DEFAULT_MMAP_MIN_BYTES):
+    '''
+    Reads an array written by write_ndarray() (after the type code).
+
+    Parses the .npy header itself and reads the data directly into the
+    array's memory, so each array is allocated once even from a pipe. Arrays
+    of at least mmap_min_bytes in regular files are instead memory-mapped,
+    copy-on-write.
+    '''
     length, = struct.unpack('>i', f.read(4))
     if length < 0:
         raise ValueError(r"bad length value {}".format(length))
@@ -157,17 +199,35 @@ def read_ndarray(f, file_is_seekable=None):
     if file_is_seekable is None:
         file_is_seekable = _file_is_seekable(f)
 
-    if file_is_seekable:
-        return np.load(f)
+    version = npy.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy.read_array_header_1_0(f)
     else:
-        with closing(StringIO()) as sio:
-            sio.write(f.read(length))
-            sio.seek(0)
-            return np.load(sio)
+        shape, fortran_order, dtype = npy.read_array_header_2_0(f)
+    if dtype.hasobject:
+        raise ValueError("can't read object arrays")
+
+    order = 'F' if fortran_order else 'C'
+    count = int(np.prod(shape))
+    n_bytes = count * dtype.itemsize
+
+    if (file_is_seekable and mmap_min_bytes is not None
+            and n_bytes >= mmap_min_bytes and isinstance(f, file)):
+        offset = f.tell()
+        ary = np.memmap(f, dtype=dtype, mode='c', offset=offset,
+                        shape=shape, order=order)
+        f.seek(offset + n_bytes)
+        return ary
+
+    buf = _read_exactly(f, n_bytes)
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(
+        shape, order=order)
 
 def _read_ndarray_in(self):
     seekable = getattr(self, '_file_seekable', None)
-    return read_ndarray(self.file, file_is_seekable=seekable)
+    mmap_min_bytes = getattr(self, '_mmap_min_bytes', DEFAULT_MMAP_MIN_BYTES)
+    return read_ndarray(self.file, file_is_seekable=seekable,
+                        mmap_min_bytes=mmap_min_bytes)
 
 def register_read_ndarray(input_object):
     check_seekable(input_object)
@@ -175,9 +235,16 @@ def register_read_ndarray(input_object):
 
 
 def write_ndarray(f, ary):
+    assert not ary.dtype.hasobject
+    header = _npy_header(ary)
     f.write(struct.pack('>B', NUMPY_CODE))
-    f.write(struct.pack('>i', _npy_size(ary)))
-    np.save(f, ary)
+    f.write(struct.pack('>i', len(header) + ary.nbytes))
+    f.write(header)
+
+    # header says fortran_order only if it's F- and not C-contiguous
+    if ary.flags.f_contiguous and not ary.flags.c_contiguous:
+        ary = ary.T
+    f.write(np.ascontiguousarray(ary).data)
 
 def _write_ndarray_out(self, ary):
     write_ndarray(self.file, ary)
@@ -216,6 +283,43 @@ FLANN_CODE = 0xab
 DEFAULT_TEMPDIR = None
 _not_passed = object()
 
+try:
+    _memfd_create = ctypes.CDLL(None, use_errno=True).memfd_create
+except (OSError, AttributeError):
+    _memfd_create = None
+else:
+    _memfd_create.argtypes = [ctypes.c_char_p, ctypes.c_uint]
+    _memfd_create.restype = ctypes.c_int
+
+MFD_CLOEXEC = 1  # from <sys/mman.h>; don't leak the fd into child processes
+
+_COPY_CHUNK = 2**20
+
+
+@contextmanager
+def _scratch_file(tempdir=None):
+    '''
+    Yields (path, fd) for a scratch file that FLANN can save to or load from
+    by name. On Linux this is an anonymous in-memory file (memfd), so nothing
+    touches the disk; elsewhere, it's a temporary file in tempdir.
+    '''
+    fd = -1
+    if _memfd_create is not None:
+        fd = _memfd_create(b'sdm-flann', MFD_CLOEXEC)
+    if fd >= 0:
+        try:
+            yield '/proc/self/fd/{}'.format(fd), fd
+        finally:
+            os.close(fd)
+    else:
+        fd, path = tempfile.mkstemp(dir=tempdir)
+        try:
+            yield path, fd
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+
 def flann_from_typedbytes(inp, tempdir=_not_passed):
     if tempdir is _not_passed:
         tempdir = DEFAULT_TEMPDIR
@@ -225,12 +329,14 @@ def flann_from_typedbytes(inp, tempdir=_not_passed):
     pts = inp._read()
     index_bytes = inp.read_bytestring()
 
-    with tempfile.NamedTemporaryFile(dir=tempdir) as f:
-        f.write(index_bytes)
-        f.flush()
-        del index_bytes
+    with _scratch_file(tempdir) as (path, fd):
+        view = memoryview(index_bytes)
+        while view:
+            view = view[os.write(fd, view):]
+        del view, index_bytes
+
         index = cyflann.FLANNIndex()
-        index.load_index(f.name, pts)
+        index.load_index(path, pts)
 
     return index
 
@@ -245,13 +351,9 @@ def flann_to_typedbytes(out, index, tempdir=_not_passed):
 
     npy_size = _npy_size(index.data)
 
-    # do a little dance with this tempfile to avoid buffering issues
-    with tempfile.NamedTemporaryFile(dir=tempdir, delete=False) as f:
-        tempname = f.name
-
-    try:
-        index.save_index(tempname)
-        index_size = os.path.getsize(tempname)
+    with _scratch_file(tempdir) as (path, fd):
+        index.save_index(path)
+        index_size = os.fstat(fd).st_size
 
         out.file.write(struct.pack('>B', FLANN_CODE))
         out.file.write(struct.pack('>i',
@@ -261,10 +363,12 @@ def flann_to_typedbytes(out, index, tempdir=_not_passed):
         out._write(index.data)
 
         out.file.write(struct.pack('>i', index_size))
-        with open(tempname, 'rb') as f:
-            copyfileobj(f, out.file)
-    finally:
-        os.remove(tempname)
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            chunk = os.read(fd, _COPY_CHUNK)
+            if not chunk:
+                break
+            out.file.write(chunk)
 
 def register_write_flann(output_object):
     register_write_ndarray(output_object)
@@ -89,6 +89,8 @@ setup(
             'extract_image_features = sdm.extract_image_features:main',
             'proc_image_features = sdm.proc_image_features:main',
             'estimate_divs = sdm.np_divs:main',
+            'estimate_divs_mapper = sdm.hadoop_divs:mapper_main',
+            'estimate_divs_reducer = sdm.hadoop_divs:reducer_main',
             'sdm = sdm.sdm:main',
         ],
     },